@@ -1,3 +1,4 @@
+import ctypes
 from simple_com import get_IID_from_raw
 
 # COM IID for the interface we need
@@ -45,6 +46,25 @@ DEBUG_DATA_BASE_TRANSLATION_VIRTUAL_OFFSET      = 3
 DEBUG_DATA_PROCESSOR_IDENTIFICATION             = 4
 DEBUG_DATA_PROCESSOR_SPEED                      = 5
 
+DEBUG_INVALID_OFFSET = 0xffffffffffffffff
+DEBUG_ANY_ID = 0xffffffff
+
+
+# https://msdn.microsoft.com/en-us/library/windows/hardware/ff541652%28v=vs.85%29.aspx
+class DEBUG_MODULE_PARAMETERS(ctypes.Structure):
+    _fields_ = [("Base", ctypes.c_uint64),
+                ("Size", ctypes.c_ulong),
+                ("TimeDateStamp", ctypes.c_ulong),
+                ("Checksum", ctypes.c_ulong),
+                ("Flags", ctypes.c_ulong),
+                ("SymbolType", ctypes.c_ulong),
+                ("ImageNameSize", ctypes.c_ulong),
+                ("ModuleNameSize", ctypes.c_ulong),
+                ("LoadedImageNameSize", ctypes.c_ulong),
+                ("SymbolFileNameSize", ctypes.c_ulong),
+                ("MappedImageNameSize", ctypes.c_ulong),
+                ("Reserved", ctypes.c_uint64 * 2)]
+
 
 # Values for MmMapLockedPagesSpecifyCache
 UserMode = 1
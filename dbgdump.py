@@ -0,0 +1,149 @@
+"""Dump of the physical memory of the debugged kernel into a raw image"""
+import os
+import sys
+import json
+import time
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import dbgmemory
+
+
+def print_progress(done, total, rate, eta):
+    """Progress callback of :class:`PhysicalMemoryDumper` writing a status line on stdout"""
+    sys.stdout.write("\r{0}/{1} MB ({2:.1f} MB/s, ETA {3}s)   ".format(done >> 20, total >> 20, rate / (1 << 20), int(eta)))
+    sys.stdout.flush()
+
+
+class PhysicalMemoryDumper(object):
+    """| Dump the physical memory **runs** ((base, size) list) into the raw image **path**.
+       | Each physical address is written at the same offset in the image, the holes
+       | between the runs are never written (they read as zeros).
+       | The memory is read by chunks of **chunk_size**, at most **max_pending** chunks
+       | are waiting for the writer thread.
+       | **progress(done, total, rate, eta)** is called after each chunk (see :func:`print_progress`)
+       | The progress is saved in **path** + ".resume", a dump interrupted for any reason
+       | continues where it stopped when :func:`dump` is called again during the same boot
+       | (see :func:`LocalKernelDebuggerBase.get_boot_identity`).
+    """
+    DEFAULT_CHUNK_SIZE = 0x400000
+    RESUME_INTERVAL = 2
+
+    def __init__(self, kdbg, path, runs=None, chunk_size=DEFAULT_CHUNK_SIZE, max_pending=4, progress=None):
+        self.kdbg = kdbg
+        self.path = path
+        self.resume_path = path + ".resume"
+        if runs is None:
+            runs = kdbg.get_physical_memory_runs()
+        self.runs = [(base, size) for base, size in sorted(runs)]
+        # The memory of another boot must not complete an interrupted dump
+        self.boot = list(kdbg.get_boot_identity())
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending
+        self.progress = progress
+        self.total = sum(size for base, size in self.runs)
+        # Every physical address below next_addr is dumped
+        self.next_addr = 0
+        self.done = 0
+        self.holes = []
+        self._queue = None
+        self._writer_error = None
+
+    def _load_resume(self):
+        if not os.path.exists(self.resume_path) or not os.path.exists(self.path):
+            return False
+        with open(self.resume_path) as f:
+            state = json.load(f)
+        if [tuple(run) for run in state["runs"]] != self.runs:
+            raise ValueError("Resume file {0} was created for other physical memory runs".format(self.resume_path))
+        if state.get("boot") != self.boot:
+            raise ValueError("Resume file {0} was created during another boot".format(self.resume_path))
+        self.next_addr = state["next"]
+        self.holes = [tuple(hole) for hole in state["holes"]]
+        self.done = sum(min(size, max(0, self.next_addr - base)) for base, size in self.runs)
+        return True
+
+    def _save_resume(self):
+        state = {"runs": self.runs, "boot": self.boot, "next": self.next_addr, "holes": self.holes}
+        tmp_path = self.resume_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        if os.path.exists(self.resume_path):
+            os.remove(self.resume_path)
+        os.rename(tmp_path, self.resume_path)
+
+    def _writer(self, image):
+        start = time.time()
+        start_done = self.done
+        last_save = start
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._writer_error is not None:
+                continue  # Drain the queue so the reader never blocks
+            addr, data, end = item
+            try:
+                if data is None:
+                    self.holes.append((addr, end - addr))
+                else:
+                    image.seek(addr)
+                    image.write(data)
+                self.done += end - addr
+                self.next_addr = end
+                now = time.time()
+                if now - last_save >= self.RESUME_INTERVAL:
+                    image.flush()
+                    self._save_resume()
+                    last_save = now
+                if self.progress is not None:
+                    rate = (self.done - start_done) / max(now - start, 1e-6)
+                    self.progress(self.done, self.total, rate, (self.total - self.done) / max(rate, 1))
+            except Exception as e:
+                self._writer_error = e
+
+    def _iter_chunks(self):
+        for base, size in self.runs:
+            start = max(base, self.next_addr)
+            if start >= base + size:
+                continue
+            for offset, data in self.kdbg.iter_read(start, base + size - start, self.chunk_size, physical=True):
+                addr = start + offset
+                if isinstance(data, dbgmemory.MemoryHole):
+                    yield addr, None, addr + data.size
+                else:
+                    # The buffer of iter_read is reused: copy the data for the writer thread
+                    yield addr, data.tobytes(), addr + len(data)
+
+    def dump(self):
+        """Dump (or finish to dump) the physical memory, return the unreadable (addr, size) ranges"""
+        resumed = self._load_resume()
+        image = open(self.path, "r+b" if resumed else "wb")
+        self._queue = queue.Queue(self.max_pending)
+        self._writer_error = None
+        writer = threading.Thread(target=self._writer, args=(image,))
+        writer.start()
+        try:
+            for item in self._iter_chunks():
+                if self._writer_error is not None:
+                    break
+                self._queue.put(item)
+        finally:
+            self._queue.put(None)
+            writer.join()
+            image.flush()
+            self._save_resume()
+            if self._writer_error is None and self.runs and self.next_addr >= self.runs[-1][0] + self.runs[-1][1]:
+                # Give the image its full size even if the last pages are holes
+                image.truncate(self.next_addr)
+                image.close()
+                os.remove(self.resume_path)
+            else:
+                image.close()
+        if self._writer_error is not None:
+            raise self._writer_error
+        return self.holes
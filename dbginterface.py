@@ -1,21 +1,30 @@
 import os
+import time
+import threading
+import traceback
+import collections
 from os.path import realpath, dirname
 import struct
 import itertools
 import functools
+import contextlib
 import ctypes
 from ctypes import byref, WINFUNCTYPE, HRESULT, WinError
 
 from simple_com import COMInterface, IDebugOutputCallbacksVtable
 import resource_emulation
 import driver_upgrade
+import dbgmemory
+import dbgdump
+import dbgsymbols
 from driver_upgrade import DU_MEMALLOC_IOCTL, DU_KCALL_IOCTL, DU_OUT_IOCTL, DU_IN_IOCTL
 import windows
 import windows.hooks
 import windows.winproxy as winproxy
 from windows.generated_def.winstructs import *
+from windows.generated_def.winfuncs import SymFromNamePrototype, SymFromNameParams
 from dbgdef import *
-from dbgtype import DbgEngType
+from dbgtype import DbgEngType, TypeRegistry
 
 # Based on the trick used in PRAW
 # http://stackoverflow.com/a/22023805
@@ -92,9 +101,13 @@ class IDebugSymbols(COMInterface):
         "GetNumberModules": WINFUNCTYPE(HRESULT, LPDWORD, LPDWORD)(12, "GetNumberModules"),
         # https://msdn.microsoft.com/en-us/library/windows/hardware/ff547080%28v=vs.85%29.aspx
         "GetModuleByIndex": WINFUNCTYPE(HRESULT, DWORD, PULONG64)(13, "GetModuleByIndex"),
+        # IDebugSymbols::GetModuleByModuleName
+        "GetModuleByModuleName": WINFUNCTYPE(HRESULT, c_char_p, ULONG, PULONG, PULONG64)(14, "GetModuleByModuleName"),
         # https://msdn.microsoft.com/en-us/library/windows/hardware/ff547146%28v=vs.85%29.aspx
         "GetModuleNames": WINFUNCTYPE(HRESULT, DWORD, c_uint64,
                                       PVOID, DWORD, LPDWORD, PVOID, DWORD, LPDWORD, PVOID, DWORD, LPDWORD)(16, "GetModuleNames"),
+        # https://msdn.microsoft.com/en-us/library/windows/hardware/ff547161%28v=vs.85%29.aspx
+        "GetModuleParameters": WINFUNCTYPE(HRESULT, ULONG, PULONG64, ULONG, PVOID)(17, "GetModuleParameters"),
         # https://msdn.microsoft.com/en-us/library/windows/hardware/ff549408%28v=vs.85%29.aspx
         "GetTypeName": WINFUNCTYPE(HRESULT, ULONG64, ULONG, PVOID, ULONG, PULONG)(19, "GetTypeName"),
         # https://msdn.microsoft.com/en-us/library/windows/hardware/ff549376%28v=vs.85%29.aspx
@@ -168,6 +181,25 @@ class DummyIATEntry(ctypes.Structure):
         return hook
 
 
+MAX_SYM_NAME = 2000
+
+
+class SymbolInfoBuffer(ctypes.Structure):
+    """A SYMBOL_INFO followed by the space for a name of MAX_SYM_NAME characters"""
+    _fields_ = [
+        ("info", SYMBOL_INFO),
+        ("name_buffer", c_char * MAX_SYM_NAME)]
+
+    def __init__(self):
+        super(SymbolInfoBuffer, self).__init__()
+        self.info.SizeOfStruct = ctypes.sizeof(SYMBOL_INFO)
+        self.info.MaxNameLen = MAX_SYM_NAME
+
+    @property
+    def name(self):
+        return ctypes.string_at(ctypes.addressof(self.info) + SYMBOL_INFO.Name.offset, self.info.NameLen)
+
+
 @windows.hooks.GetModuleFileNameWCallback
 def EmulateWinDBGName(hModule, lpFilename, nSize, real_function):
     if hModule is not None:
@@ -193,12 +225,32 @@ def require_upgraded_driver(f):
         return f
     @functools.wraps(f)
     def wrapper(self, *args, **kwargs):
+        # Upgrade deferred by fast_attach
+        self._run_deferred_phase("upgrade_driver")
         if not hasattr(self, 'upgrader') or not self.upgrader.is_upgraded:
             raise ValueError('Cannot call {0} without upgraded driver'.format(f.__name__))
         return f(self, *args, **kwargs)
     return wrapper
 
 
+# Hold the COM lock of the LKD during the whole call: used by the functions that
+# share buffers or caches with the warm-up thread (see start_warmup)
+def serialized(f):
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self.com_lock:
+            return f(self, *args, **kwargs)
+    return wrapper
+
+
+# Memoize the result of a type query in the type registry (cleared by reload)
+def type_cached(f):
+    @functools.wraps(f)
+    def wrapper(self, *args):
+        return self.type_registry.cached_query((f.__name__,) + args, lambda: f(self, *args))
+    return wrapper
+
+
 # experimental decorator
 # Just used to inform you that we are not sur if this code really works
 # and that we are currently working on it
@@ -212,25 +264,103 @@ class LocalKernelDebuggerBase(object):
     DEBUG_DLL_PATH = None
     DRIVER_FILENAME = None
     DRIVER_RESOURCE = None
+    PTR_SIZE = None
     # Will be used if '_NT_SYMBOL_PATH' is not set
     DEFAULT_SYMBOL_PATH  = "SRV*{0}\\symbols*http://msdl.microsoft.com/download/symbols".format(realpath(dirname(__file__)))
     SYMBOL_OPT = None
-
-    def __init__(self, quiet=True):
+    # Used with symbol_db=True
+    DEFAULT_SYMBOL_DB = os.path.join(realpath(dirname(__file__)), "symbols", "lkd_symbols.db")
+    DEFAULT_WARMUP_BUDGET = 2.0
+    # Number of times symbol_match grows its name buffer before giving up
+    SYMBOL_MATCH_MAX_RETRIES = 8
+    # Offsets of these nt fields are prefetched by the warm-up (the fields missing on a kernel are ignored)
+    WARMUP_FIELDS = [
+        ("_KPCR", ["Prcb", "PrcbData", "IdtBase", "IDT", "GdtBase", "GDT", "Self", "SelfPcr", "CurrentPrcb"]),
+        ("_KPRCB", ["CurrentThread", "NextThread", "IdleThread", "Number"]),
+        ("_EPROCESS", ["Pcb", "UniqueProcessId", "ActiveProcessLinks", "ImageFileName", "Peb", "Token", "ThreadListHead"]),
+        ("_ETHREAD", ["Tcb", "Cid", "ThreadListEntry", "StartAddress", "Win32StartAddress"]),
+    ]
+
+    def __init__(self, quiet=True, symbol_db=None, lazy_symbols=False, fast_attach=False, warmup_budget=None):
         self.quiet = quiet
+        # fast_attach implies lazy_symbols: modules symbols are the longest part of the attach
+        self.lazy_symbols = lazy_symbols = lazy_symbols or fast_attach
+        # Duration (in seconds) of each phase of the attach, in execution order
+        self.attach_timings = collections.OrderedDict()
+        self._deferred_phases = {}
+        # Serialize the COM calls and the caches between the main thread and the warm-up thread
+        self.com_lock = threading.RLock()
+        self.warmup_thread = None
+        # The unexpected exception that stopped the warm-up thread
+        self.warmup_error = None
+        self._processor_data_cache = {}
+        self._symbols_loaded_modules = set()
+        self.symbol_db = self._open_symbol_db(symbol_db)
+        # The single type cache: type queries, layouts and the types of the symbol database
+        self.type_registry = TypeRegistry(self, db=self.symbol_db)
+        self._module_identities = {}
+        self.memory_cache = None
+        self._write_batch = None
+        self.module_map = None
+        self.symbol_index = None
+        self.symbol_cache = dbgsymbols.SymbolCache(lambda: self.get_number_modules()[0], self._get_loaded_module_base)
+        # Reused by the COM symbol lookups instead of allocating new ctypes objects on each call
+        self._symbol_name_buffer = (c_char * 1024)()
+        self._symbol_name_size = ULONG()
+        self._symbol_displacement = ULONG64()
+        self._symbol_location = ctypes.c_uint64()
+        # Ask dbghelp directly before IDebugSymbols for the symbol lookups (see _dbghelp_get_symbol)
+        # Disabled until example/symbol_benchmark.py shows it is faster
+        self.dbghelp_symbols = False
         self._output_string = ""
         self._output_callback = None
-        self._load_debug_dll()
-        self.DebugClient = self._do_debug_create()
+        self._attach_phase("load_debug_dll", self._load_debug_dll)
+        self.DebugClient = self._attach_phase("debug_create", self._do_debug_create)
         self._do_kernel_attach()
-        self._ask_other_interface()
-        self._setup_symbols_options()
-        self.set_output_callbacks(self._standard_output_callback)
-        self._wait_local_kernel_connection()
-        self._load_modules_syms()
-        self.reload()
-        self._init_dbghelp_func()
-        self._upgrade_driver()
+        self._attach_phase("query_interfaces", self._ask_other_interface)
+        self._attach_phase("symbols_options", self._setup_symbols_options)
+        self._attach_phase("output_callbacks", self.set_output_callbacks, self._standard_output_callback)
+        self._attach_phase("wait_connection", self._wait_local_kernel_connection)
+        if not lazy_symbols:
+            self._attach_phase("load_modules_syms", self._load_modules_syms)
+        # With fast_attach these phases are done on first use of the symbols / dbghelp / upgraded driver
+        self._attach_phase("reload", self.reload, deferred=fast_attach)
+        self._attach_phase("init_dbghelp", self._init_dbghelp_func, deferred=fast_attach)
+        self._attach_phase("upgrade_driver", self._upgrade_driver, deferred=fast_attach)
+        if warmup_budget is not None:
+            self.start_warmup(warmup_budget)
+
+    def _attach_phase(self, name, function, *args, **kwargs):
+        """Call **function** and record its duration in :data:`attach_timings` (or store it for later if **deferred**)"""
+        if kwargs.get("deferred", False):
+            self._deferred_phases[name] = (function, args)
+            return None
+        start = time.time()
+        res = function(*args)
+        self.attach_timings[name] = time.time() - start
+        return res
+
+    def _run_deferred_phase(self, name):
+        """Run the attach phase **name** if it was deferred by fast_attach"""
+        phase = self._deferred_phases.pop(name, None)
+        if phase is not None:
+            function, args = phase
+            self._attach_phase(name, function, *args)
+
+    # The deferred reload is done on the first use of the symbols
+    @property
+    def DebugSymbols(self):
+        if self._deferred_phases:
+            self._run_deferred_phase("reload")
+        return self._DebugSymbols
+
+    @DebugSymbols.setter
+    def DebugSymbols(self, value):
+        self._DebugSymbols = value
+
+    @DebugSymbols.deleter
+    def DebugSymbols(self):
+        del self._DebugSymbols
 
     def _setup_driver_resource(self, dbgengmod, k32import):
         raise NotImplementedError("_setup_driver_resource")
@@ -246,8 +376,8 @@ class LocalKernelDebuggerBase(object):
         self._setup_name_imposture(dbgengmod, k32import)
 
     def _do_kernel_attach(self):
-        self._setup_windbg_imposture()
-        res = self.DebugClient.AttachKernel(DEBUG_ATTACH_LOCAL_KERNEL, None)
+        self._attach_phase("windbg_imposture", self._setup_windbg_imposture)
+        res = self._attach_phase("attach_kernel", self.DebugClient.AttachKernel, DEBUG_ATTACH_LOCAL_KERNEL, None)
         if res:
             raise WinError(res)
 
@@ -273,6 +403,8 @@ class LocalKernelDebuggerBase(object):
         DebugClient.QueryInterface(IID_IDebugDataSpaces2, ctypes.byref(self.DebugDataSpaces))
         DebugClient.QueryInterface(IID_IDebugSymbols3, ctypes.byref(self.DebugSymbols))
         DebugClient.QueryInterface(IID_IDebugControl, ctypes.byref(self.DebugControl))
+        for interface in (DebugClient, self.DebugDataSpaces, self._DebugSymbols, self.DebugControl):
+            interface._lock_ = self.com_lock
 
     def _wait_local_kernel_connection(self):
         self.DebugControl.WaitForEvent(0, 0xffffffff)
@@ -297,6 +429,15 @@ class LocalKernelDebuggerBase(object):
         self.DebugSymbols.GetNumberModules(byref(numModulesLoaded), byref(numModulesUnloaded))
         return (numModulesLoaded.value, numModulesUnloaded.value)
 
+    def _get_loaded_module_base(self, name):
+        # Base of the loaded module **name** (None if there is none): checked by the symbol cache
+        base = ULONG64(0)
+        try:
+            self.DebugSymbols.GetModuleByModuleName(name, 0, None, byref(base))
+        except WindowsError:
+            return None
+        return base.value
+
     def get_module_by_index(self, i):
         """Get the base of module number **i**"""
         currModuleBase = ULONG64(0)
@@ -320,6 +461,85 @@ class LocalKernelDebuggerBase(object):
                                          1023, byref(currLoadedImageNameSize))
         return (currImageName.value, currModuleName.value, currLoadedImageName.value)
 
+    def get_modules_parameters(self):
+        """Get the :class:`DEBUG_MODULE_PARAMETERS` of every loaded module in one call"""
+        nb_loaded, nb_unloaded = self.get_number_modules()
+        params = (DEBUG_MODULE_PARAMETERS * nb_loaded)()
+        if nb_loaded:
+            self.DebugSymbols.GetModuleParameters(nb_loaded, None, 0, byref(params))
+        return params
+
+    @serialized
+    def get_module_map(self):
+        """| Get the :class:`dbgsymbols.ModuleMap` of the loaded modules
+           | The map is built on first use and dropped by :func:`reload`
+        """
+        if self.module_map is None:
+            currModuleName = (c_char * 1024)()
+            currImageName = (c_char * 1024)()
+            currLoadedImageName = (c_char * 1024)()
+            size = DWORD(0)
+            modules = []
+            for i, params in enumerate(self.get_modules_parameters()):
+                if params.Base == DEBUG_INVALID_OFFSET:
+                    continue
+                self.DebugSymbols.GetModuleNames(i, c_uint64(params.Base), byref(currImageName), 1023, byref(size),
+                                                 byref(currModuleName), 1023, byref(size), byref(currLoadedImageName),
+                                                 1023, byref(size))
+                base = self.trim_ulong64_to_address(params.Base)
+                modules.append((base, base + params.Size, currModuleName.value, currImageName.value, currLoadedImageName.value))
+            self.module_map = dbgsymbols.ModuleMap(modules)
+        return self.module_map
+
+    def module_for_address(self, addr):
+        """Get the :class:`dbgsymbols.ModuleEntry` (base, end, name, image name, loaded image name)
+           of the module containing **addr** or None"""
+        return self.get_module_map().find(self.resolve_symbol(addr))
+
+    def modules_for_addresses(self, addresses):
+        """Same as :func:`module_for_address` for each address of **addresses** (list or :class:`numpy.ndarray`)"""
+        return self.get_module_map().find_many(addresses)
+
+    def _open_symbol_db(self, path):
+        if path is None:
+            path = os.environ.get('LKD_SYMBOL_DB')
+        elif path is True:
+            path = self.DEFAULT_SYMBOL_DB
+        if not path:
+            return None
+        return dbgsymbols.SymbolDatabase.open(path)
+
+    @serialized
+    def get_module_identity(self, module):
+        """| Get the identity of a loaded module, used as key by the :data:`symbol_db`
+           | (PDB GUID/age are not available through the dbgeng interfaces used by LKD)
+
+           :param module: The Symbol of the module
+           :type module: Symbol
+           :rtype: str, int, int -- module name, TimeDateStamp, SizeOfImage
+        """
+        base = self.resolve_symbol(module)
+        if base not in self._module_identities:
+            ulong_base = ULONG64(self.expand_address_to_ulong64(base))
+            params = DEBUG_MODULE_PARAMETERS()
+            self.DebugSymbols.GetModuleParameters(1, byref(ulong_base), 0, byref(params))
+            module_name = (c_char * 1024)()
+            module_name_size = DWORD(0)
+            self.DebugSymbols.GetModuleNames(DEBUG_ANY_ID, ulong_base, None, 0, None, byref(module_name), 1023,
+                                             byref(module_name_size), None, 0, None)
+            self._module_identities[base] = (module_name.value, params.TimeDateStamp, params.Size)
+        return self._module_identities[base]
+
+    def _load_module_syms(self, module):
+        """In lazy symbols mode: reload the symbols of **module** the first time it is used"""
+        if not self.lazy_symbols or module.lower() in self._symbols_loaded_modules:
+            return
+        self._symbols_loaded_modules.add(module.lower())
+        try:
+            self.DebugSymbols.Reload(module)
+        except WindowsError:
+            pass
+
     def _load_modules_syms(self):
         currModuleName = (c_char * 1024)()
         currImageName = (c_char * 1024)()
@@ -349,6 +569,13 @@ class LocalKernelDebuggerBase(object):
         SymGetTypeInfoPrototype = WINFUNCTYPE(BOOL, HANDLE, DWORD64, ULONG, IMAGEHLP_SYMBOL_TYPE_INFO, PVOID)
         SymGetTypeInfoParams = ((1, 'hProcess'), (1, 'ModBase'), (1, 'TypeId'), (1, 'GetType'), (1, 'pInfo'))
         self.SymGetTypeInfo_ctypes = SymGetTypeInfoPrototype(("SymGetTypeInfo", dbghelp), SymGetTypeInfoParams)
+        SymFromAddrPrototype = WINFUNCTYPE(BOOL, HANDLE, DWORD64, POINTER(DWORD64), PSYMBOL_INFO)
+        SymFromAddrParams = ((1, 'hProcess'), (1, 'Address'), (1, 'Displacement'), (1, 'Symbol'))
+        self.SymFromAddr_ctypes = SymFromAddrPrototype(("SymFromAddr", dbghelp), SymFromAddrParams)
+        self.SymFromName_ctypes = SymFromNamePrototype(("SymFromName", dbghelp), SymFromNameParams)
+        # Reused by all the SymFrom* calls
+        self._symbol_info = SymbolInfoBuffer()
+        self._symbol_info_displacement = DWORD64()
 
     # Internal helper
     def resolve_symbol(self, symbol):
@@ -427,33 +654,70 @@ class LocalKernelDebuggerBase(object):
         return res
 
     def get_modules(self):
-        """Return a list of (currModuleName, currImageName, currLoadedImageName)"""
-        self.reload("")
-        currModuleName = (c_char * 1024)()
-        currImageName = (c_char * 1024)()
-        currLoadedImageName = (c_char * 1024)()
-        currModuleNameSize = DWORD(0)
-        currImageNameSize = DWORD(0)
-        currLoadedImageNameSize = DWORD(0)
-        currModuleBase = ULONG64(0)
-        numModulesLoaded = DWORD(0)
-        numModulesUnloaded = DWORD(0)
-
-        self.DebugSymbols.GetNumberModules(byref(numModulesLoaded), byref(numModulesUnloaded))
-        res = []
-        for i in range(numModulesLoaded.value):
-            self.DebugSymbols.GetModuleByIndex(i, byref(currModuleBase))
-            self.DebugSymbols.GetModuleNames(i, c_uint64(currModuleBase.value), byref(currImageName), 1023, byref(currImageNameSize),
-                                             byref(currModuleName), 1023, byref(currModuleNameSize), byref(currLoadedImageName),
-                                             1023, byref(currLoadedImageNameSize))
-            # Removing trailing \x00
-            res.append((currModuleName[:currModuleNameSize.value - 1], currImageName[:currImageNameSize.value - 1], currLoadedImageName[:currLoadedImageNameSize.value - 1]))
-        return res
+        """| Return a list of (currModuleName, currImageName, currLoadedImageName) sorted by base address
+           | The list is the one of :func:`get_module_map`: call :func:`reload` to see newly loaded modules
+        """
+        return [(module.name, module.image_name, module.loaded_image_name) for module in self.get_module_map()]
 
+    @serialized
     def reload(self, module_to_reload=""):
         """Reload a module or all modules if **module_to_reload** is not specified"""
+        self.module_map = None
+        self.symbol_index = None
+        self.symbol_cache.clear()
+        self.type_registry.clear()
+        self._module_identities = {}
+        if module_to_reload:
+            self._symbols_loaded_modules.add(module_to_reload.lower())
+        else:
+            self._symbols_loaded_modules.clear()
         return self.DebugSymbols.Reload(module_to_reload)
 
+    def start_warmup(self, budget=DEFAULT_WARMUP_BUDGET):
+        """| Start a background thread that fills the caches with data most scripts need:
+           | the KPCR / KPRCB of each processor, the offsets of the :data:`WARMUP_FIELDS` and the exports of nt.
+           | The thread stops after **budget** seconds, it holds :data:`com_lock` for each query
+           | so it never races the main thread.
+
+           :returns: the warm-up :class:`threading.Thread`
+        """
+        thread = threading.Thread(target=self._warmup, args=(budget,), name="LKD warm-up")
+        thread.daemon = True
+        self.warmup_thread = thread
+        thread.start()
+        return thread
+
+    def _warmup(self, budget):
+        deadline = time.time() + budget
+        try:
+            for task in self._warmup_tasks():
+                if time.time() >= deadline:
+                    return
+                with self.com_lock:
+                    try:
+                        task()
+                    except (WindowsError, ValueError):
+                        pass  # Unknown field or symbol on this kernel
+        except Exception as e:
+            # The warm-up only fills caches: report the error without disturbing the session
+            self.warmup_error = e
+            traceback.print_exc()
+
+    def _warmup_tasks(self):
+        # number_processor may use the memory cache: read_virtual_memory holds the COM lock
+        for processor in range(self.number_processor()):
+            yield functools.partial(self.read_processor_system_data, processor, DEBUG_DATA_KPCR_OFFSET)
+            yield functools.partial(self.read_processor_system_data, processor, DEBUG_DATA_KPRCB_OFFSET)
+        for type_name, fields in self.WARMUP_FIELDS:
+            yield functools.partial(self.get_type_size, "nt", type_name)
+            for field in fields:
+                yield functools.partial(self.get_field_offset, "nt", type_name, field)
+        yield self._warmup_nt_exports
+
+    def _warmup_nt_exports(self):
+        for name, addr in dbgsymbols.parse_exports(self._raw_read_virtual_memory, self.resolve_symbol("nt")):
+            self.symbol_cache.add("nt!" + name, addr)
+
     def detach(self):
         """End the Debugging session and detach the COM interface"""
         self.DebugClient.EndSession(DEBUG_END_PASSIVE)
@@ -494,8 +758,10 @@ class LocalKernelDebuggerBase(object):
     @experimental
     def get_type(self, module, typeid):
         module, typeid = self.resolve_type(module, typeid)
-        return DbgEngType(module, typeid, self)
+        return self.type_registry.get_type(module, typeid)
 
+    @type_cached
+    @serialized
     def get_type_id(self, module, type_name):
         """Get the typeid of a type
 
@@ -505,6 +771,8 @@ class LocalKernelDebuggerBase(object):
         :type type_name: str
         :rtype: int"""
         module = self.resolve_symbol(module)
+        if self.lazy_symbols:
+            self._load_module_syms(self.get_module_identity(module)[0])
         res = ULONG(0)
 
         self.DebugSymbols.GetTypeId(self.expand_address_to_ulong64(module), type_name, byref(res))
@@ -516,22 +784,30 @@ class LocalKernelDebuggerBase(object):
         :param symtype: the name of the type
         :type symtype: str
         :rtype: int, int -- module ID, type ID"""
+        if "!" in symtype:
+            self._load_module_syms(symtype.split("!", 1)[0])
         typeid = ULONG(0)
         module = ULONG64(0)
 
         self.DebugSymbols.GetSymbolTypeId(symtype, byref(typeid), byref(module))
         return (module.value, typeid.value)
 
+    @serialized
     def get_field_offset(self, module, typeid, field):
         """Get the offset of a field in a type
 
         :rtype: int"""
+        return self.type_registry.stored_query(module, typeid, field,
+                                               lambda: self._get_field_offset(module, typeid, field))
+
+    def _get_field_offset(self, module, typeid, field):
         module, typeid = self.resolve_type(module, typeid)
         res = ULONG(0)
 
         self.DebugSymbols.GetFieldOffset(module, typeid, field, byref(res))
         return res.value
 
+    @type_cached
     def get_type_name(self, module, typeid):
         """Get the name of a type
 
@@ -547,10 +823,14 @@ class LocalKernelDebuggerBase(object):
             res = res[:-1]
         return res
 
+    @serialized
     def get_type_size(self, module, typeid):
         """Get the size of a type
 
         :rtype: int"""
+        return self.type_registry.stored_query(module, typeid, None, lambda: self._get_type_size(module, typeid))
+
+    def _get_type_size(self, module, typeid):
         module, typeid = self.resolve_type(module, typeid)
         res = ULONG(0)
 
@@ -680,7 +960,13 @@ class LocalKernelDebuggerBase(object):
 
     # Low level DbgHelp queries
     @experimental
-    def SymGetTypeInfo(self, module, typeid, GetType, ires=None):
+    @serialized
+    def SymGetTypeInfo(self, module, typeid, GetType, ires=None, check=False):
+        """| Raw dbghelp SymGetTypeInfo
+           | If **check** is True raise :class:`WindowsError` if the information is not available for **typeid**
+           | (else the result is 0)
+        """
+        self._run_deferred_phase("init_dbghelp")
         # If not: result is a DWORD
         res = ires
         if res is None:
@@ -694,7 +980,8 @@ class LocalKernelDebuggerBase(object):
             res = result_type.get(GetType, DWORD)()
 
         module, typeid = self.resolve_type(module, typeid)
-        self.SymGetTypeInfo_ctypes(0xf0f0f0f0, module, typeid, GetType, byref(res))
+        if not self.SymGetTypeInfo_ctypes(0xf0f0f0f0, module, typeid, GetType, byref(res)) and check:
+            raise WinError()
         if ires is None:
             return res.value
         return res
@@ -705,6 +992,7 @@ class LocalKernelDebuggerBase(object):
         return self.SymGetTypeInfo(module, typeid, TI_GET_CHILDRENCOUNT)
 
     @experimental
+    @serialized
     def get_childs_types(self, module, typeid):
         nb_childs = self.get_number_chid(module, typeid)
 
@@ -731,36 +1019,149 @@ class LocalKernelDebuggerBase(object):
            """
         raise NotImplementedError("bitness dependent")
 
+    @serialized
     def get_symbol_offset(self, name):
         """Get the address of a symbol
 
         :param name: Name of the symbol
         :type name: str
-        :rtype: int"""
-        SymbolLocation = ctypes.c_uint64(0)
+        :rtype: int
+
+        The results (including unknown symbols) are cached in :data:`symbol_cache` until the next :func:`reload`"""
+        found, addr = self.symbol_cache.lookup(name)
+        if found:
+            return addr
+        module, symbol = name.split("!", 1) if "!" in name else (None, None)
+        if self.symbol_db is not None and module:
+            base = self.get_symbol_offset(module)
+            if base is not None:
+                rva = self.symbol_db.get_symbol_rva(self.get_module_identity(base), symbol)
+                if rva is not None:
+                    self.symbol_cache.add(name, base + rva)
+                    return base + rva
+        if module:
+            self._load_module_syms(module)
+        addr = self._engine_get_symbol_offset(name)
+        if addr is not None and self.symbol_db is not None and module and base is not None:
+            self.symbol_db.add_symbols(self.get_module_identity(base), [(symbol, addr - base)])
+        self.symbol_cache.add(name, addr)
+        return addr
+
+    def _engine_get_symbol_offset(self, name):
+        if self.dbghelp_symbols:
+            addr = self._dbghelp_get_symbol_offset(name)
+            if addr is not None:
+                return addr
+        return self._com_get_symbol_offset(name)
+
+    def _com_get_symbol_offset(self, name):
         try:
-            self.DebugSymbols.GetOffsetByName(name, ctypes.byref(SymbolLocation))
+            self.DebugSymbols.GetOffsetByName(name, byref(self._symbol_location))
         except WindowsError:
             return None
-        return self.trim_ulong64_to_address(SymbolLocation.value)
+        return self.trim_ulong64_to_address(self._symbol_location.value)
 
+    def _dbghelp_get_symbol_offset(self, name):
+        self._run_deferred_phase("init_dbghelp")
+        info = self._symbol_info
+        if not self.SymFromName_ctypes(0xf0f0f0f0, name, byref(info.info)):
+            return None
+        return self.trim_ulong64_to_address(info.info.Address)
+
+    def resolve_symbols(self, names):
+        """| Get the address of each symbol of **names** (see :func:`get_symbol_offset`)
+           | Each name is resolved once, :class:`int` are returned unchanged
+
+        :param names: The symbols to resolve
+        :type names: list of str
+        :rtype: list of int -- None for unknown symbols"""
+        resolved = {}
+        for name in names:
+            if name not in resolved:
+                resolved[name] = name if isinstance(name, (int, long)) else self.get_symbol_offset(name)
+        return [resolved[name] for name in names]
+
+    def get_symbol_index(self):
+        """| Get the :class:`dbgsymbols.SymbolIndex` used by :func:`get_symbol` and :func:`get_symbols`
+           | The index is built on first use and dropped by :func:`reload`,
+           | the symbols of a module are enumerated the first time an address falls into it.
+        """
+        if self.symbol_index is None:
+            self.symbol_index = dbgsymbols.SymbolIndex(self.get_module_map(), self._enum_module_symbols)
+        return self.symbol_index
+
+    def _enum_module_symbols(self, module):
+        if self.symbol_db is not None:
+            base = self.get_symbol_offset(module)
+            key = self.get_module_identity(base)
+            if self.symbol_db.is_complete(key):
+                return [(module + "!" + name, base + rva) for name, rva in self.symbol_db.get_symbols(key)]
+        try:
+            symbols = list(self.symbol_match(module + "!*"))
+        except WindowsError:
+            return []
+        if self.symbol_db is not None:
+            self.symbol_db.add_symbols(key, [(name.split("!", 1)[1], addr - base) for name, addr in symbols], complete=True)
+        return symbols
+
+    @serialized
     def get_symbol(self, addr):
         """Get the symbol and displacement of an address
 
         :param addr: The address to lookup
         :type addr: int
         :rtype: str, int -- symbol name, displacement"""
+        res = self.get_symbol_index().lookup(self.trim_ulong64_to_address(self.expand_address_to_ulong64(addr)))
+        if res[0] is None:
+            # Not in a module known by the index: let dbghelp/dbgeng try
+            return self._engine_get_symbol(addr)
+        return res
+
+    @serialized
+    def get_symbols(self, addresses):
+        """Get the symbol and displacement of each address of **addresses** (see :func:`get_symbol`)
+
+        :param addresses: The addresses to lookup
+        :type addresses: list of int or :class:`numpy.ndarray`
+        :rtype: list of (str, int) -- symbol name, displacement"""
+        addresses = [self.trim_ulong64_to_address(self.expand_address_to_ulong64(addr)) for addr in addresses]
+        unique = sorted(set(addresses))
+        resolved = dict(zip(unique, self.get_symbol_index().lookup_many(unique)))
+        for addr, sym in resolved.items():
+            if sym[0] is None:
+                resolved[addr] = self._engine_get_symbol(addr)
+        return [resolved[addr] for addr in addresses]
+
+    def _engine_get_symbol(self, addr):
+        if self.dbghelp_symbols:
+            res = self._dbghelp_get_symbol(addr)
+            if res is not None:
+                return res
+        return self._com_get_symbol(addr)
+
+    def _dbghelp_get_symbol(self, addr):
+        """SymFromAddr on the dbghelp session of dbgeng: same result as :func:`_com_get_symbol` or None"""
+        self._run_deferred_phase("init_dbghelp")
+        info = self._symbol_info
+        if not self.SymFromAddr_ctypes(0xf0f0f0f0, self.expand_address_to_ulong64(addr),
+                                       byref(self._symbol_info_displacement), byref(info.info)):
+            return None
+        # dbghelp only gives the name of the symbol: find the module to get "module!symbol"
+        module = self.get_module_map().find(self.trim_ulong64_to_address(info.info.ModBase))
+        if module is None:
+            return None
+        return (module.name + "!" + info.name, self._symbol_info_displacement.value)
+
+    def _com_get_symbol(self, addr):
         addr = self.expand_address_to_ulong64(addr)
-        buffer_size = 1024
-        buffer = (c_char * buffer_size)()
-        name_size = ULONG()
-        displacement = ULONG64()
+        buffer = self._symbol_name_buffer
         try:
-            self.DebugSymbols.GetNameByOffset(addr, byref(buffer), buffer_size, byref(name_size), byref(displacement))
+            self.DebugSymbols.GetNameByOffset(addr, byref(buffer), len(buffer), byref(self._symbol_name_size),
+                                              byref(self._symbol_displacement))
         except WindowsError as e:
             if (e.winerror & 0xffffffff) == E_FAIL:
                 return (None, None)
-        return (buffer.value, displacement.value)
+        return (buffer.value, self._symbol_displacement.value)
 
     def symbol_match(self, symbol_pattern):
         """| <generator>
@@ -771,25 +1172,64 @@ class LocalKernelDebuggerBase(object):
            :yield: str, int -- symbol name, symbol address
         """
         search_handle = ULONG64()
-        buffer_size = 1024
-        buffer = (c_char * buffer_size)()
+        buffer = (c_char * 1024)()
         match_size = ULONG()
         symbol_addr = ULONG64()
+        nb_yielded = 0
+        to_skip = 0
+        nb_retries = 0
 
+        module = symbol_pattern.split("!", 1)[0] if "!" in symbol_pattern else ""
+        if module and not any(c in module for c in "*?[]"):
+            self._load_module_syms(module)
         self.DebugSymbols.StartSymbolMatch(symbol_pattern, byref(search_handle))
-        while True:
-            try:
-                self.DebugSymbols.GetNextSymbolMatch(search_handle, byref(buffer), buffer_size, byref(match_size), byref(symbol_addr))
-            except WindowsError as e:
-                if (e.winerror & 0xffffffff) == S_FALSE:
-                    buffer_size = buffer_size
-                    buffer = (c_char * buffer_size)()
-                    continue
-                if (e.winerror & 0xffffffff) == E_NOINTERFACE:
+        try:
+            while True:
+                try:
+                    res = self.DebugSymbols.GetNextSymbolMatch(search_handle, byref(buffer), len(buffer), byref(match_size), byref(symbol_addr))
+                except WindowsError as e:
+                    if (e.winerror & 0xffffffff) == E_NOINTERFACE:
+                        return
+                    raise
+                if res == S_FALSE or match_size.value > len(buffer):
+                    # Name truncated: restart the match with a buffer big enough and skip the symbols already yielded
+                    nb_retries += 1
+                    if nb_retries > self.SYMBOL_MATCH_MAX_RETRIES:
+                        raise ValueError("Symbol name too long in the match of <{0}>".format(symbol_pattern))
+                    # The size may not be reported with S_FALSE: at least double the buffer
+                    buffer = (c_char * max(match_size.value, 2 * len(buffer)))()
                     self.DebugSymbols.EndSymbolMatch(search_handle)
-                    return
-            yield (buffer.value, self.trim_ulong64_to_address(symbol_addr.value))
+                    self.DebugSymbols.StartSymbolMatch(symbol_pattern, byref(search_handle))
+                    to_skip = nb_yielded
+                    continue
+                if to_skip:
+                    to_skip -= 1
+                    continue
+                nb_yielded += 1
+                yield (buffer.value, self.trim_ulong64_to_address(symbol_addr.value))
+        finally:
+            self.DebugSymbols.EndSymbolMatch(search_handle)
+
+    def find_symbols(self, symbol_pattern):
+        """| List of symbol (name, address) that match a symbol pattern (see :func:`symbol_match`)
+           | The query is answered from the symbol index (see :func:`get_symbol_index`):
+           | the symbols of a module are only enumerated through COM the first time it is queried
 
+           :param symbol_pattern: The symbol pattern (nt!Ke*, *!CreateFile, ..) case insensitive
+           :type symbol_pattern: str
+           :rtype: list of (str, int) -- symbol name, symbol address
+        """
+        return self.get_symbol_index().find_symbols(symbol_pattern, "find_glob")
+
+    def find_symbols_by_prefix(self, prefix):
+        """Same as :func:`find_symbols` for the symbols starting with a prefix ("nt!KeBugCheck")"""
+        return self.get_symbol_index().find_symbols(prefix, "find_prefix")
+
+    def find_symbols_containing(self, substring):
+        """Same as :func:`find_symbols` for the symbols containing a string ("nt!Timer")"""
+        return self.get_symbol_index().find_symbols(substring, "find_substring")
+
+    @serialized
     def read_virtual_memory(self, addr, size):
         """Read the memory at a given virtual address
 
@@ -800,12 +1240,35 @@ class LocalKernelDebuggerBase(object):
            :returns: str
         """
         addr = self.resolve_symbol(addr)
-        buffer = (c_char * size)()
-        read = DWORD(0)
+        if self.memory_cache is not None:
+            data = self.memory_cache.read(addr, size)
+            if data is not None:
+                return data
+        return self._raw_read_virtual_memory(addr, size)
 
-        self.DebugDataSpaces.ReadVirtual(c_uint64(addr), buffer, size, byref(read))
-        return buffer[0:read.value]
+    def _raw_read_virtual_memory(self, addr, size):
+        buffer = ctypes.create_string_buffer(size)
+        read = dbgmemory.readinto(self.DebugDataSpaces.ReadVirtual, addr, buffer)
+        return buffer.raw[:read]
+
+    @serialized
+    def readinto_virtual(self, addr, buffer):
+        """Fill a writable buffer with the memory at a given virtual address
+
+           :param addr: The Symbol to read from
+           :type addr: Symbol
+           :param buffer: The buffer to fill
+           :type buffer: bytearray, memoryview, array.array or ctypes object
+           :returns: the size read -- :class:`int`
+        """
+        addr = self.resolve_symbol(addr)
+        if self.memory_cache is not None:
+            data = self.memory_cache.read(addr, dbgmemory.buffer_size(buffer))
+            if data is not None:
+                return dbgmemory.copy_into(buffer, data)
+        return dbgmemory.readinto(self.DebugDataSpaces.ReadVirtual, addr, buffer)
 
+    @serialized
     def write_virtual_memory(self, addr, data):
         """Write data to a given virtual address
 
@@ -825,14 +1288,68 @@ class LocalKernelDebuggerBase(object):
             buffer = data
         written = ULONG(0)
         addr = self.resolve_symbol(addr)
+        if self._write_batch is not None:
+            return self._write_batch.stage("virtual", addr, data)
+        if self.memory_cache is not None:
+            self.memory_cache.invalidate(addr, size)
         self.DebugDataSpaces.WriteVirtual(c_uint64(addr), buffer, size, byref(written))
         return written.value
 
+    @serialized
     def write_pfv_memory(self, addr, data):
         """Write physical memory from virtual address
            Exactly the same as write_physical(virtual_to_physical(addr), data)
         """
-        return self.write_physical_memory(self.virtual_to_physical(addr), data)
+        addr = self.resolve_symbol(addr)
+        if self._write_batch is not None:
+            return self._write_batch.stage("pfv", addr, data)
+        written = self._raw_write_physical_memory(self.virtual_to_physical(addr), data)
+        if self.memory_cache is not None:
+            self.memory_cache.invalidate(addr, written)
+        return written
+
+    @contextlib.contextmanager
+    def write_batch(self):
+        """| Context manager that stages every write done through LKD (write_* helpers,
+           | :func:`write_virtual_memory`, :func:`write_physical_memory`, :func:`write_pfv_memory`)
+           | and flushes them in address order on exit, merging the contiguous ones.
+           | The virtual to physical translations of :func:`write_pfv_memory` are done once per page.
+           | Reads in the batch do not see the staged writes, the writes are dropped on exception.
+           | The virtual writes are flushed before the physical ones.
+
+           >>> with kdbg.write_batch():
+           ...     kdbg.write_dword(addr, 0x11223344)
+           ...     kdbg.write_dword(addr + 4, 0x55667788)  # Only one WriteVirtual
+        """
+        if self._write_batch is not None:
+            # Nested batch: everything is flushed by the outer one
+            yield self._write_batch
+            return
+        batch = self._write_batch = dbgmemory.WriteBatch()
+        try:
+            yield batch
+        finally:
+            self._write_batch = None
+        self._flush_write_batch(batch)
+
+    def _flush_write_batch(self, batch):
+        for addr, data in dbgmemory.merge_writes(batch.get_writes("virtual")):
+            self.write_virtual_memory(addr, data)
+        translations = {}
+        physical_writes = []
+        for space, addr, data in batch.writes:
+            if space == "physical":
+                physical_writes.append((addr, data))
+            elif space == "pfv":
+                for page_addr, page_data in dbgmemory.split_by_page(addr, data):
+                    page = page_addr & dbgmemory.PAGE_MASK
+                    if page not in translations:
+                        translations[page] = self.virtual_to_physical(page)
+                    physical_writes.append((translations[page] + (page_addr - page), page_data))
+        for addr, data in dbgmemory.merge_writes(physical_writes):
+            self._raw_write_physical_memory(addr, data)
+        if physical_writes:
+            self.flush_memory_cache()
 
     def read_virtual_memory_into(self, addr, struct):
         """"Read the memory at a given virtual address into a ctypes Structure
@@ -843,12 +1360,260 @@ class LocalKernelDebuggerBase(object):
            :type size: ctypes.Structure
            :returns: the size read -- :class:`int`
         """
-        addr = self.resolve_symbol(addr)
-        size = ctypes.sizeof(struct)
-        read = ULONG(0)
+        return self.readinto_virtual(addr, struct)
+
+    def read_array(self, addr, typecode, count, physical=False):
+        """| Read **count** unsigned integers in one transfer.
+           | The result is a :class:`numpy.ndarray` if NumPy is installed else an :class:`array.array`
+           | (see :func:`dbgmemory.new_array`)
+
+           :param addr: The Symbol to read from (physical address if **physical**)
+           :type addr: Symbol
+           :param typecode: "B", "H", "I", "Q" or "P" for pointers
+           :type typecode: str
+           :param count: number of elements to read
+           :type count: int
+        """
+        if typecode == "P":
+            typecode = {4: "I", 8: "Q"}[self.PTR_SIZE]
+        res = dbgmemory.new_array(typecode, count)
+        if physical:
+            read = self.readinto_physical(addr, res)
+        else:
+            read = self.readinto_virtual(addr, res)
+        nb_elt = read // dbgmemory.ARRAY_ITEM_SIZE[typecode]
+        if nb_elt != count:
+            return res[:nb_elt]
+        return res
+
+    def read_many(self, ranges, physical=False, max_gap=0):
+        """| Read multiple (addr, size) **ranges** with as few COM calls as possible.
+           | Adjacent and overlapping ranges (or separated by at most **max_gap** bytes)
+           | are merged in one read, the ranges a merged read does not cover are read on their own.
+
+           :param ranges: the (Symbol, size) to read (physical addresses if **physical**)
+           :type ranges: list of (Symbol, int)
+           :returns: one :class:`str` per range, in the order of **ranges**
+        """
+        if physical:
+            read = self.read_physical_memory
+        else:
+            ranges = [(self.resolve_symbol(addr), size) for addr, size in ranges]
+            read = self.read_virtual_memory
+        return dbgmemory.read_ranges(read, ranges, max_gap)
+
+    def iter_read(self, addr, length, chunk=dbgmemory.DEFAULT_CHUNK_SIZE, physical=False):
+        """| <generator>
+           | Read **length** bytes by chunks of **chunk** bytes into a reusable buffer.
+           | Unreadable pages do not stop the read: they are reported as :class:`dbgmemory.MemoryHole`.
+           | The yielded memoryview are only valid until the next iteration.
+
+           :param addr: The Symbol to read from (physical address if **physical**)
+           :type addr: Symbol
+           :yield: int, memoryview or :class:`dbgmemory.MemoryHole` -- offset from **addr**, data
+        """
+        if physical:
+            readinto = self.readinto_physical
+        else:
+            addr = self.resolve_symbol(addr)
+            readinto = self.readinto_virtual
+        return dbgmemory.iter_chunks(readinto, addr, length, chunk)
+
+    def search(self, start, end, pattern, mask=None, chunk=dbgmemory.DEFAULT_CHUNK_SIZE, physical=False, overlap=None):
+        """| <generator>
+           | Search **pattern** in [**start**, **end**) by reading it in chunks of **chunk** bytes.
+           | Unreadable pages are skipped.
+
+           :param pattern: the bytes to search or a compiled regex
+           :type pattern: str or regex
+           :param mask: bits of **pattern** to compare (0xff: exact byte, 0x00: any byte)
+           :type mask: str
+           :param overlap: maximum length of a match, required for a regex
+           :type overlap: int
+           :yield: int -- address of each match
+        """
+        if not physical:
+            start = self.resolve_symbol(start)
+            end = self.resolve_symbol(end)
+        chunks = self.iter_read(start, end - start, chunk, physical)
+        for offset in dbgmemory.search_chunks(chunks, pattern, mask, overlap):
+            yield start + offset
+
+    def get_module_sections(self, module):
+        """Get the sections of a loaded module from its PE header in memory
+
+           :param module: The Symbol of the module
+           :type module: Symbol
+           :rtype: list of (str, int, int) -- name, address, size
+        """
+        base = self.resolve_symbol(module)
+        nt_headers = base + self.read_dword(base + 0x3c)
+        nb_sections = self.read_word(nt_headers + 6)
+        size_of_optional_header = self.read_word(nt_headers + 0x14)
+        # sizeof(IMAGE_SECTION_HEADER) == 40
+        headers = self.read_virtual_memory(nt_headers + 0x18 + size_of_optional_header, nb_sections * 40)
+        res = []
+        for i in range(nb_sections):
+            name, virtual_size, virtual_address = struct.unpack_from("<8sII", headers, i * 40)
+            res.append((name.rstrip("\x00"), base + virtual_address, virtual_size))
+        return res
+
+    def get_module_size(self, module):
+        """Get the SizeOfImage of a loaded module from its PE header in memory"""
+        base = self.resolve_symbol(module)
+        nt_headers = base + self.read_dword(base + 0x3c)
+        # OptionalHeader.SizeOfImage is at the same offset in PE32 and PE32+
+        return self.read_dword(nt_headers + 0x18 + 0x38)
+
+    def get_module_exports(self, module):
+        """Get the named exports of a loaded module from its PE export directory in memory
+
+           :param module: The Symbol of the module
+           :type module: Symbol
+           :rtype: list of (str, int) -- name, address
+        """
+        return dbgsymbols.parse_exports(self.read_virtual_memory, self.resolve_symbol(module))
+
+    def search_module(self, module, pattern, mask=None, sections=None, overlap=None):
+        """| <generator>
+           | Search **pattern** in a loaded module (see :func:`search`)
+
+           :param sections: only search in these sections ([".text"])
+           :type sections: list of str
+           :yield: int -- address of each match
+        """
+        if sections is None:
+            ranges = [(self.resolve_symbol(module), self.get_module_size(module))]
+        else:
+            ranges = [(addr, size) for name, addr, size in self.get_module_sections(module) if name in sections]
+        for addr, size in ranges:
+            for match in self.search(addr, addr + size, pattern, mask, overlap=overlap):
+                yield match
+
+    def search_modules(self, pattern, mask=None, modules=None, sections=None, overlap=None):
+        """| <generator>
+           | Search **pattern** in every loaded module (see :func:`get_modules`) or in **modules**
+
+           :yield: str, int -- module name, address of the match
+        """
+        if modules is None:
+            modules = [name for name, image_name, loaded_image_name in self.get_modules()]
+        for module in modules:
+            try:
+                matches = list(self.search_module(module, pattern, mask, sections, overlap))
+            except (WindowsError, ValueError):
+                # Module or PE header not accessible
+                continue
+            for match in matches:
+                yield module, match
+
+    def snapshot(self, ranges, keep_data=False, physical=False):
+        """| Hash every page of some memory ranges to detect later modifications.
+           | Compare two snapshots with :func:`diff`.
+
+           :param ranges: the (Symbol, size) to snapshot (physical addresses if **physical**)
+           :type ranges: list of (Symbol, int)
+           :param keep_data: also keep the compressed content of the pages to get the modified bytes
+           :rtype: :class:`dbgmemory.MemorySnapshot`
+        """
+        if not physical:
+            ranges = [(self.resolve_symbol(addr), size) for addr, size in ranges]
+        iter_read = lambda addr, size: self.iter_read(addr, size, physical=physical)
+        return dbgmemory.take_snapshot(iter_read, ranges, keep_data)
+
+    def diff(self, old, new):
+        """| Compare two snapshots taken with :func:`snapshot` (see :func:`dbgmemory.diff_snapshots`).
+           | The modified byte ranges are only computed if both snapshots were taken with **keep_data**.
+
+           :rtype: list of (int, list of (int, int)) -- page address, (start, end) addresses or None
+        """
+        return dbgmemory.diff_snapshots(old, new)
+
+    def get_boot_identity(self):
+        """| Identify the current boot of the machine: the base of nt (randomized at each boot by KASLR)
+           | and :file:`nt!KeBootTime` (None if the symbol is not available)
+
+           :rtype: int, int
+        """
+        try:
+            boot_time = self.read_qword("nt!KeBootTime")
+        except (WindowsError, ValueError):
+            boot_time = None
+        return self.resolve_symbol("nt"), boot_time
 
-        self.DebugDataSpaces.ReadVirtual(c_uint64(addr), byref(struct), size, byref(read))
-        return read.value
+    def get_physical_memory_runs(self):
+        """Get the RAM ranges described by :file:`nt!MmPhysicalMemoryBlock`
+
+           :rtype: list of (int, int) -- physical address, size
+        """
+        # lkd> dt nt!_PHYSICAL_MEMORY_DESCRIPTOR
+        #    +0x000 NumberOfRuns     : Uint4B
+        #    +0x008 NumberOfPages    : Uint8B
+        #    +0x010 Run              : [1] _PHYSICAL_MEMORY_RUN (BasePage, PageCount)
+        descriptor = self.read_ptr("nt!MmPhysicalMemoryBlock")
+        nb_runs = self.read_dword(descriptor)
+        runs = self.read_array(descriptor + 2 * self.PTR_SIZE, "P", 2 * nb_runs)
+        return [(int(runs[2 * i]) * dbgmemory.PAGE_SIZE, int(runs[2 * i + 1]) * dbgmemory.PAGE_SIZE) for i in range(nb_runs)]
+
+    def dump_physical_memory(self, path, **kwargs):
+        """| Dump the RAM into the raw image **path** (see :class:`dbgdump.PhysicalMemoryDumper`)
+           | Calling it again after an interruption continues the dump where it stopped.
+           | Pass ``progress=dbgdump.print_progress`` to follow the dump on stdout.
+
+           :returns: the unreadable (addr, size) ranges
+        """
+        return dbgdump.PhysicalMemoryDumper(self, path, **kwargs).dump()
+
+    def iter_list_entry(self, head, type, link_field, with_data=False, max_nodes=0x10000):
+        """| <generator>
+           | Walk a kernel LIST_ENTRY list (nt!PsActiveProcessHead, nt!PsLoadedModuleList, ...)
+           | Each node is read in one call of the size of its containing type.
+           | Raise :class:`ValueError` if the list looks corrupted or has more than **max_nodes** nodes.
+
+           :param head: The Symbol of the list head
+           :type head: Symbol
+           :param type: The containing type ("nt!_EPROCESS") or a :class:`DbgEngType`
+           :param link_field: The name of the LIST_ENTRY field in **type** ("ActiveProcessLinks")
+           :type link_field: str
+           :param with_data: also yield the raw content of the node
+           :yield: node address -- :class:`int` or (node address, node content) if **with_data**
+        """
+        head = self.resolve_symbol(head)
+        if not isinstance(type, DbgEngType):
+            module, type_name = type.split("!", 1) if "!" in type else ("nt", type)
+            type = self.get_type(module, type_name)
+        link_offset = self.get_field_offset(type.module, type.typeid, link_field)
+        for node, data in dbgmemory.walk_list_entry(self.read_virtual_memory, head, link_offset,
+                                                    type.size, self.PTR_SIZE, max_nodes):
+            if with_data:
+                yield node, data
+            else:
+                yield node
+
+    # Memory cache
+    def enable_memory_cache(self, max_size=dbgmemory.PageCache.DEFAULT_MAX_SIZE,
+                            max_cached_read=dbgmemory.PageCache.DEFAULT_MAX_CACHED_READ):
+        """| Put a page-granular LRU cache in front of the virtual memory reads.
+           | Writes done through LKD invalidate it, use :func:`flush_memory_cache`
+           | if the kernel may have modified the memory you are reading.
+
+           :param max_size: the number of bytes the cache may keep
+           :type max_size: int
+           :param max_cached_read: bigger reads bypass the cache
+           :type max_cached_read: int
+           :returns: :class:`dbgmemory.PageCache`
+        """
+        self.memory_cache = dbgmemory.PageCache(self._raw_read_virtual_memory, max_size, max_cached_read)
+        return self.memory_cache
+
+    def disable_memory_cache(self):
+        """Remove the memory cache, every read will go through COM again"""
+        self.memory_cache = None
+
+    def flush_memory_cache(self):
+        """Drop every page of the memory cache (if any)"""
+        if self.memory_cache is not None:
+            self.memory_cache.flush()
 
     def read_byte(self, addr):
         """Read a byte from virtual memory"""
@@ -982,12 +1747,20 @@ class LocalKernelDebuggerBase(object):
            :type size: int
            :returns: :class:`str`
         """
+        buffer = ctypes.create_string_buffer(size)
+        read = self.readinto_physical(addr, buffer)
+        return buffer.raw[:read]
 
-        buffer = (c_char * size)()
-        read = DWORD(0)
+    def readinto_physical(self, addr, buffer):
+        """Fill a writable buffer with the physical memory at a given address
 
-        self.DebugDataSpaces.ReadPhysical(c_uint64(addr), buffer, size, byref(read))
-        return buffer[0:read.value]
+           :param addr: The physical address to read from
+           :type addr: int
+           :param buffer: The buffer to fill
+           :type buffer: bytearray, memoryview, array.array or ctypes object
+           :returns: the size read -- :class:`int`
+        """
+        return dbgmemory.readinto(self.DebugDataSpaces.ReadPhysical, addr, buffer)
 
     def write_physical_memory(self, addr, data):
         """Write data to a given physical address
@@ -998,6 +1771,13 @@ class LocalKernelDebuggerBase(object):
            :type size: str or ctypes.Structure
            :returns: the size written -- :class:`int`
         """
+        if self._write_batch is not None:
+            return self._write_batch.stage("physical", addr, data)
+        # We cannot know which virtual pages map this physical address
+        self.flush_memory_cache()
+        return self._raw_write_physical_memory(addr, data)
+
+    def _raw_write_physical_memory(self, addr, data):
         try:
             # ctypes structure
             size = ctypes.sizeof(data)
@@ -1010,12 +1790,16 @@ class LocalKernelDebuggerBase(object):
         self.DebugDataSpaces.WritePhysical(c_uint64(addr), buffer, size, byref(written))
         return written.value
 
+    @serialized
     def read_processor_system_data(self, processor, type):
         """| Returns a :class:`DEBUG_PROCESSOR_IDENTIFICATION_X86` if type is :class:`DEBUG_DATA_PROCESSOR_IDENTIFICATION`
            | else returns an :class:`int`
 
            (see :func:`ReadProcessorSystemData` `<https://msdn.microsoft.com/en-us/library/windows/hardware/ff554326%28v=vs.85%29.aspx>`_.)
+           | The KPCR and KPRCB addresses never change: they are cached
         """
+        if (processor, type) in self._processor_data_cache:
+            return self._processor_data_cache[processor, type]
         if type == DEBUG_DATA_PROCESSOR_IDENTIFICATION:
             buffer = DEBUG_PROCESSOR_IDENTIFICATION_ALL()
         elif type == DEBUG_DATA_PROCESSOR_SPEED:
@@ -1026,6 +1810,8 @@ class LocalKernelDebuggerBase(object):
         self.DebugDataSpaces.ReadProcessorSystemData(processor, type, byref(buffer), sizeof(buffer), byref(data_size))
         if type != DEBUG_DATA_PROCESSOR_IDENTIFICATION:
             buffer = buffer.value
+        if type in (DEBUG_DATA_KPCR_OFFSET, DEBUG_DATA_KPRCB_OFFSET):
+            self._processor_data_cache[processor, type] = buffer
         return buffer
 
     def read_bus_data(self, datatype, busnumber, slot, offset, size):
@@ -1177,6 +1963,8 @@ class LocalKernelDebugger32(LocalKernelDebuggerBase):
     GetModuleFileNameW_addr_jump_offset = 0x3374bc
     FindResourceW_addr_jump_offset = 0x3374a0
 
+    PTR_SIZE = 4
+
     # read_ptr and write_ptr real implementation (bitness dependant)
     read_ptr = LocalKernelDebuggerBase.read_dword
     read_ptr_p = LocalKernelDebuggerBase.read_dword_p
@@ -1272,6 +2060,8 @@ class LocalKernelDebugger64(LocalKernelDebuggerBase):
                   SYMOPT_OMAP_FIND_NEAREST + SYMOPT_LOAD_LINES + SYMOPT_DEFERRED_LOADS +
                   SYMOPT_UNDNAME + SYMOPT_CASE_INSENSITIVE)
 
+    PTR_SIZE = 8
+
     read_ptr = LocalKernelDebuggerBase.read_qword
     read_ptr_p = LocalKernelDebuggerBase.read_qword_p
     write_ptr = LocalKernelDebuggerBase.write_qword
@@ -1352,9 +2142,18 @@ class LocalKernelDebuggerError(Exception):
     pass
 
 
-def LocalKernelDebugger(quiet=True):
+def LocalKernelDebugger(quiet=True, symbol_db=None, lazy_symbols=False, fast_attach=False, warmup_budget=None):
     """| Check that all conditions to Local Kernel Debugging are met
        | and return a LKD (subclass of :class:`LocalKernelDebuggerBase`
+       | **symbol_db** is the path of the :class:`dbgsymbols.SymbolDatabase` (True for ``.\\symbols\\lkd_symbols.db``)
+       | If **symbol_db** is None the database is only used if the ``LKD_SYMBOL_DB`` environment variable is set
+       | If **lazy_symbols** is True the symbols of a module are only loaded when first used
+       | (a ``module!symbol`` lookup or an address inside the module) instead of at attach time
+       | If **fast_attach** is True (implies **lazy_symbols**) the symbol reload, the dbghelp setup and the
+       | driver upgrade are done on first use instead of at attach time
+       | The duration of each phase of the attach is recorded in :data:`attach_timings`
+       | If **warmup_budget** is not None, a background thread prefetches common data
+       | during at most **warmup_budget** seconds (see :func:`LocalKernelDebuggerBase.start_warmup`)
     """
     if not windows.utils.check_debug():
         raise LocalKernelDebuggerError("Cannot perform LocalKernelDebugging on kernel not in DEBUG mode")
@@ -1364,8 +2163,8 @@ def LocalKernelDebugger(quiet=True):
     if windows.system.bitness == 64:
         if windows.current_process.is_wow_64:
             raise LocalKernelDebuggerError("Cannot perform LocalKernelDebugging from SysWow64 process (please launch from 64bits python)")
-        return LocalKernelDebugger64(quiet)
-    return LocalKernelDebugger32(quiet)
+        return LocalKernelDebugger64(quiet, symbol_db, lazy_symbols, fast_attach, warmup_budget)
+    return LocalKernelDebugger32(quiet, symbol_db, lazy_symbols, fast_attach, warmup_budget)
     
 # # We are working on this part, we don't know if we will use it
 # # We don't know if it really works
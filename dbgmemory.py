@@ -0,0 +1,619 @@
+"""Memory access helpers used by LKD to limit the number of COM round trips"""
+import re
+import zlib
+import array
+import hashlib
+import struct
+import ctypes
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PAGE_SIZE = 0x1000
+PAGE_MASK = ~(PAGE_SIZE - 1)
+
+CTYPES_DATA_TYPES = (ctypes._SimpleCData, ctypes.Array, ctypes.Structure, ctypes.Union)
+
+# Size of the unsigned integers accepted by new_array
+ARRAY_ITEM_SIZE = {"B": 1, "H": 2, "I": 4, "Q": 8}
+CTYPES_UNSIGNED = {1: ctypes.c_uint8, 2: ctypes.c_uint16, 4: ctypes.c_uint32, 8: ctypes.c_uint64}
+
+
+def new_array(typecode, count):
+    """| Return a zeroed array of **count** little-endian unsigned integers
+       | **typecode** is one of "B", "H", "I", "Q"
+       | The array is a :class:`numpy.ndarray` if NumPy is installed, else an :class:`array.array`
+       | (or a ctypes array if no :mod:`array` typecode has the requested size)
+    """
+    size = ARRAY_ITEM_SIZE[typecode]
+    if numpy is not None:
+        return numpy.zeros(count, dtype="<u{0}".format(size))
+    for code in "BHILQ":
+        try:
+            if array.array(code).itemsize == size:
+                return array.array(code, [0]) * count
+        except ValueError:  # No 'Q' on python2
+            pass
+    return (CTYPES_UNSIGNED[size] * count)()
+
+
+def buffer_size(buffer):
+    """Return the size in bytes of a writable **buffer** (bytearray, memoryview, array, ctypes object)"""
+    if isinstance(buffer, CTYPES_DATA_TYPES):
+        return ctypes.sizeof(buffer)
+    if isinstance(buffer, array.array):
+        return len(buffer) * buffer.itemsize
+    view = memoryview(buffer)
+    return len(view) * view.itemsize
+
+
+def as_ctypes_buffer(buffer, size):
+    """| Return a (c_char * **size**) sharing the memory of **buffer**
+       | or None if ctypes cannot map it (memoryview on python2)
+    """
+    try:
+        return (ctypes.c_char * size).from_buffer(buffer)
+    except TypeError:
+        return None
+
+
+def as_bytes(data):
+    """Return the content of **data** (:class:`str`, bytearray or ctypes object) as :class:`str`"""
+    if isinstance(data, CTYPES_DATA_TYPES):
+        return ctypes.string_at(ctypes.addressof(data), ctypes.sizeof(data))
+    return bytes(data)
+
+
+def copy_into(buffer, data):
+    """Copy **data** at the beginning of the writable **buffer**, return the size copied"""
+    size = len(data)
+    cbuffer = as_ctypes_buffer(buffer, size)
+    if cbuffer is None:
+        memoryview(buffer)[:size] = data
+    else:
+        ctypes.memmove(cbuffer, data, size)
+    return size
+
+
+def readinto(read_function, addr, buffer):
+    """| Fill **buffer** in place using an IDebugDataSpaces Read function (ReadVirtual, ReadPhysical)
+       | **buffer** may be any writable buffer (bytearray, memoryview, array, ctypes object)
+
+       :returns: the size read -- :class:`int`
+    """
+    size = buffer_size(buffer)
+    if not size:
+        return 0
+    read = ctypes.c_ulong(0)
+    cbuffer = as_ctypes_buffer(buffer, size)
+    if cbuffer is not None:
+        read_function(ctypes.c_uint64(addr), cbuffer, size, ctypes.byref(read))
+        return read.value
+    # Cannot share the memory of buffer: use a temporary one
+    cbuffer = ctypes.create_string_buffer(size)
+    read_function(ctypes.c_uint64(addr), cbuffer, size, ctypes.byref(read))
+    memoryview(buffer)[:read.value] = cbuffer.raw[:read.value]
+    return read.value
+
+
+class PageCache(object):
+    """| LRU cache of :data:`PAGE_SIZE` lines in front of a raw memory reader.
+       | **read** is called as read(addr, size) and returns the data read (:class:`str`),
+       | it may return less data than asked if a page is unreadable.
+       | **max_size** is the number of bytes the cache may keep.
+       | Reads bigger than **max_cached_read** are not cached (they would flush the whole cache).
+       | Unreadable pages are cached too (as None) so they are not asked again.
+    """
+    DEFAULT_MAX_SIZE = 0x400000
+    DEFAULT_MAX_CACHED_READ = 0x10000
+
+    def __init__(self, read, max_size=DEFAULT_MAX_SIZE, max_cached_read=DEFAULT_MAX_CACHED_READ):
+        self.read_raw = read
+        self.max_size = max_size
+        self.max_cached_read = max_cached_read
+        self.pages = collections.OrderedDict()
+        # Incremented each time the whole cache is flushed
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        """Number of bytes currently cached"""
+        return len(self.pages) * PAGE_SIZE
+
+    def _insert(self, page_addr, data):
+        if self.max_size < PAGE_SIZE:
+            return
+        while self.pages and self.size + PAGE_SIZE > self.max_size:
+            self.pages.popitem(last=False)
+        self.pages[page_addr] = data
+
+    def _lookup(self, page_addr):
+        # Return (True, page content or None if unreadable) for a cached page, else (False, None)
+        try:
+            data = self.pages.pop(page_addr)
+        except KeyError:
+            return False, None
+        self.hits += 1
+        # Reinsert the page as the most recently used one
+        self.pages[page_addr] = data
+        return True, data
+
+    def _fetch(self, page_addr, nb_pages):
+        """| Read **nb_pages** missing pages in one raw read and cache them
+           | Return the content of the pages read before the first unreadable one
+        """
+        self.misses += nb_pages
+        try:
+            data = self.read_raw(page_addr, nb_pages * PAGE_SIZE)
+        except EnvironmentError:
+            data = b""
+        res = []
+        for i in range(len(data) // PAGE_SIZE):
+            page = data[i * PAGE_SIZE:(i + 1) * PAGE_SIZE]
+            self._insert(page_addr + i * PAGE_SIZE, page)
+            res.append(page)
+        if len(res) < nb_pages:
+            self._insert(page_addr + len(res) * PAGE_SIZE, None)
+        return res
+
+    def get_page(self, page_addr):
+        """Return the content of the page at **page_addr** or None if it cannot be read"""
+        cached, data = self._lookup(page_addr)
+        if cached:
+            return data
+        pages = self._fetch(page_addr, 1)
+        return pages[0] if pages else None
+
+    def read(self, addr, size):
+        """| Return the **size** bytes at **addr** (less if a page is unreadable, like the raw reads)
+           | Return None if the first page cannot be read or the read is too big to be cached
+        """
+        if size <= 0:
+            return b""
+        if size > self.max_cached_read:
+            return None
+        end = addr + size
+        first_page = page_addr = addr & PAGE_MASK
+        pages = []
+        while page_addr < end:
+            cached, data = self._lookup(page_addr)
+            if cached:
+                if data is None:
+                    break
+                pages.append(data)
+                page_addr += PAGE_SIZE
+                continue
+            # Read the whole run of missing pages at once
+            run_end = page_addr + PAGE_SIZE
+            while run_end < end and run_end not in self.pages:
+                run_end += PAGE_SIZE
+            nb_pages = (run_end - page_addr) // PAGE_SIZE
+            fetched = self._fetch(page_addr, nb_pages)
+            pages.extend(fetched)
+            if len(fetched) < nb_pages:
+                break
+            page_addr = run_end
+        if not pages:
+            return None
+        return b"".join(pages)[addr - first_page:end - first_page]
+
+    def invalidate(self, addr, size):
+        """Drop the cached pages that overlap [**addr**, **addr** + **size**)"""
+        page_addr = addr & PAGE_MASK
+        while page_addr < addr + size:
+            self.pages.pop(page_addr, None)
+            page_addr += PAGE_SIZE
+
+    def flush(self):
+        """Drop every cached page and start a new generation"""
+        self.pages.clear()
+        self.generation += 1
+
+    def __repr__(self):
+        return "<PageCache {0} pages (hits={1} misses={2})>".format(len(self.pages), self.hits, self.misses)
+
+
+def coalesce_ranges(ranges, max_gap=0):
+    """| Merge adjacent and overlapping (addr, size) **ranges** into as few ranges as possible.
+       | Ranges separated by at most **max_gap** bytes are also merged.
+
+       :returns: list of (addr, size, members) where members is a list of
+                 (index in **ranges**, offset in the merged range, size)
+    """
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+    res = []
+    current = None
+    for i in order:
+        addr, size = ranges[i]
+        if current is not None and addr <= current[1] + max_gap:
+            current[1] = max(current[1], addr + size)
+        else:
+            current = [addr, addr + size, []]
+            res.append(current)
+        current[2].append((i, addr - current[0], size))
+    return [(start, end - start, members) for start, end, members in res]
+
+
+def read_ranges(read, ranges, max_gap=0):
+    """| Read the (addr, size) **ranges** with one **read(addr, size)** per merged range (see :func:`coalesce_ranges`)
+       | If a merged read fails or comes back short (unreadable page in a gap), the ranges it does not
+       | cover are read on their own.
+
+       :returns: one :class:`str` per range, in the order of **ranges**
+    """
+    res = [None] * len(ranges)
+    for addr, size, members in coalesce_ranges(ranges, max_gap):
+        try:
+            data = read(addr, size)
+        except EnvironmentError:
+            if len(members) == 1:
+                raise
+            data = b""
+        for i, offset, member_size in members:
+            if offset + member_size <= len(data) or len(members) == 1:
+                res[i] = data[offset:offset + member_size]
+            else:
+                res[i] = read(addr + offset, member_size)
+    return res
+
+
+def walk_list_entry(read, head, link_offset, node_size, ptr_size, max_nodes):
+    """| <generator>
+       | Walk a LIST_ENTRY chain starting at **head** by reading each node in one call.
+       | **read** is called as read(addr, size) and returns the data read (:class:`str`)
+       | Raise :class:`ValueError` if the list is corrupted (NULL or unreadable Flink,
+       | Blink mismatch, cycle) or has more than **max_nodes** nodes
+
+       :yield: int, str -- node address, node content
+    """
+    if node_size < link_offset + 2 * ptr_size:
+        raise ValueError("Node size {0} is too small for a LIST_ENTRY at offset {1}".format(hex(node_size), hex(link_offset)))
+    ptr_format = {4: "I", 8: "Q"}[ptr_size]
+    flink = struct.unpack("<" + ptr_format, read(head, ptr_size))[0]
+    prev = head
+    seen = set()
+    while flink != head:
+        if not flink:
+            raise ValueError("NULL Flink in list entry {0}".format(hex(prev)))
+        if flink in seen:
+            raise ValueError("Cycle in list {0}: {1} already visited".format(hex(head), hex(flink)))
+        if len(seen) >= max_nodes:
+            raise ValueError("List {0} has more than {1} nodes".format(hex(head), max_nodes))
+        seen.add(flink)
+        node = flink - link_offset
+        data = read(node, node_size)
+        if len(data) != node_size:
+            raise ValueError("Cannot read list node at {0}".format(hex(node)))
+        next_flink, blink = struct.unpack_from("<" + ptr_format * 2, data, link_offset)
+        if blink != prev:
+            raise ValueError("Corrupted list entry {0}: Blink is {1} instead of {2}".format(hex(flink), hex(blink), hex(prev)))
+        yield node, data
+        prev = flink
+        flink = next_flink
+
+
+DEFAULT_CHUNK_SIZE = 0x100000
+
+
+class MemoryHole(object):
+    """An unreadable range of **size** bytes reported by :func:`iter_chunks`"""
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return "<MemoryHole of size {0}>".format(hex(self.size))
+
+
+def iter_chunks(readinto, addr, length, chunk_size=DEFAULT_CHUNK_SIZE):
+    """| <generator>
+       | Read [**addr**, **addr** + **length**) by chunks of **chunk_size** into a reusable buffer.
+       | **readinto** is called as readinto(addr, buffer) and returns the size read
+       | If a chunk cannot be fully read, it is read again page by page and the unreadable
+       | pages are reported as :class:`MemoryHole`.
+       | The yielded memoryview are only valid until the next iteration.
+
+       :yield: int, memoryview or :class:`MemoryHole` -- offset from **addr**, data
+    """
+    buffer = bytearray(min(chunk_size, length))
+    view = memoryview(buffer)
+    offset = 0
+    while offset < length:
+        size = min(chunk_size, length - offset)
+        try:
+            read = readinto(addr + offset, (ctypes.c_char * size).from_buffer(buffer))
+        except EnvironmentError:
+            read = 0
+        if read == size:
+            yield offset, view[:size]
+            offset += size
+            continue
+        # Find the readable parts of the chunk page by page
+        segments = [(0, read, True)]
+        pos = read
+        while pos < size:
+            page_end = min(size, ((addr + offset + pos) & PAGE_MASK) + PAGE_SIZE - (addr + offset))
+            try:
+                page_read = readinto(addr + offset + pos, (ctypes.c_char * (page_end - pos)).from_buffer(buffer, pos))
+            except EnvironmentError:
+                page_read = 0
+            segments.append((pos, pos + page_read, True))
+            segments.append((pos + page_read, page_end, False))
+            pos = page_end
+        merged = []
+        for start, end, readable in segments:
+            if start == end:
+                continue
+            if merged and merged[-1][2] == readable:
+                merged[-1][1] = end
+            else:
+                merged.append([start, end, readable])
+        for start, end, readable in merged:
+            if readable:
+                yield offset + start, view[start:end]
+            else:
+                yield offset + start, MemoryHole(end - start)
+        offset += size
+
+
+def masked_pattern_regex(pattern, mask):
+    """| Compile a regex matching **pattern** where only the bits set in **mask** are compared.
+       | A mask byte of 0xff means "exact byte", 0x00 means "any byte".
+    """
+    if len(pattern) != len(mask):
+        raise ValueError("pattern and mask must have the same size")
+    regex = []
+    for p, m in zip(bytearray(pattern), bytearray(mask)):
+        if m == 0xff:
+            regex.append(re.escape(chr(p)))
+        elif m == 0:
+            regex.append(".")
+        else:
+            regex.append("[" + "".join(re.escape(chr(v)) for v in range(0x100) if v & m == p & m) + "]")
+    regex = "".join(regex)
+    if not isinstance(regex, bytes):  # python3
+        regex = regex.encode("latin-1")
+    return re.compile(regex, re.DOTALL)
+
+
+def _search_regex_window(regex, window, base, done, last):
+    """| Search **regex** in **window** (at offset **base**) from the offset **done**.
+       | Unless **last**, the search stops at the first match touching the end of the window:
+       | the next chunk may extend it.
+
+       :return: list of (int, int), int -- offsets (start, end) of the matches,
+                index in **window** of the match cut by the end of the window or None
+    """
+    res = []
+    for match in regex.finditer(window, max(0, done - base)):
+        if match.end() == len(window) and not last:
+            return res, match.start()
+        res.append((base + match.start(), base + match.end()))
+    return res, None
+
+
+def _masked_find(regex):
+    # Same interface as str.find
+    def find(window, pos):
+        match = regex.search(window, pos)
+        if match is None:
+            return -1
+        return match.start()
+    return find
+
+
+def search_chunks(chunks, pattern, mask=None, overlap=None):
+    """| <generator>
+       | Search **pattern** in the chunks yielded by :func:`iter_chunks`.
+       | The end of each chunk is kept to find the matches across chunk boundaries.
+       | **pattern** is either a :class:`str` (with an optional **mask**, see :func:`masked_pattern_regex`)
+       | or a compiled regex, in which case **overlap** must be the maximum length of a match:
+       | a longer match across a chunk boundary is not found.
+       | A regex match touching the end of a chunk is only yielded once the next chunk is read, with its full length.
+
+       :yield: int -- offset of each match
+    """
+    if hasattr(pattern, "finditer"):
+        if overlap is None:
+            raise ValueError("overlap (maximum length of a match) is required for a regex")
+        regex = pattern
+    else:
+        # Fixed length pattern: overlapping matches are found by searching again from the next byte
+        regex = None
+        overlap = len(pattern) - 1
+        if mask is not None:
+            find = _masked_find(masked_pattern_regex(pattern, mask))
+        else:
+            # str.find is a Boyer-Moore-Horspool like search implemented in C
+            find = lambda window, pos: window.find(pattern, pos)
+    tail = b""
+    tail_base = tail_end = None
+    # Offset before which the regex matches were already yielded
+    done = 0
+    for offset, data in chunks:
+        data = None if isinstance(data, MemoryHole) else data.tobytes()
+        if data is None or tail_end != offset:
+            if tail and regex is not None:
+                # End of a contiguous range: the match cut by the end of the tail is complete
+                matches, cut = _search_regex_window(regex, tail, tail_base, done, True)
+                for start, end in matches:
+                    yield start
+            tail = b""
+            tail_end = None
+            if data is None:
+                continue
+        window = tail + data
+        base = offset - len(tail)
+        tail_start = max(0, len(window) - overlap) if overlap else len(window)
+        if regex is None:
+            pos = find(window, 0)
+            while pos != -1:
+                yield base + pos
+                pos = find(window, pos + 1)
+        else:
+            matches, cut = _search_regex_window(regex, window, base, done, False)
+            for start, end in matches:
+                yield start
+                done = end
+            if cut is not None:
+                # Search the cut match again with the next chunk
+                tail_start = min(tail_start, cut)
+                done = max(done, base + cut)
+        tail = window[tail_start:]
+        tail_base = base + tail_start
+        tail_end = offset + len(data)
+    if tail and regex is not None:
+        matches, cut = _search_regex_window(regex, tail, tail_base, done, True)
+        for start, end in matches:
+            yield start
+
+
+try:
+    blake2b = hashlib.blake2b
+except AttributeError:  # python2
+    blake2b = None
+
+
+def page_digest(data):
+    """Strong hash of a page: blake2b if available else sha256"""
+    if blake2b is not None:
+        return blake2b(data, digest_size=32).digest()
+    return hashlib.sha256(data).digest()
+
+
+class MemorySnapshot(object):
+    """| Hash of each page of some memory ranges (see :func:`take_snapshot`)
+       | **digests**: page address -> page digest (None if the page was not readable)
+       | **data**: page address -> zlib compressed page (None if the content was not kept)
+    """
+    def __init__(self, digests, data=None):
+        self.digests = digests
+        self.data = data
+
+    def get_page(self, page_addr):
+        """Return the content of the page at **page_addr** if it was kept, else None"""
+        if self.data is None or page_addr not in self.data:
+            return None
+        return zlib.decompress(self.data[page_addr])
+
+    def __repr__(self):
+        return "<MemorySnapshot of {0} pages>".format(len(self.digests))
+
+
+def take_snapshot(iter_read, ranges, keep_data=False):
+    """| Hash every page of the (addr, size) **ranges** and optionally keep their compressed content.
+       | **iter_read** is called as iter_read(addr, size) and behaves like :func:`iter_chunks`
+
+       :rtype: :class:`MemorySnapshot`
+    """
+    digests = {}
+    data = {} if keep_data else None
+    for addr, size in ranges:
+        start = addr & PAGE_MASK
+        end = (addr + size + PAGE_SIZE - 1) & PAGE_MASK
+        for offset, chunk in iter_read(start, end - start):
+            if isinstance(chunk, MemoryHole):
+                for page_offset in range(0, chunk.size, PAGE_SIZE):
+                    digests[start + offset + page_offset] = None
+                continue
+            for page_offset in range(0, len(chunk), PAGE_SIZE):
+                page = chunk[page_offset:page_offset + PAGE_SIZE].tobytes()
+                page_addr = start + offset + page_offset
+                digests[page_addr] = page_digest(page)
+                if keep_data:
+                    data[page_addr] = zlib.compress(page)
+    return MemorySnapshot(digests, data)
+
+
+def diff_bytes(old, new, base=0):
+    """Return the (start, end) ranges (offset by **base**) where **old** and **new** differ"""
+    res = []
+    start = None
+    old, new = bytearray(old), bytearray(new)
+    for i in range(max(len(old), len(new))):
+        differ = i >= len(old) or i >= len(new) or old[i] != new[i]
+        if differ and start is None:
+            start = i
+        elif not differ and start is not None:
+            res.append((base + start, base + i))
+            start = None
+    if start is not None:
+        res.append((base + start, base + max(len(old), len(new))))
+    return res
+
+
+def diff_snapshots(old, new):
+    """| Compare two :class:`MemorySnapshot` page by page.
+       | The byte ranges are only computed if both snapshots kept the content of the page.
+
+       :returns: list of (page address, list of (start, end) addresses or None) for the changed pages
+    """
+    res = []
+    for page_addr in sorted(set(old.digests) | set(new.digests)):
+        if page_addr in old.digests and page_addr in new.digests and old.digests[page_addr] == new.digests[page_addr]:
+            continue
+        old_page = old.get_page(page_addr)
+        new_page = new.get_page(page_addr)
+        if old_page is None or new_page is None:
+            res.append((page_addr, None))
+        else:
+            res.append((page_addr, diff_bytes(old_page, new_page, page_addr)))
+    return res
+
+
+def split_by_page(addr, data):
+    """Split the write of **data** at **addr** on page boundaries: list of (addr, data)"""
+    res = []
+    offset = 0
+    while offset < len(data):
+        size = min(len(data) - offset, PAGE_SIZE - ((addr + offset) & (PAGE_SIZE - 1)))
+        res.append((addr + offset, data[offset:offset + size]))
+        offset += size
+    return res
+
+
+def merge_writes(writes):
+    """| Merge the adjacent and overlapping (addr, data) **writes** (in the order they were staged).
+       | When writes overlap, the last staged one wins.
+
+       :returns: list of (addr, data) sorted by address
+    """
+    res = []
+    for addr, size, members in coalesce_ranges([(addr, len(data)) for addr, data in writes]):
+        buffer = bytearray(size)
+        for i, offset, size in sorted(members):
+            buffer[offset:offset + size] = writes[i][1]
+        res.append((addr, bytes(buffer)))
+    return res
+
+
+class WriteBatch(object):
+    """| Writes staged by :func:`LocalKernelDebuggerBase.write_batch`
+       | **writes** is the list of staged (space, addr, data) with space in :data:`SPACES`
+    """
+    SPACES = ("virtual", "physical", "pfv")
+
+    def __init__(self):
+        self.writes = []
+
+    def stage(self, space, addr, data):
+        """Stage the write of **data** at **addr**, return the size staged"""
+        if space not in self.SPACES:
+            raise ValueError("Unknown address space <{0}>".format(space))
+        data = as_bytes(data)
+        self.writes.append((space, addr, data))
+        return len(data)
+
+    def get_writes(self, space):
+        """Return the (addr, data) staged for **space** in staging order"""
+        return [(addr, data) for write_space, addr, data in self.writes if write_space == space]
+
+    def __len__(self):
+        return len(self.writes)
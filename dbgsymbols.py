@@ -0,0 +1,417 @@
+"""Symbol tables used by LKD to answer symbol lookups without COM round trips"""
+import os
+import struct
+import bisect
+import fnmatch
+import collections
+import sqlite3
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    intern
+except NameError:  # python3
+    from sys import intern
+
+
+class ModuleSymbols(object):
+    """| The symbols of the module **name** loaded at [**base**, **base** + **size**[
+       | **symbols** is an iterable of (name, address) as returned by :func:`symbol_match`
+       | The symbols are stored in the parallel lists **addrs** and **names** sorted by address,
+       | only the first symbol seen at a given address is kept for the address lookups.
+       | All the symbols are kept in **symbols** for the name queries.
+    """
+    def __init__(self, name, base, size, symbols):
+        self.name = name
+        self.base = base
+        self.size = size
+        self.symbols = []
+        by_addr = {}
+        for sym_name, addr in symbols:
+            if base <= addr < base + size:
+                sym_name = intern(sym_name)
+                self.symbols.append((sym_name, addr))
+                if addr not in by_addr:
+                    by_addr[addr] = sym_name
+        self.addrs = sorted(by_addr)
+        self.names = [by_addr[addr] for addr in self.addrs]
+        self._numpy_addrs = None
+        # Sorted lowercase names without the module part, built on the first name query
+        self._name_keys = None
+        self._name_symbols = None
+
+    @property
+    def end(self):
+        return self.base + self.size
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def lookup(self, addr):
+        """Return the (symbol, displacement) of **addr** (the module name if no symbol is before **addr**)"""
+        i = bisect.bisect_right(self.addrs, addr) - 1
+        if i < 0:
+            return (self.name, addr - self.base)
+        return (self.names[i], addr - self.addrs[i])
+
+    def _get_name_keys(self):
+        if self._name_keys is None:
+            entries = sorted((sym_name.split("!", 1)[-1].lower(), sym_name, addr) for sym_name, addr in self.symbols)
+            self._name_keys = [key for key, sym_name, addr in entries]
+            self._name_symbols = [(sym_name, addr) for key, sym_name, addr in entries]
+        return self._name_keys
+
+    def _prefix_range(self, prefix):
+        keys = self._get_name_keys()
+        start = i = bisect.bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            i += 1
+        return start, i
+
+    def find_prefix(self, prefix):
+        """Return the (name, address) of the symbols whose name (without module) starts with **prefix** (case insensitive)"""
+        start, end = self._prefix_range(prefix.lower())
+        return self._name_symbols[start:end]
+
+    def find_glob(self, pattern):
+        """Return the (name, address) of the symbols whose name (without module) matches the glob **pattern** (case insensitive)"""
+        pattern = pattern.lower()
+        # Only the names starting with the literal part of the pattern can match
+        literal = pattern
+        for i, c in enumerate(pattern):
+            if c in "*?[":
+                literal = pattern[:i]
+                break
+        start, end = self._prefix_range(literal)
+        keys = self._name_keys
+        return [self._name_symbols[i] for i in range(start, end) if fnmatch.fnmatchcase(keys[i], pattern)]
+
+    def find_substring(self, substring):
+        """Return the (name, address) of the symbols whose name (without module) contains **substring** (case insensitive)"""
+        substring = substring.lower()
+        keys = self._get_name_keys()
+        return [self._name_symbols[i] for i in range(len(keys)) if substring in keys[i]]
+
+    def lookup_many(self, addrs):
+        """Same as :func:`lookup` for each address of the :class:`numpy.ndarray` **addrs**"""
+        if self._numpy_addrs is None:
+            self._numpy_addrs = numpy.array(self.addrs, dtype=numpy.uint64)
+        indexes = numpy.searchsorted(self._numpy_addrs, addrs, side="right") - 1
+        res = []
+        for addr, i in zip(addrs.tolist(), indexes.tolist()):
+            if i < 0:
+                res.append((self.name, addr - self.base))
+            else:
+                res.append((self.names[i], addr - self.addrs[i]))
+        return res
+
+
+def parse_exports(read, base):
+    """| Return the (name, address) of the named exports of the PE loaded at **base**
+       | **read(addr, size)** returns the memory at **addr**, forwarded exports are ignored
+    """
+    nt_headers = base + struct.unpack("<I", read(base + 0x3c, 4))[0]
+    magic = struct.unpack("<H", read(nt_headers + 0x18, 2))[0]
+    # OptionalHeader.DataDirectory[IMAGE_DIRECTORY_ENTRY_EXPORT] of PE32 / PE32+
+    data_directory = nt_headers + 0x18 + (0x60 if magic == 0x10b else 0x70)
+    export_rva, export_size = struct.unpack("<II", read(data_directory, 8))
+    if not export_rva:
+        return []
+    export_end = export_rva + export_size
+    nb_functions, nb_names, functions_rva, names_rva, ordinals_rva = struct.unpack("<IIIII", read(base + export_rva + 0x14, 20))
+    functions = struct.unpack("<{0}I".format(nb_functions), read(base + functions_rva, 4 * nb_functions))
+    names = struct.unpack("<{0}I".format(nb_names), read(base + names_rva, 4 * nb_names))
+    ordinals = struct.unpack("<{0}H".format(nb_names), read(base + ordinals_rva, 2 * nb_names))
+    # The name strings are usually in the export directory: read them all at once
+    directory = None
+    if names and export_rva <= min(names) and max(names) < export_end:
+        directory = read(base + export_rva, export_size)
+    res = []
+    for name_rva, ordinal in zip(names, ordinals):
+        if directory is not None:
+            offset = name_rva - export_rva
+            name = directory[offset:directory.index(b"\x00", offset)]
+        else:
+            name = read(base + name_rva, 0x100).split(b"\x00", 1)[0]
+        function_rva = functions[ordinal]
+        if export_rva <= function_rva < export_end:
+            continue  # Forwarder string
+        res.append((name, base + function_rva))
+    return res
+
+
+ModuleEntry = collections.namedtuple("ModuleEntry", ["base", "end", "name", "image_name", "loaded_image_name"])
+
+
+class ModuleMap(object):
+    """| Sorted interval table of the loaded modules
+       | **modules** is an iterable of :class:`ModuleEntry` (base, end, name, image name, loaded image name)
+    """
+    def __init__(self, modules):
+        self.modules = sorted(ModuleEntry(*module) for module in modules)
+        self.bases = [module.base for module in self.modules]
+
+    def __len__(self):
+        return len(self.modules)
+
+    def __iter__(self):
+        return iter(self.modules)
+
+    def index(self, addr):
+        """Return the index in **modules** of the module containing **addr** or None"""
+        i = bisect.bisect_right(self.bases, addr) - 1
+        if i < 0 or addr >= self.modules[i].end:
+            return None
+        return i
+
+    def indexes(self, addresses):
+        """| Same as :func:`index` for each address of **addresses**
+           | Return a :class:`numpy.ndarray` (-1 for no module) if NumPy is installed, else a list
+        """
+        if numpy is None:
+            return [self.index(addr) for addr in addresses]
+        addrs = numpy.asarray(addresses, dtype=numpy.uint64)
+        bases = numpy.array(self.bases, dtype=numpy.uint64)
+        ends = numpy.array([module.end for module in self.modules] + [0], dtype=numpy.uint64)
+        res = numpy.searchsorted(bases, addrs, side="right") - 1
+        # ends[-1] == 0: addresses below the first module are also rejected
+        res[addrs >= ends[res]] = -1
+        return res
+
+    def find(self, addr):
+        """Return the :class:`ModuleEntry` containing **addr** or None"""
+        i = self.index(addr)
+        if i is None:
+            return None
+        return self.modules[i]
+
+    def find_many(self, addresses):
+        """Return the :class:`ModuleEntry` (or None) containing each address of **addresses**"""
+        if numpy is None:
+            return [self.find(addr) for addr in addresses]
+        return [self.modules[i] if i >= 0 else None for i in self.indexes(addresses).tolist()]
+
+
+class SymbolIndex(object):
+    """| Address -> symbol index of the modules of the :class:`ModuleMap` **module_map**
+       | **load_symbols(name)** returns the (name, address) of the symbols of a module,
+       | it is only called the first time an address falls into the module.
+    """
+    def __init__(self, module_map, load_symbols):
+        self.module_map = module_map
+        self.load_symbols = load_symbols
+        self.tables = {}
+
+    def get_table(self, i):
+        """Return the :class:`ModuleSymbols` of module number **i** of the map, loading it if needed"""
+        table = self.tables.get(i)
+        if table is None:
+            module = self.module_map.modules[i]
+            symbols = self.load_symbols(module.name)
+            table = self.tables[i] = ModuleSymbols(module.name, module.base, module.end - module.base, symbols)
+        return table
+
+    def lookup(self, addr):
+        """Return the (symbol, displacement) of **addr** or (None, None) if it is not in a module"""
+        i = self.module_map.index(addr)
+        if i is None:
+            return (None, None)
+        return self.get_table(i).lookup(addr)
+
+    def find_symbols(self, query, method="find_glob"):
+        """| Return the (name, address) of the symbols matching the "module!name" **query**
+           | **module** is a glob pattern on the module names, **method** is the name of the
+           | :class:`ModuleSymbols` method used to match **name** (find_glob, find_prefix, find_substring)
+        """
+        if "!" not in query:
+            raise ValueError("Symbol query <{0}> is not in the form module!name".format(query))
+        module_pattern, name = query.split("!", 1)
+        module_pattern = module_pattern.lower()
+        res = []
+        for i, module in enumerate(self.module_map.modules):
+            if fnmatch.fnmatchcase(module.name.lower(), module_pattern):
+                res.extend(getattr(self.get_table(i), method)(name))
+        return res
+
+    def lookup_many(self, addresses):
+        """Return the list of (symbol, displacement) of **addresses** (see :func:`lookup`)"""
+        if numpy is None:
+            return [self.lookup(addr) for addr in addresses]
+        addrs = numpy.asarray(addresses, dtype=numpy.uint64)
+        res = [(None, None)] * len(addrs)
+        modules = self.module_map.indexes(addrs)
+        for i in numpy.unique(modules).tolist():
+            if i < 0:
+                continue
+            positions = numpy.nonzero(modules == i)[0]
+            for pos, sym in zip(positions.tolist(), self.get_table(i).lookup_many(addrs[positions])):
+                res[pos] = sym
+        return res
+
+
+class SymbolCache(object):
+    """| Case insensitive name -> address cache used by :func:`get_symbol_offset`
+       | Unknown names are cached with the number of loaded modules returned by **get_nb_modules()**
+       | at the time of the lookup: the negative entry is dropped if this number changed.
+       | Known names are cached with the base of their module returned by **get_module_base(module name)**
+       | (None if there is no such module): the entry is dropped if the module was loaded at another base.
+       | **hits** and **misses** count the lookups since the creation of the cache.
+    """
+    def __init__(self, get_nb_modules, get_module_base):
+        self.get_nb_modules = get_nb_modules
+        self.get_module_base = get_module_base
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, name):
+        """Return (True, address) if **name** is in the cache (address is None for unknown symbols) else (False, None)"""
+        key = name.lower()
+        entry = self.entries.get(key)
+        if entry is not None:
+            addr, stamp = entry
+            if stamp == self._stamp(key, addr):
+                self.hits += 1
+                return (True, addr)
+            del self.entries[key]
+        self.misses += 1
+        return (False, None)
+
+    def add(self, name, addr):
+        """Cache the address of **name** (None if the symbol is unknown)"""
+        key = name.lower()
+        self.entries[key] = (addr, self._stamp(key, addr))
+
+    def _stamp(self, key, addr):
+        # The state of the modules an entry depends on
+        if addr is None:
+            return self.get_nb_modules()
+        return self.get_module_base(key.split("!", 1)[0])
+
+    def clear(self):
+        """Drop all the entries (the stats are kept)"""
+        self.entries.clear()
+
+    @property
+    def hit_rate(self):
+        """Ratio of the lookups served by the cache"""
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / total
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SymbolDatabase(object):
+    """| On-disk (sqlite) cache of symbols and type layouts, shared by all LKD sessions
+       | Entries are keyed by module identity: (module name, TimeDateStamp, SizeOfImage),
+       | so the content of a module is valid for every kernel with the same build of this module.
+       | Symbols are stored as RVA and can be used without dbgeng/dbghelp (offline analysis).
+       | Types are stored by name: a dbghelp typeid is only valid in the session that returned it.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS modules (id INTEGER PRIMARY KEY, name TEXT COLLATE NOCASE, timestamp INTEGER,
+                                            size INTEGER, complete INTEGER DEFAULT 0, UNIQUE (name, timestamp, size));
+        CREATE TABLE IF NOT EXISTS symbols (module INTEGER, name TEXT COLLATE NOCASE, rva INTEGER,
+                                            PRIMARY KEY (module, name));
+        CREATE TABLE IF NOT EXISTS sizes (module INTEGER, type TEXT, size INTEGER,
+                                          PRIMARY KEY (module, type));
+        CREATE TABLE IF NOT EXISTS field_offsets (module INTEGER, type TEXT, name TEXT, offset INTEGER,
+                                                  PRIMARY KEY (module, type, name));
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Used by the warm-up thread of LKD (always holding the COM lock of the session)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Names are given to ctypes/COM: we want str on python2
+        self.db.text_factory = str
+        # It's a cache: losing the last writes on a crash is not a problem
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.executescript(self.SCHEMA)
+        self.module_ids = {}
+
+    @classmethod
+    def open(cls, path):
+        """Open the database **path**, creating its directory if needed"""
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        return cls(path)
+
+    def close(self):
+        self.db.close()
+
+    def _module_id(self, key, create=False):
+        module_id = self.module_ids.get(key)
+        if module_id is not None:
+            return module_id
+        row = self.db.execute("SELECT id FROM modules WHERE name = ? AND timestamp = ? AND size = ?", key).fetchone()
+        if row is not None:
+            module_id = row[0]
+        elif create:
+            module_id = self.db.execute("INSERT INTO modules (name, timestamp, size) VALUES (?, ?, ?)", key).lastrowid
+        else:
+            return None
+        self.module_ids[key] = module_id
+        return module_id
+
+    def _get_one(self, query, key, *args):
+        module_id = self._module_id(key)
+        if module_id is None:
+            return None
+        row = self.db.execute(query, (module_id,) + args).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _add(self, query, key, rows):
+        module_id = self._module_id(key, create=True)
+        with self.db:
+            self.db.executemany(query, [(module_id,) + tuple(row) for row in rows])
+        return module_id
+
+    # Symbols
+    def is_complete(self, key):
+        """Return True if all the symbols of the module **key** are in the database"""
+        return bool(self._get_one("SELECT complete FROM modules WHERE id = ?", key))
+
+    def get_symbols(self, key):
+        """Return the (name, rva) of the symbols of the module **key** stored in the database"""
+        module_id = self._module_id(key)
+        if module_id is None:
+            return []
+        return self.db.execute("SELECT name, rva FROM symbols WHERE module = ? ORDER BY rva", (module_id,)).fetchall()
+
+    def add_symbols(self, key, symbols, complete=False):
+        """| Add the (name, rva) **symbols** of the module **key**
+           | **complete** means that **symbols** are all the symbols of the module
+        """
+        module_id = self._add("INSERT OR REPLACE INTO symbols (module, name, rva) VALUES (?, ?, ?)", key, symbols)
+        if complete:
+            with self.db:
+                self.db.execute("UPDATE modules SET complete = 1 WHERE id = ?", (module_id,))
+
+    def get_symbol_rva(self, key, name):
+        """Return the rva of the symbol **name** (without the module name) or None"""
+        return self._get_one("SELECT rva FROM symbols WHERE module = ? AND name = ?", key, name)
+
+    # Types
+    def get_type_size(self, key, type_name):
+        return self._get_one("SELECT size FROM sizes WHERE module = ? AND type = ?", key, type_name)
+
+    def add_type_size(self, key, type_name, size):
+        self._add("INSERT OR REPLACE INTO sizes (module, type, size) VALUES (?, ?, ?)", key, [(type_name, size)])
+
+    def get_field_offset(self, key, type_name, field):
+        return self._get_one("SELECT offset FROM field_offsets WHERE module = ? AND type = ? AND name = ?",
+                             key, type_name, field)
+
+    def add_field_offset(self, key, type_name, field, offset):
+        self._add("INSERT OR REPLACE INTO field_offsets (module, type, name, offset) VALUES (?, ?, ?, ?)",
+                  key, [(type_name, field, offset)])
@@ -5,36 +5,459 @@
 # One for the type above (fieldname.type)
 # That have info about array size and co
 
+import json
 import struct
-from windows.generated_def.winstructs import *
+import ctypes
+import itertools
+import collections
+
+import dbgmemory
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    basestring
+except NameError:  # python3
+    basestring = str
+
+try:
+    from windows.generated_def.winstructs import *
+except (ImportError, AttributeError, NameError, ValueError):
+    # Not on Windows: only the offline registries (see load_layouts) are usable
+    TI_GET_SYMTAG = 0x0
+    TI_GET_SYMNAME = 0x1
+    TI_GET_LENGTH = 0x2
+    TI_GET_TYPE = 0x3
+    TI_GET_BASETYPE = 0x5
+    TI_GET_OFFSET = 0xa
+    TI_GET_COUNT = 0xc
+    TI_GET_BITPOSITION = 0xe
+    TI_GET_UDTKIND = 0x18
+
+# dbghelp SymTagEnum values used by the type layouts
+SymTagData = 7
+SymTagUDT = 11
+SymTagEnum = 12
+SymTagFunctionType = 13
+SymTagPointerType = 14
+SymTagArrayType = 15
+SymTagBaseType = 16
+SymTagTypedef = 17
+
+# dbghelp UdtKind values
+UdtStruct = 0
+UdtClass = 1
+UdtUnion = 2
+
+KIND_BY_SYMTAG = {SymTagUDT: "struct", SymTagEnum: "enum", SymTagFunctionType: "function",
+                  SymTagPointerType: "pointer", SymTagArrayType: "array",
+                  SymTagBaseType: "base", SymTagTypedef: "typedef"}
+
+# kind: "struct", "union", "pointer", "array", "base", "enum", "function", "typedef" or "unknown"
+# element: typeid of the pointed / array element / underlying type (None if not relevant)
+# count: the number of elements of an array (None for other kinds)
+# fields: OrderedDict name -> FieldLayout (empty for non struct / union types)
+TypeLayout = collections.namedtuple("TypeLayout", ["module", "typeid", "name", "size", "kind", "element", "count", "fields"])
+# id: the dbghelp id of the field (not its type)
+# bitpos / bitlen / mask: the first bit, number of bits and mask of a bitfield (None if the field is not a bitfield)
+FieldLayout = collections.namedtuple("FieldLayout", ["name", "id", "offset", "typeid", "bitpos", "bitlen", "mask"])
+
+
+def make_field_layout(name, id, offset, typeid, bitpos=None, bitlen=None):
+    """Create a :class:`FieldLayout`, the mask of a bitfield is computed once here"""
+    mask = None if bitlen is None else (1 << bitlen) - 1
+    return FieldLayout(name, id, offset, typeid, bitpos, bitlen, mask)
+
+
+UNPACK_BY_SIZE = {1: "<B", 2: "<H", 4: "<I", 8: "<Q"}
+UNSIGNED_CTYPES = {1: ctypes.c_uint8, 2: ctypes.c_uint16, 4: ctypes.c_uint32, 8: ctypes.c_uint64}
+# Base types that are not unsigned integers (by their dbgeng name)
+BASE_CTYPES = {"char": ctypes.c_int8, "short": ctypes.c_int16, "int": ctypes.c_int32, "long": ctypes.c_int32,
+               "int64": ctypes.c_int64, "__int64": ctypes.c_int64, "float": ctypes.c_float, "double": ctypes.c_double}
+
+# Version of the files written by TypeRegistry.export
+LAYOUT_FILE_VERSION = 1
+
+# A member of a generated ctypes type: a field or a unit of bitfields at **offset**
+# entries are the ctypes _fields_ entries of the member
+CtypesMember = collections.namedtuple("CtypesMember", ["offset", "size", "entries"])
+
+
+class TypeRegistry(object):
+    """| The type cache of a debugging session
+       | Each (module, typeid) is asked to dbgeng / dbghelp only once, see :class:`TypeLayout`,
+       | and so are the type queries of **kdbg** (see :func:`cached_query`).
+       | The sizes and field offsets of the types asked by name are also kept in the
+       | :class:`dbgsymbols.SymbolDatabase` **db** for the next sessions (see :func:`stored_query`)
+       | An **offline** registry only knows the layouts loaded from a file (see :func:`load_layouts`),
+       | its **kdbg** is only used to read the memory (see :class:`OfflineMemory`)
+    """
+    def __init__(self, kdbg, offline=False, db=None):
+        self.kdbg = kdbg
+        self.offline = offline
+        self.db = db
+        # (query name, arguments) -> result of the type queries of kdbg
+        self.queries = {}
+        self.layouts = {}
+        self.ctypes_types = {}
+        # (module, type name) -> typeid of the loaded layouts
+        self.names = {}
+        # The (module name, TimeDateStamp, SizeOfImage) of the loaded layouts
+        self.build = None
+
+    def __len__(self):
+        return len(self.layouts)
+
+    def clear(self):
+        self.queries.clear()
+        self.layouts.clear()
+        self.ctypes_types.clear()
+        self.names.clear()
+        self.build = None
+
+    def cached_query(self, key, query):
+        """Return the result of **query()**, computed only once for **key** (until :func:`clear`)"""
+        try:
+            return self.queries[key]
+        except KeyError:
+            pass
+        res = self.queries[key] = query()
+        return res
+
+    def stored_query(self, module, type_name, field, query):
+        """| Same as :func:`cached_query` for the size of a type (**field** is None) or the offset of a field
+           | If the type is given by name (a typeid is only valid in its session), the result is also
+           | read from / written to :data:`db`, keyed by module identity and type name
+        """
+        key = ("size", module, type_name) if field is None else ("offset", module, type_name, field)
+        return self.cached_query(key, lambda: self._stored_query(module, type_name, field, query))
+
+    def _stored_query(self, module, type_name, field, query):
+        if self.db is None or not isinstance(type_name, basestring):
+            return query()
+        db_key = self.kdbg.get_module_identity(module)
+        if field is None:
+            res = self.db.get_type_size(db_key, type_name)
+        else:
+            res = self.db.get_field_offset(db_key, type_name, field)
+        if res is None:
+            res = query()
+            if field is None:
+                self.db.add_type_size(db_key, type_name, res)
+            else:
+                self.db.add_field_offset(db_key, type_name, field, res)
+        return res
+
+    def get_layout(self, module, typeid):
+        """:returns: :class:`TypeLayout`"""
+        key = (module, typeid)
+        layout = self.layouts.get(key)
+        if layout is None:
+            if self.offline:
+                raise ValueError("Type {0} of {1} is not in the offline layouts".format(typeid, module))
+            with self.kdbg.com_lock:
+                layout = self.layouts[key] = self._query_layout(module, typeid)
+        return layout
+
+    def get_type(self, module, typeid):
+        """:returns: :class:`DbgEngType`"""
+        return DbgEngType(module, typeid, self.kdbg, self)
+
+    def get_type_by_name(self, module, name):
+        """| Return the :class:`DbgEngType` **name** of **module**
+           | The names of an offline registry are resolved from its loaded layouts
+        """
+        if not self.offline:
+            return self.get_type(*self.kdbg.resolve_type(module, name))
+        typeid = self.names.get((module, name))
+        if typeid is None:
+            raise ValueError("Unkown type: <{0}!{1}>".format(module, name))
+        return self.get_type(module, typeid)
+
+    def _query_layout(self, module, typeid):
+        kdbg = self.kdbg
+        symtag = kdbg.SymGetTypeInfo(module, typeid, TI_GET_SYMTAG)
+        kind = KIND_BY_SYMTAG.get(symtag, "unknown")
+        if kind == "struct" and kdbg.SymGetTypeInfo(module, typeid, TI_GET_UDTKIND) == UdtUnion:
+            kind = "union"
+        element = count = None
+        if kind in ("pointer", "array", "enum", "typedef"):
+            element = kdbg.SymGetTypeInfo(module, typeid, TI_GET_TYPE)
+        if kind == "array":
+            count = kdbg.SymGetTypeInfo(module, typeid, TI_GET_COUNT)
+        fields = collections.OrderedDict()
+        if kind in ("struct", "union"):
+            for field in self._query_fields(module, typeid):
+                fields[field.name] = field
+        return TypeLayout(module, typeid, kdbg.get_type_name(module, typeid), kdbg.get_type_size(module, typeid),
+                          kind, element, count, fields)
+
+    def _query_fields(self, module, typeid):
+        kdbg = self.kdbg
+        for child in kdbg.get_childs_types(module, typeid).Types:
+            # Ignore the base classes, methods, ... of C++ types
+            if kdbg.SymGetTypeInfo(module, child, TI_GET_SYMTAG) != SymTagData:
+                continue
+            try:
+                bitpos = kdbg.SymGetTypeInfo(module, child, TI_GET_BITPOSITION, check=True)
+            except EnvironmentError:
+                bitpos = bitlen = None  # Not a bitfield
+            else:
+                bitlen = kdbg.SymGetTypeInfo(module, child, TI_GET_LENGTH)
+            yield make_field_layout(str(kdbg.SymGetTypeInfo(module, child, TI_GET_SYMNAME)), child,
+                                    kdbg.SymGetTypeInfo(module, child, TI_GET_OFFSET),
+                                    kdbg.SymGetTypeInfo(module, child, TI_GET_TYPE), bitpos, bitlen)
+
+    # Layout files
+    def export(self, path, roots, follow_pointers=True):
+        """| Write the layouts of **roots** and of every type they contain to a JSON file
+           | keyed by the build of their module (see :func:`load_layouts`)
+
+           :param roots: the :class:`DbgEngType` to export
+           :param follow_pointers: also export the pointed types
+           :returns: the number of exported types
+        """
+        modules = set(root.module for root in roots)
+        if len(modules) != 1:
+            raise ValueError("The exported types must be in one module (got {0})".format(len(modules)))
+        module = modules.pop()
+        todo = [root.typeid for root in roots]
+        exported = {}
+        while todo:
+            typeid = todo.pop()
+            if typeid in exported:
+                continue
+            layout = exported[typeid] = self.get_layout(module, typeid)
+            if layout.element is not None and (follow_pointers or layout.kind != "pointer"):
+                todo.append(layout.element)
+            todo.extend(field.typeid for field in layout.fields.values())
+        if self.offline:
+            build = self.build
+        else:
+            build = self.kdbg.get_module_identity(self.kdbg.trim_ulong64_to_address(module))
+        data = {"version": LAYOUT_FILE_VERSION, "build": list(build), "pointer_size": self.kdbg.PTR_SIZE,
+                "types": [[layout.typeid, layout.name, layout.size, layout.kind, layout.element, layout.count,
+                           [list(field[:6]) for field in layout.fields.values()]]
+                          for typeid, layout in sorted(exported.items())]}
+        with open(path, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+        return len(exported)
+
+    def load(self, path):
+        """| Add the layouts of a file written by :func:`export` to an offline registry (see :func:`load_layouts`)
+           | The typeids of the file are the ones of the exporting session: they are never mixed with the
+           | typeids of a live session, the types are keyed by module name and found by type name.
+           | Raise :class:`ValueError` if the memory is a live session on another build of the module
+
+           :returns: the number of loaded types
+        """
+        if not self.offline:
+            raise ValueError("The layout files can only be loaded in an offline registry (see load_layouts)")
+        with open(path) as f:
+            data = json.load(f)
+        if data["version"] != LAYOUT_FILE_VERSION:
+            raise ValueError("Unknown layout file version {0}".format(data["version"]))
+        build = (str(data["build"][0]), data["build"][1], data["build"][2])
+        module = build[0]
+        if hasattr(self.kdbg, "get_module_identity") and self.kdbg.get_module_identity(module) != build:
+            raise ValueError("{0} was created for another build of {1}".format(path, module))
+        for typeid, name, size, kind, element, count, fields in data["types"]:
+            fields = collections.OrderedDict((str(field[0]), make_field_layout(str(field[0]), *field[1:])) for field in fields)
+            self.layouts[(module, typeid)] = TypeLayout(module, typeid, str(name), size, str(kind), element, count, fields)
+            self.names.setdefault((module, str(name)), typeid)
+        self.build = build
+        return len(data["types"])
+
+    # ctypes generation
+    def to_ctypes(self, module, typeid):
+        """| Return a ctypes type with the layout of the type (cached)
+           | Structures and unions become :class:`ctypes.Structure` / :class:`ctypes.Union` with **_pack_** = 1
+           | and explicit padding, overlapping fields are put in anonymous unions.
+           | Pointers are integers of the size of the pointers of the session.
+        """
+        key = (module, typeid)
+        res = self.ctypes_types.get(key)
+        if res is None:
+            res = self.ctypes_types[key] = self._build_ctypes(self.get_layout(module, typeid))
+        return res
+
+    def _build_ctypes(self, layout):
+        if layout.kind == "array":
+            return self.to_ctypes(layout.module, layout.element) * layout.count
+        if layout.kind == "typedef":
+            return self.to_ctypes(layout.module, layout.element)
+        if layout.kind in ("struct", "union"):
+            return self._build_ctypes_struct(layout)
+        if layout.kind == "base" and layout.name in BASE_CTYPES:
+            return BASE_CTYPES[layout.name]
+        if layout.size in UNSIGNED_CTYPES:
+            # unsigned base types, pointers and enums
+            return UNSIGNED_CTYPES[layout.size]
+        return ctypes.c_uint8 * layout.size
+
+    def _build_ctypes_struct(self, layout):
+        # Unique suffix of the generated padding / anonymous members
+        counter = itertools.count()
+        members = self._ctypes_members(layout, counter)
+        if layout.kind == "union":
+            res = self._make_ctypes_union(layout.name, members, 0, counter)
+        else:
+            res = self._make_ctypes_struct(layout.name, members, 0, layout.size, counter)
+        if ctypes.sizeof(res) < layout.size:
+            res = type(str(layout.name), (ctypes.Union,), {"_pack_": 1, "_anonymous_": ["_u"],
+                       "_fields_": [("_u", res), ("_pad", ctypes.c_uint8 * layout.size)]})
+        if ctypes.sizeof(res) != layout.size:
+            raise ValueError("Generated ctypes {0} is {1} bytes instead of {2}".format(layout.name, ctypes.sizeof(res), layout.size))
+        return res
+
+    def _ctypes_members(self, layout, counter):
+        members = []
+        unit_bits = None  # Number of bits used in the last member if it is a bitfield unit
+        for field in layout.fields.values():
+            ctype = self.to_ctypes(layout.module, field.typeid)
+            if field.bitpos is None or ctypes.sizeof(ctype) not in UNSIGNED_CTYPES:
+                members.append(CtypesMember(field.offset, ctypes.sizeof(ctype), [(field.name, ctype)]))
+                unit_bits = None
+                continue
+            storage = UNSIGNED_CTYPES[ctypes.sizeof(ctype)]
+            last = members[-1] if members else None
+            if unit_bits is None or (last.offset, last.entries[-1][1]) != (field.offset, storage) or field.bitpos < unit_bits:
+                self._close_ctypes_unit(last, unit_bits, counter)
+                last = CtypesMember(field.offset, ctypes.sizeof(storage), [])
+                members.append(last)
+                unit_bits = 0
+            if field.bitpos > unit_bits:
+                last.entries.append(("_bits{0}".format(next(counter)), storage, field.bitpos - unit_bits))
+            last.entries.append((field.name, storage, field.bitlen))
+            unit_bits = field.bitpos + field.bitlen
+        if members:
+            self._close_ctypes_unit(members[-1], unit_bits, counter)
+        return members
+
+    @staticmethod
+    def _close_ctypes_unit(member, unit_bits, counter):
+        # Fill the whole storage unit: the layout of the bitfields is then the same for every compiler
+        if unit_bits is not None and unit_bits < member.size * 8:
+            member.entries.append(("_bits{0}".format(next(counter)), member.entries[-1][1], member.size * 8 - unit_bits))
+
+    def _make_ctypes_struct(self, name, members, base, size, counter):
+        fields = []
+        anonymous = []
+        groups = []  # [offset, end, members] of the overlapping members
+        for member in sorted(members, key=lambda member: member.offset):
+            if groups and member.offset < groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], member.offset + member.size)
+                groups[-1][2].append(member)
+            else:
+                groups.append([member.offset, member.offset + member.size, [member]])
+        pos = base
+        for offset, end, group in groups:
+            if offset > pos:
+                fields.append(("_pad{0}".format(next(counter)), ctypes.c_uint8 * (offset - pos)))
+            if len(group) == 1:
+                fields.extend(group[0].entries)
+            else:
+                union_name = "_u{0}".format(next(counter))
+                fields.append((union_name, self._make_ctypes_union(name, group, offset, counter)))
+                anonymous.append(union_name)
+            pos = max(pos, end)
+        if size is not None and base + size > pos:
+            fields.append(("_pad{0}".format(next(counter)), ctypes.c_uint8 * (base + size - pos)))
+        return type(str(name), (ctypes.Structure,), {"_pack_": 1, "_anonymous_": anonymous, "_fields_": fields})
+
+    def _make_ctypes_union(self, name, members, base, counter):
+        branches = []  # [end, members] of non overlapping members
+        for member in sorted(members, key=lambda member: member.offset):
+            for branch in branches:
+                if member.offset >= branch[0]:
+                    branch[0] = member.offset + member.size
+                    branch[1].append(member)
+                    break
+            else:
+                branches.append([member.offset + member.size, [member]])
+        fields = []
+        anonymous = []
+        for end, branch in branches:
+            if len(branch) == 1 and branch[0].offset == base and len(branch[0].entries) == 1:
+                fields.extend(branch[0].entries)
+            else:
+                struct_name = "_s{0}".format(next(counter))
+                fields.append((struct_name, self._make_ctypes_struct(name, branch, base, None, counter)))
+                anonymous.append(struct_name)
+        return type(str(name), (ctypes.Union,), {"_pack_": 1, "_anonymous_": anonymous, "_fields_": fields})
+
+
+def load_layouts(path, memory=None):
+    """| Create an offline :class:`TypeRegistry` from a file written by :func:`TypeRegistry.export`
+       | No dbgeng / dbghelp is needed: the types are found with :func:`TypeRegistry.get_type_by_name`
+       | and mapped on **memory** (an :class:`OfflineMemory` or a :class:`LocalKernelDebugger`
+       | running on the same build of the module)
+    """
+    registry = TypeRegistry(memory, offline=True)
+    registry.load(path)
+    return registry
+
+
+class OfflineMemory(object):
+    """| The memory of a saved image, for the types of an offline :class:`TypeRegistry`
+       | **read(addr, size)** returns the **size** bytes at the virtual address **addr**
+    """
+    def __init__(self, read, ptr_size):
+        self.read = read
+        self.PTR_SIZE = ptr_size
+
+    @classmethod
+    def from_snapshot(cls, snapshot, ptr_size):
+        """Read the pages of a :class:`dbgmemory.MemorySnapshot` taken with **keep_data**"""
+        def read(addr, size):
+            res = []
+            end = addr + size
+            while addr < end:
+                page_addr = addr & dbgmemory.PAGE_MASK
+                page = snapshot.get_page(page_addr)
+                if page is None:
+                    raise ValueError("Page {0} is not in the snapshot".format(hex(page_addr)))
+                chunk_end = min(end, page_addr + dbgmemory.PAGE_SIZE)
+                res.append(page[addr - page_addr:chunk_end - page_addr])
+                addr = chunk_end
+            return b"".join(res)
+        return cls(read, ptr_size)
+
+    def read_virtual_memory(self, addr, size):
+        return self.read(addr, size)
+
+    def read_ptr(self, addr):
+        return struct.unpack({4: "<I", 8: "<Q"}[self.PTR_SIZE], self.read(addr, self.PTR_SIZE))[0]
+
+    def read_virtual_memory_into(self, addr, struct):
+        return dbgmemory.copy_into(struct, self.read(addr, ctypes.sizeof(struct)))
+
 
 class DbgEngTypeBase(object):
-    def __init__(self, module, typeid, kdbg):
+    def __init__(self, module, typeid, kdbg, registry=None):
         self.module = module
-        self.module_name = kdbg.get_symbol(module)[0]
         self.typeid = typeid
         self.kdbg = kdbg
-
-    def SymGetTypeInfo(self, GetType):
-        return self.kdbg.SymGetTypeInfo(self.module, self.typeid, GetType)
+        self.registry = registry if registry is not None else kdbg.type_registry
 
     @property
-    def size(self):
-        return self.kdbg.get_type_size(self.module, self.typeid)
+    def module_name(self):
+        if self.registry.offline:
+            return self.module
+        return self.kdbg.get_symbol(self.module)[0]
 
-    @property
-    def type(self):
-        #if not self.is_array:
-        #    raise ValueError("array_type on non array type")
-        sub_type = self.kdbg.SymGetTypeInfo(self.module, self.typeid, TI_GET_TYPE)
-        return DbgEngType(self.module, sub_type, self.kdbg)
+    def SymGetTypeInfo(self, GetType):
+        return self.kdbg.SymGetTypeInfo(self.module, self.typeid, GetType)
 
     @property
     def base_type(self):
         #if not self.is_array:
         #    raise ValueError("array_type on non array type")
         sub_type = self.kdbg.SymGetTypeInfo(self.module, self.typeid, TI_GET_BASETYPE)
-        return DbgEngType(self.module, sub_type, self.kdbg)
+        return self.registry.get_type(self.module, sub_type)
 
     @property
     def raw_name(self):
@@ -44,24 +467,42 @@ class DbgEngTypeBase(object):
         return DbgEngtypeMapping(self, addr)
 
 class DbgEngType(DbgEngTypeBase):
+    """A handle on the :class:`TypeLayout` of **typeid** in the :class:`TypeRegistry`"""
+    @property
+    def layout(self):
+        return self.registry.get_layout(self.module, self.typeid)
+
     @property
     def name(self):
-        return self.kdbg.get_type_name(self.module, self.typeid)
+        return self.layout.name
+
+    @property
+    def size(self):
+        return self.layout.size
+
+    @property
+    def kind(self):
+        return self.layout.kind
+
+    @property
+    def type(self):
+        """The pointed / array element type"""
+        layout = self.layout
+        if layout.element is None:
+            raise ValueError("{0} has no sub type".format(layout.name))
+        return self.registry.get_type(self.module, layout.element)
 
     @property
     def is_array(self):
-        "Todo: Il doit bien y avoir un truc moins crade :D"
-        return self.name.endswith("[]")
+        return self.layout.kind == "array"
 
     @property
     def is_pointer(self):
-        "Todo: Il doit bien y avoir un truc moins crade :D"
-        return self.name.endswith("*")
+        return self.layout.kind == "pointer"
 
     @property
     def fields(self):
-        children = self.kdbg.get_childs_types(self.module, self.typeid)
-        return [DbgEngField(self.module, x, self.kdbg) for x in children.Types]
+        return [DbgEngField(self, field) for field in self.layout.fields.values()]
 
     @property
     def fields_dict(self):
@@ -69,94 +510,208 @@ class DbgEngType(DbgEngTypeBase):
 
     @property
     def number_elt(self):
-        return self.SymGetTypeInfo(TI_GET_COUNT)
+        return self.layout.count
+
+    def to_ctypes(self):
+        """:returns: the ctypes type with the layout of the type (see :func:`TypeRegistry.to_ctypes`)"""
+        return self.registry.to_ctypes(self.module, self.typeid)
+
+    def read(self, addr):
+        """Read the type at **addr** into an instance of :func:`to_ctypes` in one transfer"""
+        res = self.to_ctypes()()
+        self.kdbg.read_virtual_memory_into(addr, res)
+        return res
+
+    def decode_field(self, data, field_name, count=None):
+        """| Decode the integer (or bitfield) **field_name** of each of the **count** types
+           | stored one after the other in **data** (all the types of **data** if **count** is None)
+           | Return a :class:`numpy.ndarray` if NumPy is installed, else a list
+        """
+        layout = self.layout
+        field = layout.fields[field_name]
+        format = UNPACK_BY_SIZE[self.registry.get_layout(self.module, field.typeid).size]
+        if count is None:
+            count = len(data) // layout.size
+        if numpy is not None:
+            values = numpy.ndarray((count,), dtype=numpy.dtype(format), buffer=data,
+                                   offset=field.offset, strides=(layout.size,))
+            if field.bitpos is None:
+                return values.copy()
+            scalar = values.dtype.type
+            return (values >> scalar(field.bitpos)) & scalar(field.mask)
+        values = [struct.unpack_from(format, data, i * layout.size + field.offset)[0] for i in range(count)]
+        if field.bitpos is None:
+            return values
+        return [(value >> field.bitpos) & field.mask for value in values]
+
+    def read_field_array(self, addr, count, field_name):
+        """| Read **count** consecutive types at **addr** in one transfer
+           | and decode their **field_name** (see :func:`decode_field`)
+        """
+        return self.decode_field(self.kdbg.read_virtual_memory(addr, count * self.size), field_name, count)
+
+    def __eq__(self, other):
+        return isinstance(other, DbgEngType) and (self.module, self.typeid) == (other.module, other.typeid)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.module, self.typeid))
 
     def __repr__(self):
         return '<DbgEngType "{0}">'.format(self.name)
 
-    def __call__(self, addr):
+    def __call__(self, addr, snapshot=False):
+        """| Map the type on the memory at **addr**
+           | If **snapshot** is True the whole type is read once and every field access
+           | is decoded from this :class:`TypeSnapshot` until the mapping is refreshed
+        """
+        if snapshot:
+            return get_mapped_type(self, addr, TypeSnapshot(self.kdbg, addr, self.size))
         return get_mapped_type(self, addr)
 
 class DbgEngField(DbgEngTypeBase):
-    name = DbgEngTypeBase.raw_name
+    def __init__(self, parent, field):
+        super(DbgEngField, self).__init__(parent.module, field.id, parent.kdbg, parent.registry)
+        self.parent = parent
+        self.field = field
 
     @property
-    def parent(self):
-        parent_typeid = self.SymGetTypeInfo(TI_GET_CLASSPARENTID)
-        return  DbgEngType(self.module, parent_typeid, self.kdbg)
+    def name(self):
+        return self.field.name
 
     @property
     def offset(self):
-        return self.SymGetTypeInfo(TI_GET_OFFSET)
+        return self.field.offset
 
     @property
     def bitoff(self):
-        return self.SymGetTypeInfo(TI_GET_BITPOSITION)
+        return self.field.bitpos
+
+    @property
+    def bitlen(self):
+        return self.field.bitlen
+
+    @property
+    def type(self):
+        return self.registry.get_type(self.module, self.field.typeid)
+
+    @property
+    def size(self):
+        return self.type.size
 
     def __repr__(self):
-        return '<Field <{0}.{1}> at offset <{2}> of type <{3}>>'.format(self.parent.name, self.raw_name, hex(self.offset), self.type.name)
+        return '<Field <{0}.{1}> at offset <{2}> of type <{3}>>'.format(self.parent.name, self.name, hex(self.offset), self.type.name)
 
 
-def get_mapped_type(type, addr):
+def get_mapped_type(type, addr, snapshot=None):
+    layout = type.layout
 
-    if type.is_array:
-            return DbgEngtypeMappingPtr(type, addr)
+    if layout.kind == "array":
+            return DbgEngtypeMappingPtr(type, addr, snapshot)
 
-    if type.is_pointer and type.name not in ["void*"]:
-            return DbgEngtypeMappingPtr(type, addr)
+    if layout.kind == "pointer" and layout.name not in ["void*"]:
+            return DbgEngtypeMappingPtr(type, addr, snapshot)
 
     # basic type: no fields
-    if not type.fields:
-        unpack_by_size = {1:"B", 2:'H', 4:'I', 8:'Q'}
-        data = type.kdbg.read_virtual_memory(addr, type.size)
-        return struct.unpack("<" + unpack_by_size[type.size], data)[0]
-    return DbgEngtypeMapping(type, addr)
+    if not layout.fields:
+        return unpack_mapped(type.kdbg, UNPACK_BY_SIZE[layout.size], addr, snapshot)
+    return DbgEngtypeMapping(type, addr, snapshot)
+
+
+def unpack_mapped(kdbg, format, addr, snapshot=None):
+    """Unpack the value at **addr** from the **snapshot** if it contains it, else from the memory"""
+    size = struct.calcsize(format)
+    if snapshot is not None and snapshot.contains(addr, size):
+        return struct.unpack_from(format, snapshot.data, addr - snapshot.addr)[0]
+    return struct.unpack(format, kdbg.read_virtual_memory(addr, size))[0]
+
+
+class TypeSnapshot(object):
+    """| The memory of a mapped type read in one transfer (see :func:`DbgEngType.__call__`)
+       | The mappings of its fields, sub-structures and arrays share it until :func:`refresh`
+    """
+    def __init__(self, kdbg, addr, size):
+        self.kdbg = kdbg
+        self.addr = addr
+        self.size = size
+        self.refresh()
+
+    def refresh(self):
+        """Read the memory of the snapshot again"""
+        self.data = self.kdbg.read_virtual_memory(self.addr, self.size)
+
+    def contains(self, addr, size):
+        return self.addr <= addr and addr + size <= self.addr + self.size
+
+    def __repr__(self):
+        return "<TypeSnapshot of {0} bytes at {1}>".format(self.size, hex(self.addr))
 
 
 class DbgEngtypeMapping(object):
-    def __init__(self, type, addr):
+    def __init__(self, type, addr, snapshot=None):
         self.type = type
-        self.type_field_dict = {x.name : x for x in type.fields}
+        self.layout = type.layout
         self.addr = addr
         self.kdbg = type.kdbg
+        self.snapshot = snapshot
 
     def __getattr__(self, name):
-        if name not in self.type_field_dict:
-            raise AttributeError
+        if name not in self.layout.fields:
+            raise AttributeError(name)
 
-        field = self.type_field_dict[name]
+        field = self.layout.fields[name]
         addr = self.addr + field.offset
+        field_type = self.type.registry.get_type(self.type.module, field.typeid)
+
+        if field.bitpos is not None:
+            value = unpack_mapped(self.kdbg, UNPACK_BY_SIZE[field_type.size], addr, self.snapshot)
+            return (value >> field.bitpos) & field.mask
 
-        # TODO: bitfield
+        return get_mapped_type(field_type, addr, self.snapshot)
 
-        return get_mapped_type(field.type, addr)
+    def refresh(self):
+        """Read the snapshot shared by this mapping again (nothing to do for live mappings)"""
+        if self.snapshot is not None:
+            self.snapshot.refresh()
 
     def __repr__(self):
         return "<Mapped {0} on addr {1}>".format(self.type.name, hex(self.addr))
 
-        
+
 class DbgEngtypeMappingPtr(object):
-    def __init__(self, type, addr):
+    def __init__(self, type, addr, snapshot=None):
         self.type = type
         self.addr = addr
         self.kdbg = type.kdbg
+        self.snapshot = snapshot
 
         if not self.type.is_array and not self.type.is_pointer:
             raise ValueError('DbgEngtypeMappingPtr on non ptr type')
 
     def __getitem__(self, n):
-        if self.type.is_array:
-            addr = self.addr + self.type.size * n
-        else:
-            addr = self.type.kdbg.read_ptr(self.addr)
-            addr += self.type.size * n
-
         target_t = self.type.type
+        if self.type.is_array:
+            addr = self.addr + target_t.size * n
+            return get_mapped_type(target_t, addr, self.snapshot)
+        # The pointer value may come from the snapshot, the pointed memory is live
+        addr = unpack_mapped(self.kdbg, UNPACK_BY_SIZE[self.type.size], self.addr, self.snapshot)
+        addr += target_t.size * n
         return get_mapped_type(target_t, addr)
 
+    def refresh(self):
+        """Read the snapshot shared by this mapping again (nothing to do for live mappings)"""
+        if self.snapshot is not None:
+            self.snapshot.refresh()
+
 
 # Example
 # >>> k = kdbg.get_type("nt", "_KPRCB")
 # >>> t = k(0xfffff8016c167000)
 # >>> t.WheaInfo
 # 18446708889364968624L
+# >>> t = k(0xfffff8016c167000, snapshot=True)  # One read for the whole _KPRCB
+# >>> t.refresh()
+# >>> idt = kdbg.get_type("nt", "_KIDTENTRY64")
+# >>> idt.read_field_array(idt_base, 256, "Present")  # The Present bit of the 256 IDT entries
@@ -1,4 +1,5 @@
 """Code that rewrite part of the LKD driver in memory to upgrade its features"""
+import struct
 import itertools
 import windows.native_exec.simple_x86 as x86
 import windows.native_exec.simple_x64 as x64
@@ -11,6 +12,7 @@ DU_TEST_INT3_IOCTL = 0x220077
 
 class DriverUpgrader(object):
     PTR_SIZE = None
+    PTR_FORMAT = None
 
     def __init__(self, kdbg):
         self.kdbg = kdbg
@@ -22,7 +24,7 @@ class DriverUpgrader(object):
         self.registered_ioctl = []
 
     def write_pfv_ptr(self, addr, data):
-            return self.kdbg.write_ptr_p(self.kdbg.virtual_to_physical(addr), data)
+            return self.kdbg.write_pfv_memory(addr, struct.pack(self.PTR_FORMAT, data))
 
     def register_test(self):
         DOINT3 = x86.MultipleInstr()
@@ -76,13 +78,17 @@ class DriverUpgrader(object):
             the the IOCODE/Handler array
         """
         next_array_entry = self.ioctl_array + (len(self.registered_ioctl) * (self.PTR_SIZE * 2))
-        self.kdbg.write_pfv_memory(self.next_code_addr, code)
-        # Set following entry a 0 for safety
-        self.write_pfv_ptr(next_array_entry + (2 * self.PTR_SIZE), 0)
-        self.write_pfv_ptr(next_array_entry + (3 * self.PTR_SIZE), 0)
-        # Setup new entry
+        # The driver may dispatch an IOCTL at any time: the handler code must be in memory
+        # before its entry is visible (a batch flushes in address order)
+        with self.kdbg.write_batch():
+            self.kdbg.write_pfv_memory(self.next_code_addr, code)
+        with self.kdbg.write_batch():
+            # Set following entry a 0 for safety
+            self.write_pfv_ptr(next_array_entry + (2 * self.PTR_SIZE), 0)
+            self.write_pfv_ptr(next_array_entry + (3 * self.PTR_SIZE), 0)
+            self.write_pfv_ptr(next_array_entry + (1 * self.PTR_SIZE), self.next_code_addr)
+        # Publish the new entry: the IOCODE is written last
         self.write_pfv_ptr(next_array_entry, iocode)
-        self.write_pfv_ptr(next_array_entry + (1 * self.PTR_SIZE), self.next_code_addr)
 
         self.registered_ioctl.append((iocode, self.next_code_addr))
         self.next_code_addr += len(code)
@@ -123,6 +129,7 @@ class DriverUpgrader32(DriverUpgrader):
             self.upgrade_driver_add_new_ioctl_handler(IOCODE, HANDLER_CODE)
     """
     PTR_SIZE = 4
+    PTR_FORMAT = "<I"
     # Offset of the function we will rewrite in the driver
     init_function_offset = 0xD10
     # Offset of the jump in the iohandle that we will hijack
@@ -207,12 +214,14 @@ class DriverUpgrader32(DriverUpgrader):
         new_ioctl_array_page = self.kdbg.alloc_memory(0x1000)
 
         alloc_ioctl, alloc_code_addr = self.registered_ioctl[0]
+        # Fill the new array before using it
+        with self.kdbg.write_batch():
+            self.write_pfv_ptr(new_ioctl_array_page, alloc_ioctl)
+            self.write_pfv_ptr(new_ioctl_array_page + 4, alloc_code_addr)
+            self.write_pfv_ptr(new_ioctl_array_page + 8, 0)
+            self.write_pfv_ptr(new_ioctl_array_page + 0xc, 0)
         # Write first array dest
         self.write_pfv_ptr(self.ioctl_array_ptr, new_ioctl_array_page)
-        self.write_pfv_ptr(new_ioctl_array_page, alloc_ioctl)
-        self.write_pfv_ptr(new_ioctl_array_page + 4, alloc_code_addr)
-        self.write_pfv_ptr(new_ioctl_array_page + 8, 0)
-        self.write_pfv_ptr(new_ioctl_array_page + 0xc, 0)
 
         self.ioctl_array = new_ioctl_array_page
         new_code_page = self.kdbg.alloc_memory(0x1000)
@@ -382,6 +391,7 @@ class DriverUpgrader64(DriverUpgrader):
             self.upgrade_driver_add_new_ioctl_handler(IOCODE, HANDLER_CODE)
     """
     PTR_SIZE = 8
+    PTR_FORMAT = "<Q"
     # Offset of the code in the iohandle that we will hijack
     hijack_offset = 0x50e8
     # Offset of the normal code path in the iohandle for the standard IO_CODE
@@ -465,12 +475,14 @@ class DriverUpgrader64(DriverUpgrader):
         new_ioctl_array_page = self.kdbg.alloc_memory(0x1000)
         alloc_ioctl, alloc_code_addr = self.registered_ioctl[0]
 
+        # Fill the new array before using it
+        with self.kdbg.write_batch():
+            self.write_pfv_ptr(new_ioctl_array_page, alloc_ioctl)
+            self.write_pfv_ptr(new_ioctl_array_page + 0x8, alloc_code_addr)
+            self.write_pfv_ptr(new_ioctl_array_page + 0x10, 0)
+            self.write_pfv_ptr(new_ioctl_array_page + 0x18, 0)
         # Write first array dest
         self.write_pfv_ptr(self.ioctl_array_ptr, new_ioctl_array_page)
-        self.write_pfv_ptr(new_ioctl_array_page, alloc_ioctl)
-        self.write_pfv_ptr(new_ioctl_array_page + 0x8, alloc_code_addr)
-        self.write_pfv_ptr(new_ioctl_array_page + 0x10, 0)
-        self.write_pfv_ptr(new_ioctl_array_page + 0x18, 0)
         self.ioctl_array = new_ioctl_array_page
 
         new_code_page = self.kdbg.alloc_memory(0x1000)
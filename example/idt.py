@@ -112,10 +112,10 @@ def get_idt_64(kdbg, num_proc=0):
 
     # You can read a pointer-size value, it doesn't depend of the target computer's architecture processor
     idt_base = kdbg.read_ptr(kpcr_addr + idt_base_offset)
+    # You can read multiple ranges at once, contiguous ranges are merged into one read
+    raw_entries = kdbg.read_many([(idt_base + i * sizeof(IDT64), sizeof(IDT64)) for i in xrange(0, 0xFF)])
     for i in xrange(0, 0xFF):
-        idt64 = IDT64()
-        # You can read data from  virtual address into a ctype structure
-        kdbg.read_virtual_memory_into(idt_base + i * sizeof(IDT64), idt64)
+        idt64 = IDT64.from_buffer_copy(raw_entries[i])
         addr = (idt64.OffsetHigh << 32) | (idt64.OffsetMiddle << 16) | idt64.OffsetLow
         if addr < addr_nt_KxUnexpectedInterrupt0 or addr > (addr_nt_KxUnexpectedInterrupt0 + 0xFF * size_unexpected_interrupt):
             l_idt.append((addr, get_kinterrupt_64(kdbg, addr)))
@@ -170,9 +170,9 @@ def get_idt_32(kdbg, num_proc=0):
 
     kpcr_addr = kdbg.read_processor_system_data(num_proc, DEBUG_DATA_KPCR_OFFSET)
     idt_base = kdbg.read_ptr(kpcr_addr + idt_base_offset)
+    raw_entries = kdbg.read_many([(idt_base + i * sizeof(IDT32), sizeof(IDT32)) for i in xrange(0, 0xFF)])
     for i in xrange(0, 0xFF):
-        idt32 = IDT32()
-        kdbg.read_virtual_memory_into(idt_base + i * sizeof(IDT32), idt32)
+        idt32 = IDT32.from_buffer_copy(raw_entries[i])
         if (idt32.ExtendedOffset == 0 or idt32.Offset == 0):
             l_idt.append((None, None))
             continue
@@ -193,9 +193,12 @@ if __name__ == '__main__':
         l_idt = get_idt_32(kdbg)
     else:
         l_idt = get_idt_64(kdbg)
+    # Resolve all the handlers at once
+    symbols = iter(kdbg.get_symbols([addr for addr, kinterrupt in l_idt if addr is not None]))
     for i in range(len(l_idt)):
         if l_idt[i][0] is not None:
+            symbol = next(symbols)[0]
             if l_idt[i][1] is not None:
-                print("0x{0:02X} {1} {2} (KINTERRUPT {3})".format(i, hex(l_idt[i][0]), kdbg.get_symbol(l_idt[i][0])[0], hex(l_idt[i][1])))
+                print("0x{0:02X} {1} {2} (KINTERRUPT {3})".format(i, hex(l_idt[i][0]), symbol, hex(l_idt[i][1])))
             else:
-                print("0x{0:02X} {1} {2}".format(i, hex(l_idt[i][0]), kdbg.get_symbol(l_idt[i][0])[0]))
+                print("0x{0:02X} {1} {2}".format(i, hex(l_idt[i][0]), symbol))
@@ -0,0 +1,42 @@
+"""Compare the speed of the symbol lookup backends of LKD"""
+import sys
+import os
+import time
+if os.getcwd().endswith("example"):
+    sys.path.append(os.path.realpath(".."))
+else:
+    sys.path.append(os.path.realpath("."))
+
+from dbginterface import LocalKernelDebugger
+
+
+def bench(name, function, args):
+    start = time.time()
+    for arg in args:
+        function(arg)
+    duration = time.time() - start
+    print("{0:<40} {1:>8.1f} us/lookup".format(name, duration * 1000000 / len(args)))
+
+
+kdbg = LocalKernelDebugger(symbol_db=False)
+
+# Some addresses inside the first "nt!Ke*" functions
+names = [name for name, addr in kdbg.symbol_match("nt!Ke*")][:1000]
+addresses = [kdbg.get_symbol_offset(name) + 0x10 for name in names]
+print("{0} names / {1} addresses".format(len(names), len(addresses)))
+
+# address -> name
+bench("IDebugSymbols::GetNameByOffset", kdbg._com_get_symbol, addresses)
+bench("dbghelp!SymFromAddr", kdbg._dbghelp_get_symbol, addresses)
+kdbg.get_symbol_index().lookup(addresses[0])  # Build the nt table
+bench("Symbol index (get_symbol)", kdbg.get_symbol, addresses)
+
+# name -> address
+bench("IDebugSymbols::GetOffsetByName", kdbg._com_get_symbol_offset, names)
+bench("dbghelp!SymFromName", kdbg._dbghelp_get_symbol_offset, names)
+bench("Name cache (get_symbol_offset)", kdbg.get_symbol_offset, names)
+
+# Both backends must agree
+for addr in addresses:
+    if kdbg._com_get_symbol(addr) != kdbg._dbghelp_get_symbol(addr):
+        print("Mismatch for {0}: {1} vs {2}".format(hex(addr), kdbg._com_get_symbol(addr), kdbg._dbghelp_get_symbol(addr)))
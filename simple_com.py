@@ -11,16 +11,26 @@ def get_IID_from_raw(raw):
     return "".join([struct.pack(i, j) for i, j in zip(IID_PACK, raw)])
 
 
+def locked_call(lock, function, *args):
+    with lock:
+        return function(*args)
+
+
 class COMInterface(ctypes.c_void_p):
     _functions_ = {
         "QueryInterface": ctypes.WINFUNCTYPE(HRESULT, ctypes.c_void_p, ctypes.c_void_p)(0, "QueryInterface"),
         "AddRef": ctypes.WINFUNCTYPE(HRESULT)(1, "AddRef"),
         "Release": ctypes.WINFUNCTYPE(HRESULT)(2, "Release")
     }
+    # If set (on the instance) all the calls to the interface are done holding this lock
+    _lock_ = None
 
     def __getattr__(self, name):
         if name in self._functions_:
-            return functools.partial(self._functions_[name], self)
+            function = functools.partial(self._functions_[name], self)
+            if self._lock_ is not None:
+                return functools.partial(locked_call, self._lock_, function)
+            return function
         return super(COMInterface, self).__getattribute__(name)
 
 
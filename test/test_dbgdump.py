@@ -0,0 +1,99 @@
+import sys
+sys.path.append(".")
+import os
+import shutil
+import tempfile
+import unittest
+
+import dbgmemory
+import dbgdump
+from dbgmemory import PAGE_SIZE
+
+
+class FakePhysicalMemory(object):
+    """Physical memory with some unreadable pages, exposing the iter_read of LocalKernelDebugger"""
+    def __init__(self, size, unreadable=()):
+        self.memory = bytes(bytearray((i * 7) & 0xff for i in range(size)))
+        self.unreadable = set(unreadable)
+        self.read_addrs = []
+        self.boot = (0xfffff80002a00000, 0x1d2c3b4a59687766)
+
+    def get_boot_identity(self):
+        return self.boot
+
+    def readinto(self, addr, buffer):
+        self.read_addrs.append(addr)
+        size = dbgmemory.buffer_size(buffer)
+        end = addr
+        while end < addr + size and (end & dbgmemory.PAGE_MASK) not in self.unreadable:
+            end = min(addr + size, (end & dbgmemory.PAGE_MASK) + PAGE_SIZE)
+        if end == addr:
+            raise EnvironmentError("Cannot read {0}".format(hex(addr)))
+        return dbgmemory.copy_into(buffer, self.memory[addr:end])
+
+    def iter_read(self, addr, length, chunk, physical=False):
+        return dbgmemory.iter_chunks(self.readinto, addr, length, chunk)
+
+
+class PhysicalMemoryDumperTestCase(unittest.TestCase):
+    RUNS = [(PAGE_SIZE, 5 * PAGE_SIZE), (8 * PAGE_SIZE, 8 * PAGE_SIZE)]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "memory.raw")
+        self.memory = FakePhysicalMemory(16 * PAGE_SIZE, unreadable=[10 * PAGE_SIZE])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def dumper(self):
+        return dbgdump.PhysicalMemoryDumper(self.memory, self.path, self.RUNS, chunk_size=2 * PAGE_SIZE)
+
+    def check_image(self):
+        with open(self.path, "rb") as f:
+            image = f.read()
+        self.assertEqual(len(image), 16 * PAGE_SIZE)
+        for base, size in self.RUNS:
+            for page in range(base, base + size, PAGE_SIZE):
+                expected = self.memory.memory[page:page + PAGE_SIZE]
+                if page in self.memory.unreadable:
+                    expected = b"\x00" * PAGE_SIZE
+                self.assertEqual(image[page:page + PAGE_SIZE], expected)
+        # Not in any run: never read nor written
+        self.assertEqual(image[:PAGE_SIZE], b"\x00" * PAGE_SIZE)
+        self.assertEqual(image[6 * PAGE_SIZE:8 * PAGE_SIZE], b"\x00" * 2 * PAGE_SIZE)
+
+    def test_dump(self):
+        holes = self.dumper().dump()
+        self.assertEqual(holes, [(10 * PAGE_SIZE, PAGE_SIZE)])
+        self.check_image()
+        self.assertFalse(os.path.exists(self.path + ".resume"))
+        self.assertFalse([addr for addr in self.memory.read_addrs if addr < PAGE_SIZE or 6 * PAGE_SIZE <= addr < 8 * PAGE_SIZE])
+
+    def test_resume(self):
+        # Simulate a dump interrupted after the first run
+        with open(self.path, "wb") as f:
+            f.seek(PAGE_SIZE)
+            f.write(self.memory.memory[PAGE_SIZE:6 * PAGE_SIZE])
+        dumper = self.dumper()
+        dumper.next_addr = 6 * PAGE_SIZE
+        dumper._save_resume()
+
+        self.dumper().dump()
+        self.check_image()
+        self.assertTrue(min(self.memory.read_addrs) >= 8 * PAGE_SIZE)
+
+    def test_resume_other_boot(self):
+        dumper = self.dumper()
+        dumper.next_addr = 6 * PAGE_SIZE
+        open(self.path, "wb").close()
+        dumper._save_resume()
+        self.memory.boot = (0xfffff80002c00000, 0x1d2c3b4a59687766)
+        self.assertRaises(ValueError, self.dumper().dump)
+        self.assertEqual(self.memory.read_addrs, [])
+
+
+if __name__ == '__main__':
+    alltests = unittest.TestSuite()
+    alltests.addTest(unittest.makeSuite(PhysicalMemoryDumperTestCase))
+    unittest.TextTestRunner(verbosity=2).run(alltests)
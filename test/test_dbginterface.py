@@ -0,0 +1,158 @@
+import sys
+sys.path.append(".")
+import threading
+import collections
+import unittest
+
+try:
+    import dbginterface
+except (ImportError, AttributeError, NameError, ValueError, SyntaxError):
+    # dbginterface needs the windows package (and Python 2)
+    dbginterface = None
+
+
+class FakeDebugSymbols(object):
+    """Replacement of IDebugSymbols recording the reloaded modules"""
+    def __init__(self):
+        self.reloaded = []
+
+    def Reload(self, module):
+        self.reloaded.append(module)
+        return 0
+
+
+def make_debugger(lazy_symbols=False):
+    """A LocalKernelDebugger without attach: only the attributes used by the tested functions"""
+    kdbg = dbginterface.LocalKernelDebugger64.__new__(dbginterface.LocalKernelDebugger64)
+    kdbg.com_lock = threading.RLock()
+    kdbg.lazy_symbols = lazy_symbols
+    kdbg._symbols_loaded_modules = set()
+    kdbg._deferred_phases = {}
+    kdbg.attach_timings = collections.OrderedDict()
+    kdbg.DebugSymbols = FakeDebugSymbols()
+    return kdbg
+
+
+@unittest.skipIf(dbginterface is None, "dbginterface needs Windows")
+class LazySymbolsTestCase(unittest.TestCase):
+    def test_loaded_once(self):
+        kdbg = make_debugger(lazy_symbols=True)
+        kdbg._load_module_syms("NT")
+        kdbg._load_module_syms("nt")
+        kdbg._load_module_syms("hal")
+        self.assertEqual(kdbg.DebugSymbols.reloaded, ["NT", "hal"])
+
+    def test_not_lazy(self):
+        kdbg = make_debugger()
+        kdbg._load_module_syms("nt")
+        self.assertEqual(kdbg.DebugSymbols.reloaded, [])
+
+
+class FakeUpgrader(object):
+    is_upgraded = False
+
+
+@unittest.skipIf(dbginterface is None, "dbginterface needs Windows")
+class DeferredPhasesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.kdbg = make_debugger()
+        self.calls = []
+
+    def phase(self, name):
+        return lambda *args: self.calls.append((name,) + args)
+
+    def test_timings(self):
+        self.kdbg._attach_phase("query_interfaces", self.phase("query_interfaces"))
+        self.kdbg._attach_phase("init_dbghelp", self.phase("init_dbghelp"), deferred=True)
+        self.assertEqual(self.calls, [("query_interfaces",)])
+        self.assertEqual(list(self.kdbg.attach_timings), ["query_interfaces"])
+
+    def test_run_once(self):
+        self.kdbg._attach_phase("init_dbghelp", self.phase("init_dbghelp"), 42, deferred=True)
+        self.kdbg._run_deferred_phase("init_dbghelp")
+        self.kdbg._run_deferred_phase("init_dbghelp")
+        self.assertEqual(self.calls, [("init_dbghelp", 42)])
+        self.assertEqual(list(self.kdbg.attach_timings), ["init_dbghelp"])
+
+    def test_reload_on_symbols_use(self):
+        self.kdbg._attach_phase("reload", self.phase("reload"), deferred=True)
+        self.kdbg.DebugSymbols.Reload("nt")
+        self.kdbg.DebugSymbols.Reload("hal")
+        self.assertEqual(self.calls, [("reload",)])
+
+    def test_upgrade_on_driver_use(self):
+        def upgrade():
+            self.calls.append(("upgrade_driver",))
+            self.kdbg.upgrader = FakeUpgrader()
+        self.kdbg._attach_phase("upgrade_driver", upgrade, deferred=True)
+        # The upgrade is done before checking that the driver is upgraded
+        self.assertRaises(ValueError, self.kdbg.kcall, 0)
+        self.assertRaises(ValueError, self.kdbg.kcall, 0)
+        self.assertEqual(self.calls, [("upgrade_driver",)])
+
+
+class FakeOutput(object):
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+
+@unittest.skipIf(dbginterface is None, "dbginterface needs Windows")
+class WarmupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.kdbg = make_debugger()
+        self.kdbg.warmup_error = None
+        self.done = []
+
+    def task(self, name, exception=None):
+        def task():
+            # The warm-up holds the COM lock for each task
+            self.assertTrue(self.kdbg.com_lock._is_owned())
+            self.done.append(name)
+            if exception is not None:
+                raise exception
+        return task
+
+    def test_tasks(self):
+        self.kdbg.number_processor = lambda: 2
+        tasks = list(self.kdbg._warmup_tasks())
+        self.assertEqual([(task.func.__name__, task.args) for task in tasks[:4]],
+                         [("read_processor_system_data", (0, dbginterface.DEBUG_DATA_KPCR_OFFSET)),
+                          ("read_processor_system_data", (0, dbginterface.DEBUG_DATA_KPRCB_OFFSET)),
+                          ("read_processor_system_data", (1, dbginterface.DEBUG_DATA_KPCR_OFFSET)),
+                          ("read_processor_system_data", (1, dbginterface.DEBUG_DATA_KPRCB_OFFSET))])
+        self.assertEqual(tasks[-1], self.kdbg._warmup_nt_exports)
+
+    def test_unknown_symbol_ignored(self):
+        self.kdbg._warmup_tasks = lambda: iter([self.task("a", ValueError("Unknow symbol")), self.task("b")])
+        self.kdbg._warmup(10)
+        self.assertEqual(self.done, ["a", "b"])
+        self.assertIsNone(self.kdbg.warmup_error)
+
+    def test_unexpected_error(self):
+        error = RuntimeError("bug")
+        self.kdbg._warmup_tasks = lambda: iter([self.task("a"), self.task("b", error), self.task("c")])
+        stderr = sys.stderr
+        sys.stderr = FakeOutput()
+        try:
+            self.kdbg._warmup(10)
+        finally:
+            output, sys.stderr = sys.stderr, stderr
+        self.assertEqual(self.done, ["a", "b"])
+        self.assertIs(self.kdbg.warmup_error, error)
+        self.assertIn("RuntimeError", "".join(output.data))
+
+    def test_budget(self):
+        self.kdbg._warmup_tasks = lambda: iter([self.task("a")])
+        self.kdbg._warmup(0)
+        self.assertEqual(self.done, [])
+
+
+if __name__ == '__main__':
+    alltests = unittest.TestSuite()
+    alltests.addTest(unittest.makeSuite(LazySymbolsTestCase))
+    alltests.addTest(unittest.makeSuite(DeferredPhasesTestCase))
+    alltests.addTest(unittest.makeSuite(WarmupTestCase))
+    unittest.TextTestRunner(verbosity=2).run(alltests)
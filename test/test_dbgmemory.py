@@ -0,0 +1,538 @@
+import sys
+sys.path.append(".")
+import unittest
+import re
+import array
+import struct
+import ctypes
+import threading
+
+import dbgmemory
+from dbgmemory import PAGE_SIZE
+
+try:
+    import dbginterface
+    import driver_upgrade
+except (ImportError, AttributeError, NameError, ValueError, SyntaxError):
+    # dbginterface needs the windows package (and Python 2)
+    dbginterface = driver_upgrade = None
+
+
+class FakeDataSpaces(object):
+    """In-memory replacement of IDebugDataSpaces: a set of mapped pages + a count of the reads"""
+    # The virtual pages are mapped in reverse order from PHYSICAL_BASE
+    PHYSICAL_BASE = 0x100000
+
+    def __init__(self, base, nb_pages):
+        self.base = base
+        self.memory = bytearray(i & 0xff for i in range(nb_pages * PAGE_SIZE))
+        self.nb_read = 0
+        self.unmapped = set()
+        # The (space, address, data) of every write, in order
+        self.writes = []
+        self.nb_translations = 0
+
+    def is_mapped(self, addr):
+        offset = addr - self.base
+        return 0 <= offset < len(self.memory) and (addr & dbgmemory.PAGE_MASK) not in self.unmapped
+
+    def ReadVirtual(self, addr, buffer, size, pread):
+        self.nb_read += 1
+        addr = addr.value
+        if not self.is_mapped(addr):
+            raise EnvironmentError("Unmapped memory at {0}".format(hex(addr)))
+        # Stop at the first unmapped page
+        end = addr
+        while end < addr + size and self.is_mapped(end):
+            end = min(addr + size, (end & dbgmemory.PAGE_MASK) + PAGE_SIZE)
+        data = bytes(self.memory[addr - self.base: end - self.base])
+        ctypes.memmove(buffer, data, len(data))
+        pread._obj.value = len(data)
+        return 0
+
+    def read_virtual(self, addr, size):
+        buffer = ctypes.create_string_buffer(size)
+        read = dbgmemory.readinto(self.ReadVirtual, addr, buffer)
+        return buffer.raw[:read]
+
+    def WriteVirtual(self, addr, buffer, size, pwritten):
+        data = ctypes.string_at(buffer, size)
+        self.writes.append(("virtual", addr.value, data))
+        self.write_virtual(addr.value, data)
+        pwritten._obj.value = size
+        return 0
+
+    def VirtualToPhysical(self, virtual, pphysical):
+        self.nb_translations += 1
+        page = (virtual.value - self.base) // PAGE_SIZE
+        nb_pages = len(self.memory) // PAGE_SIZE
+        pphysical._obj.value = self.PHYSICAL_BASE + (nb_pages - 1 - page) * PAGE_SIZE + virtual.value % PAGE_SIZE
+        return 0
+
+    def WritePhysical(self, addr, buffer, size, pwritten):
+        self.writes.append(("physical", addr.value, ctypes.string_at(buffer, size)))
+        pwritten._obj.value = size
+        return 0
+
+    def write_virtual(self, addr, data):
+        self.memory[addr - self.base: addr - self.base + len(data)] = data
+
+
+class PageCacheTestCase(unittest.TestCase):
+    BASE = 0xfffff80000000000
+
+    def setUp(self):
+        self.dataspaces = FakeDataSpaces(self.BASE, 4)
+        self.cache = dbgmemory.PageCache(self.dataspaces.read_virtual)
+
+    def test_read_same_page_once(self):
+        for i in range(0x20):
+            self.assertEqual(self.cache.read(self.BASE + 0x10 + i * 4, 4),
+                             self.dataspaces.read_virtual(self.BASE + 0x10 + i * 4, 4))
+        # 1 read for the cache + 0x20 reads for the expected values
+        self.assertEqual(self.dataspaces.nb_read, 1 + 0x20)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 0x1f)
+
+    def test_read_across_pages(self):
+        addr = self.BASE + PAGE_SIZE - 2
+        self.assertEqual(self.cache.read(addr, 4), self.dataspaces.read_virtual(addr, 4))
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_unreadable_page(self):
+        # Like the raw reads: the bytes before the unreadable page
+        addr = self.BASE + 4 * PAGE_SIZE - 2
+        self.assertEqual(self.cache.read(addr, 4), self.dataspaces.read_virtual(addr, 4))
+        self.assertIsNone(self.cache.read(self.BASE - 8, 4))
+
+    def test_unreadable_page_cached(self):
+        self.dataspaces.unmapped.add(self.BASE + PAGE_SIZE)
+        self.assertEqual(len(self.cache.read(self.BASE + PAGE_SIZE - 2, 4)), 2)
+        nb_read = self.dataspaces.nb_read
+        self.assertEqual(len(self.cache.read(self.BASE + PAGE_SIZE - 2, 4)), 2)
+        self.assertIsNone(self.cache.read(self.BASE + PAGE_SIZE, 4))
+        self.assertEqual(self.dataspaces.nb_read, nb_read)
+
+    def test_missing_pages_read_at_once(self):
+        self.cache.read(self.BASE + PAGE_SIZE, 1)
+        self.dataspaces.nb_read = 0
+        # Pages 0, 2 and 3 are missing: one read for [0] and one for [2, 3]
+        self.assertEqual(self.cache.read(self.BASE, 4 * PAGE_SIZE), bytes(self.dataspaces.memory))
+        self.assertEqual(self.dataspaces.nb_read, 2)
+        self.assertEqual(self.cache.size, 4 * PAGE_SIZE)
+
+    def test_big_read_not_cached(self):
+        cache = dbgmemory.PageCache(self.dataspaces.read_virtual, max_cached_read=2 * PAGE_SIZE)
+        self.assertIsNone(cache.read(self.BASE, 3 * PAGE_SIZE))
+        self.assertEqual((cache.size, cache.misses), (0, 0))
+        self.assertEqual(len(cache.read(self.BASE, 2 * PAGE_SIZE)), 2 * PAGE_SIZE)
+
+    def test_lru_budget(self):
+        cache = dbgmemory.PageCache(self.dataspaces.read_virtual, max_size=2 * PAGE_SIZE)
+        for i in range(4):
+            cache.read(self.BASE + i * PAGE_SIZE, 1)
+        self.assertEqual(cache.size, 2 * PAGE_SIZE)
+        self.assertEqual(list(cache.pages), [self.BASE + 2 * PAGE_SIZE, self.BASE + 3 * PAGE_SIZE])
+
+    def test_invalidate_and_flush(self):
+        addr = self.BASE + 0x100
+        self.cache.read(addr, 4)
+        self.dataspaces.write_virtual(addr, b"\x42" * 4)
+        # Stale until invalidated
+        self.assertNotEqual(self.cache.read(addr, 4), b"\x42" * 4)
+        self.cache.invalidate(addr, 4)
+        self.assertEqual(self.cache.read(addr, 4), b"\x42" * 4)
+
+        generation = self.cache.generation
+        self.cache.flush()
+        self.assertEqual(self.cache.generation, generation + 1)
+        self.assertEqual(self.cache.size, 0)
+
+
+@unittest.skipIf(dbginterface is None, "dbginterface needs Windows")
+class DebuggerMemoryCacheTestCase(unittest.TestCase):
+    """The memory cache used through LocalKernelDebuggerBase on a fake IDebugDataSpaces"""
+    BASE = 0xfffff80000000000
+
+    def setUp(self):
+        # No attach: only the attributes used by the memory functions
+        self.kdbg = dbginterface.LocalKernelDebugger64.__new__(dbginterface.LocalKernelDebugger64)
+        self.dataspaces = self.kdbg.DebugDataSpaces = FakeDataSpaces(self.BASE, 4)
+        self.kdbg.com_lock = threading.RLock()
+        self.kdbg.memory_cache = None
+        self.kdbg._write_batch = None
+        self.kdbg.enable_memory_cache(max_cached_read=2 * PAGE_SIZE)
+
+    def test_read(self):
+        for i in range(0x10):
+            self.assertEqual(self.kdbg.read_virtual_memory(self.BASE + i * 8, 8),
+                             bytes(self.dataspaces.memory[i * 8:i * 8 + 8]))
+        buffer = bytearray(0x10)
+        self.assertEqual(self.kdbg.readinto_virtual(self.BASE + 0x100, buffer), 0x10)
+        self.assertEqual(buffer, self.dataspaces.memory[0x100:0x110])
+        self.assertEqual(self.dataspaces.nb_read, 1)
+
+    def test_big_read_bypass(self):
+        self.assertEqual(self.kdbg.read_virtual_memory(self.BASE, 4 * PAGE_SIZE), bytes(self.dataspaces.memory))
+        self.assertEqual((self.dataspaces.nb_read, self.kdbg.memory_cache.size), (1, 0))
+
+    def test_write_invalidates(self):
+        self.kdbg.read_virtual_memory(self.BASE, 4)
+        self.kdbg.write_virtual_memory(self.BASE, b"ABCD")
+        self.assertEqual(self.kdbg.read_virtual_memory(self.BASE, 4), b"ABCD")
+
+
+@unittest.skipIf(dbginterface is None, "dbginterface needs Windows")
+class DebuggerWriteBatchTestCase(unittest.TestCase):
+    """write_batch of LocalKernelDebuggerBase on a fake IDebugDataSpaces"""
+    BASE = 0xfffff80000000000
+    PHYSICAL_BASE = FakeDataSpaces.PHYSICAL_BASE
+
+    def setUp(self):
+        # No attach: only the attributes used by the memory functions
+        self.kdbg = dbginterface.LocalKernelDebugger64.__new__(dbginterface.LocalKernelDebugger64)
+        self.dataspaces = self.kdbg.DebugDataSpaces = FakeDataSpaces(self.BASE, 4)
+        self.kdbg.com_lock = threading.RLock()
+        self.kdbg.memory_cache = None
+        self.kdbg._write_batch = None
+
+    def test_flush_order(self):
+        with self.kdbg.write_batch():
+            # Across the boundary of 2 pages that are not contiguous in physical memory
+            self.kdbg.write_pfv_memory(self.BASE + PAGE_SIZE - 2, b"ABCD")
+            self.kdbg.write_virtual_memory(self.BASE + 0x12, b"34")
+            self.kdbg.write_virtual_memory(self.BASE + 0x10, b"12")
+            self.kdbg.write_physical_memory(0x5000, b"P")
+            self.kdbg.write_pfv_memory(self.BASE + PAGE_SIZE + 2, b"EF")
+            self.assertEqual(self.dataspaces.writes, [])
+        # Virtual writes first, then the physical ones by address, merged
+        self.assertEqual(self.dataspaces.writes, [("virtual", self.BASE + 0x10, b"1234"),
+                                                  ("physical", 0x5000, b"P"),
+                                                  ("physical", self.PHYSICAL_BASE + 2 * PAGE_SIZE, b"CDEF"),
+                                                  ("physical", self.PHYSICAL_BASE + 4 * PAGE_SIZE - 2, b"AB")])
+        # One translation per page
+        self.assertEqual(self.dataspaces.nb_translations, 2)
+
+    def test_exception_drops_writes(self):
+        try:
+            with self.kdbg.write_batch():
+                self.kdbg.write_virtual_memory(self.BASE, b"ABCD")
+                raise ValueError("test")
+        except ValueError:
+            pass
+        self.assertEqual(self.dataspaces.writes, [])
+        self.assertIsNone(self.kdbg._write_batch)
+
+    def test_ioctl_handler_written_before_its_entry(self):
+        upgrader = driver_upgrade.DriverUpgrader64.__new__(driver_upgrade.DriverUpgrader64)
+        upgrader.kdbg = self.kdbg
+        upgrader.ioctl_array = self.BASE + 3 * PAGE_SIZE
+        upgrader.registered_ioctl = [(driver_upgrade.DU_MEMALLOC_IOCTL, self.BASE + PAGE_SIZE)]
+        # The handler code is written after the array in memory
+        upgrader.next_code_addr = self.BASE + 3 * PAGE_SIZE + 0x100
+        upgrader.upgrade_driver_add_new_ioctl_handler(driver_upgrade.DU_TEST_INT3_IOCTL, b"\xcc\xc3")
+        entry = self.PHYSICAL_BASE + 0x10
+        self.assertEqual(self.dataspaces.writes, [
+            ("physical", self.PHYSICAL_BASE + 0x100, b"\xcc\xc3"),
+            ("physical", entry + 8, struct.pack("<QQQ", self.BASE + 3 * PAGE_SIZE + 0x100, 0, 0)),
+            ("physical", entry, struct.pack("<Q", driver_upgrade.DU_TEST_INT3_IOCTL))])
+        self.assertEqual(upgrader.next_code_addr, self.BASE + 3 * PAGE_SIZE + 0x102)
+
+
+class CoalesceRangesTestCase(unittest.TestCase):
+    def test_merge(self):
+        ranges = [(0x1010, 4), (0x1000, 8), (0x1004, 8), (0x2000, 4), (0x100c, 4)]
+        merged = dbgmemory.coalesce_ranges(ranges)
+        self.assertEqual([(addr, size) for addr, size, _ in merged], [(0x1000, 0x14), (0x2000, 4)])
+        self.assertEqual(sorted(merged[0][2]), [(0, 0x10, 4), (1, 0, 8), (2, 4, 8), (4, 0xc, 4)])
+        self.assertEqual(merged[1][2], [(3, 0, 4)])
+
+    def test_max_gap(self):
+        ranges = [(0x1000, 4), (0x1008, 4)]
+        self.assertEqual(len(dbgmemory.coalesce_ranges(ranges)), 2)
+        self.assertEqual(dbgmemory.coalesce_ranges(ranges, max_gap=4), [(0x1000, 0xc, [(0, 0, 4), (1, 8, 4)])])
+
+
+class ReadRangesTestCase(unittest.TestCase):
+    BASE = 0x80000000
+
+    def setUp(self):
+        self.dataspaces = FakeDataSpaces(self.BASE, 4)
+        self.memory = bytes(self.dataspaces.memory)
+
+    def test_merged_read(self):
+        ranges = [(self.BASE + 0x10, 4), (self.BASE, 8), (self.BASE + 0x20, 4)]
+        self.assertEqual(dbgmemory.read_ranges(self.dataspaces.read_virtual, ranges, max_gap=0x10),
+                         [self.memory[0x10:0x14], self.memory[0:8], self.memory[0x20:0x24]])
+        self.assertEqual(self.dataspaces.nb_read, 1)
+
+    def test_gap_over_unreadable_page(self):
+        # The merged read stops at the unreadable page 1: the range in page 2 is read on its own
+        self.dataspaces.unmapped.add(self.BASE + PAGE_SIZE)
+        ranges = [(self.BASE + PAGE_SIZE - 4, 4), (self.BASE + 2 * PAGE_SIZE, 4)]
+        self.assertEqual(dbgmemory.read_ranges(self.dataspaces.read_virtual, ranges, max_gap=2 * PAGE_SIZE),
+                         [self.memory[PAGE_SIZE - 4:PAGE_SIZE], self.memory[2 * PAGE_SIZE:2 * PAGE_SIZE + 4]])
+        self.assertEqual(self.dataspaces.nb_read, 2)
+
+    def test_merged_read_fails(self):
+        self.dataspaces.unmapped.add(self.BASE)
+        ranges = [(self.BASE, 4), (self.BASE + PAGE_SIZE, 4)]
+        self.assertRaises(EnvironmentError, dbgmemory.read_ranges, self.dataspaces.read_virtual, ranges, PAGE_SIZE)
+        self.assertRaises(EnvironmentError, dbgmemory.read_ranges, self.dataspaces.read_virtual, ranges[:1])
+        self.assertEqual(dbgmemory.read_ranges(self.dataspaces.read_virtual, ranges[1:], PAGE_SIZE),
+                         [self.memory[PAGE_SIZE:PAGE_SIZE + 4]])
+
+
+class ReadIntoTestCase(unittest.TestCase):
+    BASE = 0x80000000
+
+    def setUp(self):
+        self.dataspaces = FakeDataSpaces(self.BASE, 1)
+        self.expected = bytes(self.dataspaces.memory[0x10:0x20])
+
+    def check_readinto(self, buffer):
+        size = dbgmemory.readinto(self.dataspaces.ReadVirtual, self.BASE + 0x10, buffer)
+        self.assertEqual(size, 0x10)
+        return buffer
+
+    def test_bytearray(self):
+        self.assertEqual(bytes(self.check_readinto(bytearray(0x10))), self.expected)
+
+    def test_memoryview(self):
+        buffer = bytearray(0x20)
+        self.check_readinto(memoryview(buffer)[0x10:])
+        self.assertEqual(bytes(buffer[0x10:]), self.expected)
+
+    def test_array(self):
+        buffer = self.check_readinto(array.array("I", [0] * 4))
+        self.assertEqual(buffer.tostring() if hasattr(buffer, "tostring") else buffer.tobytes(), self.expected)
+
+    def test_ctypes(self):
+        buffer = self.check_readinto((ctypes.c_uint32 * 4)())
+        self.assertEqual(ctypes.string_at(ctypes.addressof(buffer), 0x10), self.expected)
+
+    def test_partial_read(self):
+        self.assertEqual(dbgmemory.readinto(self.dataspaces.ReadVirtual, self.BASE + PAGE_SIZE - 4, bytearray(0x10)), 4)
+
+
+class NewArrayTestCase(unittest.TestCase):
+    def test_readinto_array(self):
+        dataspaces = FakeDataSpaces(0x1000, 1)
+        for typecode, size in dbgmemory.ARRAY_ITEM_SIZE.items():
+            res = dbgmemory.new_array(typecode, 0x10)
+            self.assertEqual(dbgmemory.buffer_size(res), 0x10 * size)
+            dbgmemory.readinto(dataspaces.ReadVirtual, 0x1000 + 0x100, res)
+            expected = struct.unpack_from("<" + typecode * 0x10, bytes(dataspaces.memory), 0x100)
+            self.assertEqual(tuple(int(x) for x in res), expected)
+
+
+class WalkListEntryTestCase(unittest.TestCase):
+    BASE = 0x10000
+    NODE_SIZE = 0x20
+    LINK_OFFSET = 0x8
+
+    def setUp(self):
+        self.dataspaces = FakeDataSpaces(self.BASE, 1)
+        self.head = self.BASE
+
+    def write_links(self, entry, flink, blink):
+        self.dataspaces.write_virtual(entry, struct.pack("<II", flink, blink))
+
+    def build_list(self, nb_nodes):
+        entries = [self.head] + [self.BASE + 0x100 + i * self.NODE_SIZE + self.LINK_OFFSET for i in range(nb_nodes)]
+        for i, entry in enumerate(entries):
+            self.write_links(entry, entries[(i + 1) % len(entries)], entries[i - 1])
+        return [entry - self.LINK_OFFSET for entry in entries[1:]]
+
+    def walk(self, max_nodes=0x100):
+        return [node for node, data in dbgmemory.walk_list_entry(self.dataspaces.read_virtual, self.head,
+                                                                  self.LINK_OFFSET, self.NODE_SIZE, 4, max_nodes)]
+
+    def test_walk(self):
+        nodes = self.build_list(5)
+        self.dataspaces.nb_read = 0
+        self.assertEqual(self.walk(), nodes)
+        # 1 read for the head + 1 read per node
+        self.assertEqual(self.dataspaces.nb_read, 6)
+
+    def test_empty(self):
+        self.build_list(0)
+        self.assertEqual(self.walk(), [])
+
+    def test_max_nodes(self):
+        self.build_list(5)
+        self.assertRaises(ValueError, self.walk, 4)
+
+    def test_cycle(self):
+        nodes = self.build_list(3)
+        # Last node points back to the first one (and Blink are coherent)
+        self.write_links(nodes[2] + self.LINK_OFFSET, nodes[0] + self.LINK_OFFSET, nodes[1] + self.LINK_OFFSET)
+        self.write_links(nodes[0] + self.LINK_OFFSET, nodes[1] + self.LINK_OFFSET, nodes[2] + self.LINK_OFFSET)
+        self.assertRaises(ValueError, self.walk)
+
+    def test_bad_blink(self):
+        nodes = self.build_list(3)
+        self.write_links(nodes[1] + self.LINK_OFFSET, nodes[2] + self.LINK_OFFSET, 0x42424242)
+        self.assertRaises(ValueError, self.walk)
+
+
+class IterChunksTestCase(unittest.TestCase):
+    BASE = 0x100000
+
+    def setUp(self):
+        self.dataspaces = FakeDataSpaces(self.BASE, 8)
+
+    def iter_chunks(self, addr, length, chunk_size):
+        readinto = lambda addr, buffer: dbgmemory.readinto(self.dataspaces.ReadVirtual, addr, buffer)
+        for offset, data in dbgmemory.iter_chunks(readinto, addr, length, chunk_size):
+            if isinstance(data, dbgmemory.MemoryHole):
+                yield offset, len(data)
+            else:
+                yield offset, data.tobytes()
+
+    def test_chunks(self):
+        chunks = list(self.iter_chunks(self.BASE + 0x10, 5 * PAGE_SIZE, 2 * PAGE_SIZE))
+        self.assertEqual([offset for offset, _ in chunks], [0, 2 * PAGE_SIZE, 4 * PAGE_SIZE])
+        self.assertEqual(b"".join(data for _, data in chunks), bytes(self.dataspaces.memory[0x10:0x10 + 5 * PAGE_SIZE]))
+
+    def test_holes(self):
+        self.dataspaces.unmapped = set([self.BASE + 2 * PAGE_SIZE, self.BASE + 3 * PAGE_SIZE, self.BASE + 6 * PAGE_SIZE])
+        chunks = list(self.iter_chunks(self.BASE, 8 * PAGE_SIZE, 4 * PAGE_SIZE))
+        self.assertEqual([(offset, len(data) if isinstance(data, bytes) else data) for offset, data in chunks],
+                         [(0, 2 * PAGE_SIZE), (2 * PAGE_SIZE, 2 * PAGE_SIZE),
+                          (4 * PAGE_SIZE, 2 * PAGE_SIZE), (6 * PAGE_SIZE, PAGE_SIZE), (7 * PAGE_SIZE, PAGE_SIZE)])
+        self.assertTrue(isinstance(chunks[0][1], bytes))
+        self.assertTrue(isinstance(chunks[1][1], int))
+        self.assertEqual(chunks[4][1], bytes(self.dataspaces.memory[7 * PAGE_SIZE:]))
+
+
+class SearchChunksTestCase(unittest.TestCase):
+    BASE = 0x200000
+
+    def setUp(self):
+        self.dataspaces = FakeDataSpaces(self.BASE, 8)
+        self.dataspaces.memory = bytearray(8 * PAGE_SIZE)
+        self.readinto = lambda addr, buffer: dbgmemory.readinto(self.dataspaces.ReadVirtual, addr, buffer)
+
+    def search(self, pattern, mask=None, chunk_size=PAGE_SIZE, overlap=None):
+        chunks = dbgmemory.iter_chunks(self.readinto, self.BASE, 8 * PAGE_SIZE, chunk_size)
+        return list(dbgmemory.search_chunks(chunks, pattern, mask, overlap))
+
+    def test_chunk_boundary(self):
+        for offset in [0x10, PAGE_SIZE - 2, 3 * PAGE_SIZE - 1, 8 * PAGE_SIZE - 4]:
+            self.dataspaces.write_virtual(self.BASE + offset, b"ABCD")
+        expected = [0x10, PAGE_SIZE - 2, 3 * PAGE_SIZE - 1, 8 * PAGE_SIZE - 4]
+        self.assertEqual(self.search(b"ABCD"), expected)
+        self.assertEqual(self.search(b"ABCD", chunk_size=3 * PAGE_SIZE), expected)
+
+    def test_mask(self):
+        self.dataspaces.write_virtual(self.BASE + PAGE_SIZE - 1, b"\x48\x8b\x05")
+        self.dataspaces.write_virtual(self.BASE + 0x100, b"\x49\x8b\x0d")
+        self.assertEqual(self.search(b"\x48\x8b\x05", b"\xf0\xff\x00"), [0x100, PAGE_SIZE - 1])
+
+    def test_overlapping_matches(self):
+        self.dataspaces.write_virtual(self.BASE + PAGE_SIZE - 2, b"AAAA")
+        expected = [PAGE_SIZE - 2, PAGE_SIZE - 1, PAGE_SIZE]
+        self.assertEqual(self.search(b"AA"), expected)
+        self.assertEqual(self.search(b"AA", b"\xff\xff"), expected)
+        self.assertEqual(self.search(b"AA", b"\xff\xff", chunk_size=3 * PAGE_SIZE), expected)
+
+    def test_regex(self):
+        self.dataspaces.write_virtual(self.BASE + 2 * PAGE_SIZE - 3, b"KEY=1234;")
+        self.assertEqual(self.search(re.compile(b"KEY=[0-9]+;"), overlap=0x10), [2 * PAGE_SIZE - 3])
+        self.assertRaises(ValueError, self.search, re.compile(b"KEY=[0-9]+;"))
+
+    def test_regex_variable_length(self):
+        # Matches cut by the end of a chunk, one longer than overlap and one at the end of the memory
+        self.dataspaces.write_virtual(self.BASE + PAGE_SIZE - 2, b"AAAA")
+        self.dataspaces.write_virtual(self.BASE + 3 * PAGE_SIZE - 0x30, b"B" * 0x50)
+        self.dataspaces.write_virtual(self.BASE + 8 * PAGE_SIZE - 2, b"AA")
+        regex = re.compile(b"A+|B+")
+        found = []
+        chunks = dbgmemory.iter_chunks(self.readinto, self.BASE, 8 * PAGE_SIZE, PAGE_SIZE)
+        for chunk_offset in dbgmemory.search_chunks(chunks, regex, overlap=0x10):
+            found.append((chunk_offset, len(regex.match(bytes(self.dataspaces.memory), chunk_offset).group())))
+        self.assertEqual(found, [(PAGE_SIZE - 2, 4), (3 * PAGE_SIZE - 0x30, 0x50), (8 * PAGE_SIZE - 2, 2)])
+
+    def test_hole(self):
+        self.dataspaces.write_virtual(self.BASE + 2 * PAGE_SIZE - 2, b"ABCD")
+        self.dataspaces.write_virtual(self.BASE + 4 * PAGE_SIZE, b"ABCD")
+        self.dataspaces.unmapped = set([self.BASE + 2 * PAGE_SIZE])
+        self.assertEqual(self.search(b"ABCD"), [4 * PAGE_SIZE])
+
+
+class SnapshotTestCase(unittest.TestCase):
+    BASE = 0x300000
+
+    def setUp(self):
+        self.dataspaces = FakeDataSpaces(self.BASE, 4)
+        readinto = lambda addr, buffer: dbgmemory.readinto(self.dataspaces.ReadVirtual, addr, buffer)
+        self.iter_read = lambda addr, size: dbgmemory.iter_chunks(readinto, addr, size)
+
+    def snapshot(self, keep_data=False):
+        return dbgmemory.take_snapshot(self.iter_read, [(self.BASE + 0x10, 3 * PAGE_SIZE)], keep_data)
+
+    def test_no_change(self):
+        snapshot = self.snapshot()
+        self.assertEqual(sorted(snapshot.digests), [self.BASE + i * PAGE_SIZE for i in range(4)])
+        self.assertEqual(dbgmemory.diff_snapshots(snapshot, self.snapshot()), [])
+
+    def test_changed_pages(self):
+        old = self.snapshot()
+        self.dataspaces.write_virtual(self.BASE + PAGE_SIZE + 0x20, b"\x00\x00")
+        self.assertEqual(dbgmemory.diff_snapshots(old, self.snapshot()), [(self.BASE + PAGE_SIZE, None)])
+
+    def test_changed_bytes(self):
+        old = self.snapshot(keep_data=True)
+        self.dataspaces.write_virtual(self.BASE + PAGE_SIZE + 0x20, b"\xff\xff")
+        self.dataspaces.write_virtual(self.BASE + PAGE_SIZE + 0x30, b"\xff")
+        self.assertEqual(dbgmemory.diff_snapshots(old, self.snapshot(keep_data=True)),
+                         [(self.BASE + PAGE_SIZE, [(self.BASE + PAGE_SIZE + 0x20, self.BASE + PAGE_SIZE + 0x22),
+                                                   (self.BASE + PAGE_SIZE + 0x30, self.BASE + PAGE_SIZE + 0x31)])])
+
+    def test_unreadable_page(self):
+        old = self.snapshot()
+        self.dataspaces.unmapped = set([self.BASE + 2 * PAGE_SIZE])
+        new = self.snapshot()
+        self.assertIsNone(new.digests[self.BASE + 2 * PAGE_SIZE])
+        self.assertEqual(dbgmemory.diff_snapshots(old, new), [(self.BASE + 2 * PAGE_SIZE, None)])
+
+
+class WriteBatchTestCase(unittest.TestCase):
+    def test_merge_adjacent(self):
+        writes = [(0x1004, b"BBBB"), (0x1000, b"AAAA"), (0x2000, b"CC")]
+        self.assertEqual(dbgmemory.merge_writes(writes), [(0x1000, b"AAAABBBB"), (0x2000, b"CC")])
+
+    def test_merge_overlap_last_wins(self):
+        writes = [(0x1000, b"AAAAAAAA"), (0x1002, b"BB"), (0x1000, b"C")]
+        self.assertEqual(dbgmemory.merge_writes(writes), [(0x1000, b"CABBAAAA")])
+
+    def test_split_by_page(self):
+        self.assertEqual(dbgmemory.split_by_page(PAGE_SIZE - 2, b"ABCD"), [(PAGE_SIZE - 2, b"AB"), (PAGE_SIZE, b"CD")])
+        self.assertEqual(dbgmemory.split_by_page(0x10, b"AB"), [(0x10, b"AB")])
+
+    def test_stage(self):
+        batch = dbgmemory.WriteBatch()
+        self.assertEqual(batch.stage("virtual", 0x1000, ctypes.c_uint32(0x44434241)), 4)
+        batch.stage("pfv", 0x2000, b"XX")
+        batch.stage("virtual", 0x1004, bytearray(b"EF"))
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch.get_writes("virtual"), [(0x1000, b"ABCD"), (0x1004, b"EF")])
+        self.assertRaises(ValueError, batch.stage, "kernel", 0x1000, b"X")
+
+
+if __name__ == '__main__':
+    alltests = unittest.TestSuite()
+    alltests.addTest(unittest.makeSuite(PageCacheTestCase))
+    alltests.addTest(unittest.makeSuite(DebuggerMemoryCacheTestCase))
+    alltests.addTest(unittest.makeSuite(DebuggerWriteBatchTestCase))
+    alltests.addTest(unittest.makeSuite(CoalesceRangesTestCase))
+    alltests.addTest(unittest.makeSuite(ReadRangesTestCase))
+    alltests.addTest(unittest.makeSuite(ReadIntoTestCase))
+    alltests.addTest(unittest.makeSuite(NewArrayTestCase))
+    alltests.addTest(unittest.makeSuite(WalkListEntryTestCase))
+    alltests.addTest(unittest.makeSuite(IterChunksTestCase))
+    alltests.addTest(unittest.makeSuite(SearchChunksTestCase))
+    alltests.addTest(unittest.makeSuite(SnapshotTestCase))
+    alltests.addTest(unittest.makeSuite(WriteBatchTestCase))
+    unittest.TextTestRunner(verbosity=2).run(alltests)
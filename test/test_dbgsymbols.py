@@ -0,0 +1,274 @@
+import sys
+sys.path.append(".")
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import dbgsymbols
+numpy = dbgsymbols.numpy
+
+NT_BASE = 0xfffff80002a00000
+NT_SYMBOLS = [("nt!KiSystemCall64", NT_BASE + 0x1000),
+              ("nt!KeBugCheckEx", NT_BASE + 0x3000),
+              ("nt!KeBugCheck", NT_BASE + 0x2000),
+              ("nt!KeBugCheck2", NT_BASE + 0x2000)]
+HAL_BASE = 0xfffff80003000000
+HAL_SYMBOLS = [("hal!HalpTimerClockInterrupt", HAL_BASE + 0x500)]
+MODULES = [(HAL_BASE, HAL_BASE + 0x10000, "hal", "hal.dll", "\\SystemRoot\\system32\\hal.dll"),
+           (NT_BASE, NT_BASE + 0x100000, "nt", "ntoskrnl.exe", "\\SystemRoot\\system32\\ntoskrnl.exe")]
+
+
+class ModuleSymbolsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = dbgsymbols.ModuleSymbols("nt", NT_BASE, 0x100000, NT_SYMBOLS)
+
+    def test_sorted(self):
+        self.assertEqual(self.table.addrs, [NT_BASE + 0x1000, NT_BASE + 0x2000, NT_BASE + 0x3000])
+        # First symbol seen at an address wins
+        self.assertEqual(self.table.names[1], "nt!KeBugCheck")
+
+    def test_lookup(self):
+        self.assertEqual(self.table.lookup(NT_BASE + 0x1000), ("nt!KiSystemCall64", 0))
+        self.assertEqual(self.table.lookup(NT_BASE + 0x2010), ("nt!KeBugCheck", 0x10))
+        self.assertEqual(self.table.lookup(NT_BASE + 0x10), ("nt", 0x10))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_lookup_many(self):
+        addresses = [NT_BASE + 0x1000, NT_BASE + 0x10, NT_BASE + 0x3fff, NT_BASE + 0x2010]
+        self.assertEqual(self.table.lookup_many(numpy.array(addresses, dtype=numpy.uint64)),
+                         [self.table.lookup(addr) for addr in addresses])
+
+    def test_find_prefix(self):
+        self.assertEqual(self.table.find_prefix("kebugcheck"), [("nt!KeBugCheck", NT_BASE + 0x2000),
+                                                                 ("nt!KeBugCheck2", NT_BASE + 0x2000),
+                                                                 ("nt!KeBugCheckEx", NT_BASE + 0x3000)])
+        self.assertEqual(self.table.find_prefix("Kd"), [])
+
+    def test_find_glob(self):
+        self.assertEqual(self.table.find_glob("Ke*Ex"), [("nt!KeBugCheckEx", NT_BASE + 0x3000)])
+        self.assertEqual(self.table.find_glob("K?SystemCall64"), [("nt!KiSystemCall64", NT_BASE + 0x1000)])
+        self.assertEqual(len(self.table.find_glob("*")), 4)
+
+    def test_find_substring(self):
+        self.assertEqual(self.table.find_substring("SYSTEMCALL"), [("nt!KiSystemCall64", NT_BASE + 0x1000)])
+
+    def test_out_of_module_symbols_ignored(self):
+        table = dbgsymbols.ModuleSymbols("nt", NT_BASE, 0x100000, NT_SYMBOLS + HAL_SYMBOLS)
+        self.assertEqual(len(table), 3)
+
+
+class ParseExportsTestCase(unittest.TestCase):
+    BASE = 0x10000000
+
+    def build_image(self, magic):
+        image = bytearray(0x400)
+        struct.pack_into("<I", image, 0x3c, 0x80)
+        struct.pack_into("<H", image, 0x80 + 0x18, magic)
+        data_directory = 0x80 + 0x18 + (0x60 if magic == 0x10b else 0x70)
+        # Export directory at 0x200, size 0x100
+        struct.pack_into("<II", image, data_directory, 0x200, 0x100)
+        # 3 functions, 3 names, functions at 0x240, names at 0x250, ordinals at 0x260
+        struct.pack_into("<IIIII", image, 0x200 + 0x14, 3, 3, 0x240, 0x250, 0x260)
+        # The 3rd function is a forwarder (its RVA is inside the export directory)
+        struct.pack_into("<III", image, 0x240, 0x1000, 0x2000, 0x280)
+        struct.pack_into("<III", image, 0x250, 0x270, 0x278, 0x280)
+        struct.pack_into("<HHH", image, 0x260, 1, 0, 2)
+        image[0x270:0x277] = b"KeBugCh"
+        image[0x278:0x27e] = b"KeTest"
+        image[0x280:0x28d] = b"HAL.Forwarded"
+        return bytes(image)
+
+    def reader(self, image):
+        def read(addr, size):
+            offset = addr - self.BASE
+            return image[offset:offset + size]
+        return read
+
+    def test_pe32_plus(self):
+        exports = dbgsymbols.parse_exports(self.reader(self.build_image(0x20b)), self.BASE)
+        self.assertEqual(exports, [(b"KeBugCh", self.BASE + 0x2000), (b"KeTest", self.BASE + 0x1000)])
+
+    def test_pe32(self):
+        exports = dbgsymbols.parse_exports(self.reader(self.build_image(0x10b)), self.BASE)
+        self.assertEqual(len(exports), 2)
+
+    def test_no_exports(self):
+        image = bytearray(self.build_image(0x20b))
+        struct.pack_into("<II", image, 0x80 + 0x18 + 0x70, 0, 0)
+        self.assertEqual(dbgsymbols.parse_exports(self.reader(bytes(image)), self.BASE), [])
+
+
+class ModuleMapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.map = dbgsymbols.ModuleMap(MODULES)
+
+    def test_sorted(self):
+        self.assertEqual([module.name for module in self.map], ["nt", "hal"])
+
+    def test_find(self):
+        self.assertEqual(self.map.find(NT_BASE).name, "nt")
+        self.assertEqual(self.map.find(HAL_BASE + 0xffff).image_name, "hal.dll")
+        self.assertIsNone(self.map.find(HAL_BASE + 0x10000))
+        self.assertIsNone(self.map.find(NT_BASE - 1))
+
+    def test_find_many(self):
+        addresses = [0, NT_BASE + 0x1234, NT_BASE + 0x100000, HAL_BASE, 0xffffffffffffffff]
+        self.assertEqual(self.map.find_many(addresses), [self.map.find(addr) for addr in addresses])
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_indexes(self):
+        addresses = [0, NT_BASE - 1, NT_BASE, HAL_BASE + 0xffff, HAL_BASE + 0x10000, 0xffffffffffffffff]
+        indexes = self.map.indexes(addresses)
+        self.assertIsInstance(indexes, numpy.ndarray)
+        self.assertEqual(indexes.tolist(), [-1, -1, 0, 1, -1, -1])
+
+    def test_find_many_without_numpy(self):
+        numpy = dbgsymbols.numpy
+        dbgsymbols.numpy = None
+        try:
+            self.assertEqual([module and module.name for module in self.map.find_many([HAL_BASE, 0, NT_BASE])],
+                             ["hal", None, "nt"])
+        finally:
+            dbgsymbols.numpy = numpy
+
+
+class SymbolIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+        self.index = dbgsymbols.SymbolIndex(dbgsymbols.ModuleMap(MODULES), self.load_symbols)
+
+    def load_symbols(self, module):
+        self.loaded.append(module)
+        return {"nt": NT_SYMBOLS, "hal": HAL_SYMBOLS}[module]
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup(NT_BASE + 0x3004), ("nt!KeBugCheckEx", 4))
+        self.assertEqual(self.index.lookup(HAL_BASE + 0x600), ("hal!HalpTimerClockInterrupt", 0x100))
+        self.assertEqual(self.index.lookup(NT_BASE - 1), (None, None))
+        self.assertEqual(self.index.lookup(HAL_BASE + 0x10000), (None, None))
+
+    def test_lazy_load(self):
+        self.index.lookup(NT_BASE + 0x3004)
+        self.index.lookup(NT_BASE + 0x1004)
+        self.assertEqual(self.loaded, ["nt"])
+
+    def test_lookup_many(self):
+        addresses = [NT_BASE + 0x3004, 0x1000, HAL_BASE + 0x500, NT_BASE + 0x1000]
+        self.assertEqual(self.index.lookup_many(addresses), [self.index.lookup(addr) for addr in addresses])
+        self.assertEqual(sorted(self.loaded), ["hal", "nt"])
+
+    def test_find_symbols(self):
+        self.assertEqual(self.index.find_symbols("nt!kebugcheck?"), [("nt!KeBugCheck2", NT_BASE + 0x2000)])
+        self.assertEqual(self.loaded, ["nt"])
+        self.assertEqual(self.index.find_symbols("*!*Clock*"), [("hal!HalpTimerClockInterrupt", HAL_BASE + 0x500)])
+        self.assertEqual(self.index.find_symbols("h*!Halp", "find_prefix"), [("hal!HalpTimerClockInterrupt", HAL_BASE + 0x500)])
+        self.assertRaises(ValueError, self.index.find_symbols, "KeBugCheck")
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_lookup_many_numpy_array(self):
+        addresses = numpy.array([HAL_BASE + 0x600, NT_BASE + 0x3004, 0x1000, NT_BASE + 0x3008], dtype=numpy.uint64)
+        self.assertEqual(self.index.lookup_many(addresses), [("hal!HalpTimerClockInterrupt", 0x100), ("nt!KeBugCheckEx", 4),
+                                                             (None, None), ("nt!KeBugCheckEx", 8)])
+
+    def test_lookup_many_without_numpy(self):
+        numpy = dbgsymbols.numpy
+        dbgsymbols.numpy = None
+        try:
+            addresses = [NT_BASE + 0x3004, 0x1000, HAL_BASE + 0x500]
+            self.assertEqual(self.index.lookup_many(addresses), [("nt!KeBugCheckEx", 4), (None, None),
+                                                                 ("hal!HalpTimerClockInterrupt", 0)])
+        finally:
+            dbgsymbols.numpy = numpy
+
+
+class SymbolCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.nb_modules = 10
+        self.bases = {"nt": NT_BASE, "drv": 0xfffff88001000000}
+        self.cache = dbgsymbols.SymbolCache(lambda: self.nb_modules, self.bases.get)
+
+    def test_case_insensitive(self):
+        self.assertEqual(self.cache.lookup("nt!KeBugCheck"), (False, None))
+        self.cache.add("nt!KeBugCheck", NT_BASE + 0x2000)
+        self.assertEqual(self.cache.lookup("NT!kebugcheck"), (True, NT_BASE + 0x2000))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.hit_rate, 0.5)
+
+    def test_negative_entry(self):
+        self.cache.add("foo!bar", None)
+        self.assertEqual(self.cache.lookup("foo!bar"), (True, None))
+        # A module was loaded: the symbol may exist now
+        self.nb_modules += 1
+        self.assertEqual(self.cache.lookup("foo!bar"), (False, None))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_module_reloaded(self):
+        self.cache.add("drv!DriverEntry", 0xfffff88001001000)
+        self.cache.add("nt!KeBugCheck", NT_BASE + 0x2000)
+        # The driver is unloaded then loaded again at another base: same number of modules
+        self.bases["drv"] = 0xfffff88002000000
+        self.assertEqual(self.cache.lookup("drv!DriverEntry"), (False, None))
+        self.assertEqual(self.cache.lookup("nt!KeBugCheck"), (True, NT_BASE + 0x2000))
+        self.assertEqual(len(self.cache), 1)
+
+    def test_clear(self):
+        self.cache.add("nt!KeBugCheck", NT_BASE + 0x2000)
+        self.cache.lookup("nt!KeBugCheck")
+        self.cache.clear()
+        self.assertEqual(self.cache.lookup("nt!KeBugCheck"), (False, None))
+        self.assertEqual(self.cache.hits, 1)
+
+
+class SymbolDatabaseTestCase(unittest.TestCase):
+    NT_KEY = ("nt", 0x5a4d1234, 0x100000)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "symbols", "lkd_symbols.db")
+        self.db = dbgsymbols.SymbolDatabase.open(self.path)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        self.db.close()
+        self.db = dbgsymbols.SymbolDatabase.open(self.path)
+
+    def test_symbols(self):
+        self.assertIsNone(self.db.get_symbol_rva(self.NT_KEY, "KeBugCheck"))
+        self.db.add_symbols(self.NT_KEY, [("KeBugCheckEx", 0x3000), ("KeBugCheck", 0x2000)])
+        self.reopen()
+        self.assertEqual(self.db.get_symbol_rva(self.NT_KEY, "kebugcheck"), 0x2000)
+        self.assertEqual(self.db.get_symbols(self.NT_KEY), [("KeBugCheck", 0x2000), ("KeBugCheckEx", 0x3000)])
+        self.assertFalse(self.db.is_complete(self.NT_KEY))
+
+    def test_module_identity(self):
+        self.db.add_symbols(self.NT_KEY, [("KeBugCheck", 0x2000)], complete=True)
+        self.assertTrue(self.db.is_complete(self.NT_KEY))
+        other_build = ("nt", 0x5a4d1235, 0x100000)
+        self.assertIsNone(self.db.get_symbol_rva(other_build, "KeBugCheck"))
+        self.assertFalse(self.db.is_complete(other_build))
+        self.assertEqual(self.db.get_symbols(other_build), [])
+
+    def test_types(self):
+        self.db.add_type_size(self.NT_KEY, "_EPROCESS", 0x4d0)
+        self.db.add_field_offset(self.NT_KEY, "_EPROCESS", "UniqueProcessId", 0x180)
+        self.reopen()
+        self.assertEqual(self.db.get_type_size(self.NT_KEY, "_EPROCESS"), 0x4d0)
+        self.assertEqual(self.db.get_field_offset(self.NT_KEY, "_EPROCESS", "UniqueProcessId"), 0x180)
+        self.assertIsNone(self.db.get_field_offset(self.NT_KEY, "_EPROCESS", "ActiveProcessLinks"))
+        self.assertIsNone(self.db.get_type_size(("nt", 0x5a4d1235, 0x100000), "_EPROCESS"))
+
+
+if __name__ == '__main__':
+    alltests = unittest.TestSuite()
+    alltests.addTest(unittest.makeSuite(ModuleSymbolsTestCase))
+    alltests.addTest(unittest.makeSuite(ParseExportsTestCase))
+    alltests.addTest(unittest.makeSuite(ModuleMapTestCase))
+    alltests.addTest(unittest.makeSuite(SymbolIndexTestCase))
+    alltests.addTest(unittest.makeSuite(SymbolCacheTestCase))
+    alltests.addTest(unittest.makeSuite(SymbolDatabaseTestCase))
+    unittest.TextTestRunner(verbosity=2).run(alltests)
@@ -0,0 +1,380 @@
+import sys
+sys.path.append(".")
+import os
+import shutil
+import struct
+import ctypes
+import tempfile
+import threading
+import unittest
+
+import dbgmemory
+import dbgsymbols
+import dbgtype
+from dbgtype import (TI_GET_SYMTAG, TI_GET_SYMNAME, TI_GET_LENGTH, TI_GET_TYPE, TI_GET_OFFSET, TI_GET_COUNT,
+                     TI_GET_BITPOSITION, TI_GET_UDTKIND)
+
+NT = 0xfffff80002a00000
+
+# typeid -> (symtag, name, size, {TI_GET_*: value}, children)
+TYPES = {
+    1: (dbgtype.SymTagUDT, "_LIST_ENTRY", 0x10, {TI_GET_UDTKIND: dbgtype.UdtStruct}, [10, 11]),
+    10: (dbgtype.SymTagData, "Flink", 0, {TI_GET_OFFSET: 0, TI_GET_TYPE: 2}, []),
+    11: (dbgtype.SymTagData, "Blink", 0, {TI_GET_OFFSET: 8, TI_GET_TYPE: 2}, []),
+    2: (dbgtype.SymTagPointerType, "_LIST_ENTRY*", 8, {TI_GET_TYPE: 1}, []),
+    3: (dbgtype.SymTagBaseType, "unsigned char", 1, {}, []),
+    4: (dbgtype.SymTagArrayType, "unsigned char[4]", 4, {TI_GET_TYPE: 3, TI_GET_COUNT: 4}, []),
+    5: (dbgtype.SymTagUDT, "_TEST", 0x18, {TI_GET_UDTKIND: dbgtype.UdtStruct}, [20, 21, 22, 23]),
+    20: (dbgtype.SymTagData, "Links", 0, {TI_GET_OFFSET: 0, TI_GET_TYPE: 1}, []),
+    21: (dbgtype.SymTagData, "Name", 0, {TI_GET_OFFSET: 0x10, TI_GET_TYPE: 4}, []),
+    22: (dbgtype.SymTagData, "Flags", 0, {TI_GET_OFFSET: 0x14, TI_GET_TYPE: 6, TI_GET_BITPOSITION: 0, TI_GET_LENGTH: 3}, []),
+    23: (dbgtype.SymTagData, "Enabled", 0, {TI_GET_OFFSET: 0x14, TI_GET_TYPE: 6, TI_GET_BITPOSITION: 3, TI_GET_LENGTH: 1}, []),
+    6: (dbgtype.SymTagBaseType, "unsigned long", 4, {}, []),
+    7: (dbgtype.SymTagUDT, "_UNION", 8, {TI_GET_UDTKIND: dbgtype.UdtUnion}, []),
+    # Anonymous union flattened by dbghelp: union { ULONG64 All; struct { ULONG Low; ULONG High; }; struct { ULONG : 31; ULONG Bit : 1 } }
+    8: (dbgtype.SymTagUDT, "_OVERLAP", 0x10, {TI_GET_UDTKIND: dbgtype.UdtStruct}, [30, 31, 32, 33, 34]),
+    30: (dbgtype.SymTagData, "All", 0, {TI_GET_OFFSET: 0, TI_GET_TYPE: 9}, []),
+    31: (dbgtype.SymTagData, "Low", 0, {TI_GET_OFFSET: 0, TI_GET_TYPE: 6}, []),
+    32: (dbgtype.SymTagData, "High", 0, {TI_GET_OFFSET: 4, TI_GET_TYPE: 6}, []),
+    33: (dbgtype.SymTagData, "Bit", 0, {TI_GET_OFFSET: 4, TI_GET_TYPE: 6, TI_GET_BITPOSITION: 31, TI_GET_LENGTH: 1}, []),
+    34: (dbgtype.SymTagData, "Last", 0, {TI_GET_OFFSET: 0xc, TI_GET_TYPE: 12}, []),
+    9: (dbgtype.SymTagBaseType, "unsigned int64", 8, {}, []),
+    12: (dbgtype.SymTagBaseType, "long", 4, {}, []),
+    13: (dbgtype.SymTagUDT, "_KIDTENTRY64", 0x10, {TI_GET_UDTKIND: dbgtype.UdtStruct}, [40, 41, 42, 43, 44, 45, 46]),
+    40: (dbgtype.SymTagData, "OffsetLow", 0, {TI_GET_OFFSET: 0, TI_GET_TYPE: 14}, []),
+    41: (dbgtype.SymTagData, "IstIndex", 0, {TI_GET_OFFSET: 4, TI_GET_TYPE: 14, TI_GET_BITPOSITION: 0, TI_GET_LENGTH: 3}, []),
+    42: (dbgtype.SymTagData, "Type", 0, {TI_GET_OFFSET: 4, TI_GET_TYPE: 14, TI_GET_BITPOSITION: 8, TI_GET_LENGTH: 5}, []),
+    43: (dbgtype.SymTagData, "Dpl", 0, {TI_GET_OFFSET: 4, TI_GET_TYPE: 14, TI_GET_BITPOSITION: 13, TI_GET_LENGTH: 2}, []),
+    44: (dbgtype.SymTagData, "Present", 0, {TI_GET_OFFSET: 4, TI_GET_TYPE: 14, TI_GET_BITPOSITION: 15, TI_GET_LENGTH: 1}, []),
+    45: (dbgtype.SymTagData, "OffsetMiddle", 0, {TI_GET_OFFSET: 6, TI_GET_TYPE: 14}, []),
+    46: (dbgtype.SymTagData, "OffsetHigh", 0, {TI_GET_OFFSET: 8, TI_GET_TYPE: 6}, []),
+    14: (dbgtype.SymTagBaseType, "unsigned short", 2, {}, []),
+}
+
+
+class Childs(object):
+    def __init__(self, types):
+        self.Types = types
+
+
+class FakeKdbg(object):
+    """Answer the type queries of a :class:`dbgtype.TypeRegistry` from TYPES and count them"""
+    PTR_SIZE = 8
+
+    def __init__(self, memory=b"", build=("nt", 0x5a4d1234, 0x100000)):
+        self.com_lock = threading.RLock()
+        self.type_registry = dbgtype.TypeRegistry(self)
+        self.memory = bytearray(memory)
+        self.build = build
+        self.nb_queries = 0
+        self.nb_reads = 0
+
+    def resolve_symbol(self, symbol):
+        return {"nt": NT}.get(symbol, symbol)
+
+    def expand_address_to_ulong64(self, addr):
+        return addr
+
+    def trim_ulong64_to_address(self, addr):
+        return addr
+
+    def get_module_identity(self, module):
+        return self.build
+
+    def resolve_type(self, module, name):
+        self.nb_queries += 1
+        return self.resolve_symbol(module), [typeid for typeid, type in TYPES.items() if type[1] == name][0]
+
+    def SymGetTypeInfo(self, module, typeid, GetType, ires=None, check=False):
+        self.nb_queries += 1
+        symtag, name, size, infos, childs = TYPES[typeid]
+        if GetType == TI_GET_SYMTAG:
+            return symtag
+        if GetType == TI_GET_SYMNAME:
+            return name
+        if GetType not in infos:
+            if check:
+                raise EnvironmentError("No info {0} for type {1}".format(GetType, typeid))
+            return 0
+        return infos[GetType]
+
+    def get_childs_types(self, module, typeid):
+        self.nb_queries += 1
+        return Childs(TYPES[typeid][4])
+
+    def get_type_name(self, module, typeid):
+        self.nb_queries += 1
+        return TYPES[typeid][1]
+
+    def get_type_size(self, module, typeid):
+        self.nb_queries += 1
+        return TYPES[typeid][2]
+
+    def read_virtual_memory(self, addr, size):
+        self.nb_reads += 1
+        return bytes(self.memory[addr:addr + size])
+
+    def read_ptr(self, addr):
+        return struct.unpack("<Q", self.read_virtual_memory(addr, 8))[0]
+
+
+class TypeRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.kdbg = FakeKdbg()
+        self.registry = self.kdbg.type_registry
+
+    def test_struct_layout(self):
+        layout = self.registry.get_layout(NT, 5)
+        self.assertEqual((layout.name, layout.size, layout.kind), ("_TEST", 0x18, "struct"))
+        self.assertEqual(list(layout.fields), ["Links", "Name", "Flags", "Enabled"])
+        self.assertEqual(layout.fields["Name"].offset, 0x10)
+        self.assertEqual(layout.fields["Name"].typeid, 4)
+        self.assertIsNone(layout.fields["Name"].bitpos)
+        self.assertEqual((layout.fields["Enabled"].bitpos, layout.fields["Enabled"].bitlen), (3, 1))
+
+    def test_pointer_array_union(self):
+        self.assertEqual(self.registry.get_layout(NT, 2)[4:7], ("pointer", 1, None))
+        self.assertEqual(self.registry.get_layout(NT, 4)[4:7], ("array", 3, 4))
+        self.assertEqual(self.registry.get_layout(NT, 7).kind, "union")
+
+    def test_memoized(self):
+        type = self.registry.get_type(NT, 5)
+        for field in type.fields:
+            field.name, field.offset, field.bitoff, field.type.name
+        nb_queries = self.kdbg.nb_queries
+        self.assertEqual(len(self.registry), 4)
+        for field in type.fields:
+            field.name, field.offset, field.bitoff, field.type.name, field.type.size
+        type.name, type.size, type.fields_dict
+        self.assertEqual(self.kdbg.nb_queries, nb_queries)
+
+    def test_clear(self):
+        self.registry.get_layout(NT, 5)
+        self.registry.cached_query(("get_type_name", NT, 5), lambda: "_TEST")
+        self.registry.clear()
+        self.assertEqual(len(self.registry), 0)
+        self.assertEqual(self.registry.queries, {})
+
+    def test_stored_query(self):
+        directory = tempfile.mkdtemp()
+        try:
+            db = dbgsymbols.SymbolDatabase.open(os.path.join(directory, "lkd_symbols.db"))
+            queries = []
+            query = lambda: queries.append(1) or 0x18
+            for i in range(2):
+                # A new session: only the sizes asked by type name are kept by the database
+                registry = dbgtype.TypeRegistry(self.kdbg, db=db)
+                self.assertEqual(registry.stored_query(NT, "_TEST", None, query), 0x18)
+                self.assertEqual(registry.stored_query(NT, "_TEST", None, query), 0x18)
+                self.assertEqual(registry.stored_query(NT, 5, "Name", lambda: queries.append(1) or 0x10), 0x10)
+            self.assertEqual(len(queries), 3)
+            self.assertEqual(db.get_type_size(self.kdbg.build, "_TEST"), 0x18)
+            db.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class DbgEngTypeTestCase(unittest.TestCase):
+    def setUp(self):
+        # A _TEST at 0x20 whose Links.Flink points to a _LIST_ENTRY at 0x0
+        memory = bytearray(0x40)
+        struct.pack_into("<QQ", memory, 0, 0x1111, 0x2222)
+        struct.pack_into("<QQ4sI", memory, 0x20, 0, 0x20, b"ABCD", 0x123c)
+        self.kdbg = FakeKdbg(bytes(memory))
+        self.type = self.kdbg.type_registry.get_type(NT, 5)
+
+    def test_handle(self):
+        self.assertFalse(self.type.is_array)
+        self.assertTrue(self.type.fields_dict["Links"].type.fields_dict["Flink"].type.is_pointer)
+        self.assertEqual(self.type.fields_dict["Links"].type.fields_dict["Flink"].type.type.name, "_LIST_ENTRY")
+        self.assertEqual(self.type.fields_dict["Name"].type.number_elt, 4)
+        self.assertEqual(self.type.fields_dict["Name"].type, self.kdbg.type_registry.get_type(NT, 4))
+        self.assertRaises(ValueError, getattr, self.type, "type")
+
+    def test_mapping(self):
+        mapped = self.type(0x20)
+        self.assertEqual(mapped.Links.Flink[0].addr, 0)
+        self.assertEqual(mapped.Links.Flink[0].Blink[0].addr, 0x2222)
+        self.assertEqual(mapped.Links.Blink[0].Blink[0].addr, 0x20)
+
+    def test_array_stride(self):
+        mapped = self.type(0x20)
+        self.assertEqual([mapped.Name[i] for i in range(4)], [ord("A"), ord("B"), ord("C"), ord("D")])
+        self.assertRaises(AttributeError, getattr, mapped, "Unknown")
+
+    def test_snapshot(self):
+        self.kdbg.nb_reads = 0
+        mapped = self.type(0x20, snapshot=True)
+        self.assertEqual([mapped.Name[i] for i in range(4)], [ord("A"), ord("B"), ord("C"), ord("D")])
+        self.assertEqual((mapped.Links.Flink[0].addr, mapped.Links.Blink[0].addr), (0, 0x20))
+        self.assertEqual(self.kdbg.nb_reads, 1)
+        # The pointed memory is live
+        self.assertEqual(mapped.Links.Flink[0].Blink[0].addr, 0x2222)
+        self.assertEqual(self.kdbg.nb_reads, 2)
+
+    def test_snapshot_refresh(self):
+        mapped = self.type(0x20, snapshot=True)
+        links = mapped.Links
+        self.kdbg.memory[0x30:0x34] = b"WXYZ"
+        self.kdbg.memory[0x28:0x30] = b"\0" * 8
+        self.assertEqual((mapped.Name[0], links.Blink[0].addr), (ord("A"), 0x20))
+        links.refresh()
+        self.assertEqual((mapped.Name[0], links.Blink[0].addr), (ord("W"), 0))
+        # Live mappings see the memory
+        self.assertEqual(self.type(0x20).Name[1], ord("X"))
+
+
+class ToCtypesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.kdbg = FakeKdbg()
+        self.registry = self.kdbg.type_registry
+
+    def test_struct(self):
+        ctype = self.registry.get_type(NT, 5).to_ctypes()
+        self.assertEqual(ctypes.sizeof(ctype), 0x18)
+        self.assertEqual(ctype.Name.offset, 0x10)
+        value = ctype.from_buffer_copy(struct.pack("<QQ4sI", 0x1111, 0x2222, b"ABCD", 0x123c))
+        self.assertEqual((value.Links.Flink, value.Links.Blink), (0x1111, 0x2222))
+        self.assertEqual(list(value.Name), [ord("A"), ord("B"), ord("C"), ord("D")])
+        self.assertEqual((value.Flags, value.Enabled), (4, 1))
+
+    def test_cached(self):
+        ctype = self.registry.to_ctypes(NT, 5)
+        self.assertIs(self.registry.to_ctypes(NT, 5), ctype)
+        self.assertIs(ctype._fields_[0][1], self.registry.to_ctypes(NT, 1))
+        self.assertIs(self.registry.to_ctypes(NT, 2), ctypes.c_uint64)
+
+    def test_overlapping_fields(self):
+        ctype = self.registry.to_ctypes(NT, 8)
+        self.assertEqual(ctypes.sizeof(ctype), 0x10)
+        value = ctype.from_buffer_copy(struct.pack("<QII", 0x8000000100000002, 0, 0xffffffff))
+        self.assertEqual(value.All, 0x8000000100000002)
+        self.assertEqual((value.Low, value.High, value.Bit), (2, 0x80000001, 1))
+        self.assertEqual(value.Last, -1)
+
+    def test_union(self):
+        self.assertEqual(ctypes.sizeof(self.registry.to_ctypes(NT, 7)), 8)
+
+
+class BitfieldTestCase(unittest.TestCase):
+    def setUp(self):
+        # 256 IDT entries: Present for the even vectors, Dpl 3 for the multiples of 3
+        self.entries = b"".join(struct.pack("<HHHHII", i, 0x10, (i % 2 == 0) << 15 | (3 if i % 3 == 0 else 0) << 13 | 0xe << 8 | i % 8,
+                                            0xffff, 0xfffff800, 0) for i in range(256))
+        self.kdbg = FakeKdbg(b"\0" * 0x1000 + self.entries)
+        self.type = self.kdbg.type_registry.get_type(NT, 13)
+
+    def test_layout_mask(self):
+        dpl = self.type.layout.fields["Dpl"]
+        self.assertEqual((dpl.bitpos, dpl.bitlen, dpl.mask), (13, 2, 3))
+        self.assertIsNone(self.type.layout.fields["OffsetLow"].mask)
+
+    def test_mapping(self):
+        entry = self.type(0x1000 + 3 * 0x10)
+        self.assertEqual((entry.Present, entry.Dpl, entry.Type, entry.IstIndex), (0, 3, 0xe, 3))
+        entry = self.type(0x1000 + 4 * 0x10, snapshot=True)
+        self.assertEqual((entry.Present, entry.Dpl, entry.Type, entry.IstIndex, entry.OffsetLow), (1, 0, 0xe, 4, 4))
+
+    def test_read_field_array(self):
+        present = self.type.read_field_array(0x1000, 256, "Present")
+        self.assertEqual(list(present), [int(i % 2 == 0) for i in range(256)])
+        self.assertEqual(list(self.type.decode_field(self.entries, "Dpl")), [3 if i % 3 == 0 else 0 for i in range(256)])
+        self.assertEqual(list(self.type.decode_field(self.entries, "OffsetLow", 4)), [0, 1, 2, 3])
+        self.assertEqual(list(self.type.decode_field(self.entries, "OffsetHigh", 2)), [0xfffff800] * 2)
+
+    @unittest.skipIf(dbgtype.numpy is None, "NumPy is not installed")
+    def test_decode_field_numpy(self):
+        numpy = dbgtype.numpy
+        for name in ["OffsetLow", "IstIndex", "Dpl", "Present", "OffsetHigh"]:
+            values = self.type.decode_field(self.entries, name)
+            self.assertIsInstance(values, numpy.ndarray)
+            dbgtype.numpy = None
+            try:
+                expected = self.type.decode_field(self.entries, name)
+            finally:
+                dbgtype.numpy = numpy
+            self.assertEqual(values.tolist(), expected)
+
+    def test_read_field_array_without_numpy(self):
+        numpy = dbgtype.numpy
+        dbgtype.numpy = None
+        try:
+            self.assertEqual(self.type.read_field_array(0x1000, 4, "IstIndex"), [0, 1, 2, 3])
+            self.assertEqual(self.type.decode_field(self.entries, "Dpl", 4), [3, 0, 0, 3])
+        finally:
+            dbgtype.numpy = numpy
+
+
+class LayoutFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "nt_types.json")
+        self.kdbg = FakeKdbg()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def export(self, *typeids, **kwargs):
+        registry = self.kdbg.type_registry
+        return registry.export(self.path, [registry.get_type(NT, typeid) for typeid in typeids], **kwargs)
+
+    def test_export_reachable(self):
+        # _TEST -> _LIST_ENTRY -> _LIST_ENTRY*, unsigned char[4] -> unsigned char, unsigned long
+        self.assertEqual(self.export(5), 6)
+        self.assertEqual(self.export(2, follow_pointers=False), 1)
+        self.assertRaises(ValueError, self.kdbg.type_registry.export, self.path,
+                          [self.kdbg.type_registry.get_type(NT, 5), self.kdbg.type_registry.get_type(NT + 1, 6)])
+
+    def test_offline(self):
+        self.export(5, 8)
+        image = bytearray(0x40)
+        struct.pack_into("<QQ4sI", image, 0x20, 0x20, 0, b"ABCD", 0x123c)
+        memory = dbgtype.OfflineMemory(lambda addr, size: bytes(image[addr:addr + size]), 8)
+        registry = dbgtype.load_layouts(self.path, memory)
+        self.assertEqual(registry.build, ("nt", 0x5a4d1234, 0x100000))
+        type = registry.get_type_by_name("nt", "_TEST")
+        self.assertEqual(type.module_name, "nt")
+        self.assertEqual(list(type.layout.fields), ["Links", "Name", "Flags", "Enabled"])
+        self.assertEqual(type.layout, self.kdbg.type_registry.get_layout(NT, 5)._replace(module="nt"))
+        mapped = type(0x20)
+        self.assertEqual(mapped.Links.Flink[0].Flink[0].addr, 0x20)
+        self.assertEqual(mapped.Name[1], ord("B"))
+        self.assertEqual(type.read(0x20).Enabled, 1)
+        self.assertEqual((mapped.Flags, mapped.Enabled), (4, 1))
+        self.assertEqual(ctypes.sizeof(registry.get_type_by_name("nt", "_OVERLAP").to_ctypes()), 0x10)
+        self.assertRaises(ValueError, registry.get_type_by_name, "nt", "_UNION")
+
+    def test_cold_start(self):
+        self.export(5)
+        kdbg = FakeKdbg()
+        registry = dbgtype.load_layouts(self.path, kdbg)
+        self.assertEqual(len(registry), 6)
+        type = registry.get_type_by_name("nt", "_TEST")
+        type.fields, type.to_ctypes()
+        self.assertEqual(kdbg.nb_queries, 0)
+        # The typeids of the file are never given to the live session
+        self.assertEqual(len(kdbg.type_registry), 0)
+        self.assertRaises(ValueError, kdbg.type_registry.load, self.path)
+        self.assertRaises(ValueError, registry.get_type_by_name, "nt", "_UNION")
+        other_build = FakeKdbg(build=("nt", 0x5a4d1235, 0x100000))
+        self.assertRaises(ValueError, dbgtype.load_layouts, self.path, other_build)
+
+    def test_snapshot_memory(self):
+        page = bytearray(dbgmemory.PAGE_SIZE * 2)
+        struct.pack_into("<Q", page, dbgmemory.PAGE_SIZE - 4, 0x1122334455667788)
+        snapshot = dbgmemory.take_snapshot(lambda addr, size: dbgmemory.iter_chunks(
+            lambda addr, buffer: dbgmemory.copy_into(buffer, bytes(page[addr:addr + len(buffer)])), addr, size),
+            [(0, len(page))], keep_data=True)
+        memory = dbgtype.OfflineMemory.from_snapshot(snapshot, 8)
+        self.assertEqual(memory.read_ptr(dbgmemory.PAGE_SIZE - 4), 0x1122334455667788)
+        self.assertRaises(ValueError, memory.read, dbgmemory.PAGE_SIZE * 2, 4)
+
+
+if __name__ == '__main__':
+    alltests = unittest.TestSuite()
+    alltests.addTest(unittest.makeSuite(TypeRegistryTestCase))
+    alltests.addTest(unittest.makeSuite(DbgEngTypeTestCase))
+    alltests.addTest(unittest.makeSuite(ToCtypesTestCase))
+    alltests.addTest(unittest.makeSuite(BitfieldTestCase))
+    alltests.addTest(unittest.makeSuite(LayoutFileTestCase))
+    unittest.TextTestRunner(verbosity=2).run(alltests)